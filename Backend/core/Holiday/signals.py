@@ -0,0 +1,18 @@
+"""
+Holiday and week-off policy edits invalidate the compiled work calendars
+(WorkCalendar) in every process.
+"""
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from ServiceWeekOff.models import WeekOffPolicy
+from .models import Holiday
+from .work_calendar import WorkCalendar
+
+
+@receiver(post_save, sender=Holiday)
+@receiver(post_delete, sender=Holiday)
+@receiver(post_save, sender=WeekOffPolicy)
+@receiver(post_delete, sender=WeekOffPolicy)
+def invalidate_work_calendars(sender, instance, **kwargs):
+    WorkCalendar.invalidate()
@@ -0,0 +1,216 @@
+"""
+Compiled holiday and week-off calendars shared by leave and payroll.
+
+A YearCalendar holds one year of an admin's (or an organization's) holidays
+as a bitset - bit i is day i of the year - and one bitset per week-off
+policy with its week_days and week_off_cycle applied (week n of a month is
+days 7n-6 to 7n). Whether a day is off is then a bit test, and counting the
+working, holiday or week-off days of any range is a mask and a popcount
+instead of a walk over the days.
+
+WorkCalendar keeps compiled calendars in a process-local LRU
+(WORK_CALENDAR_CACHE_SIZE entries, one per scope and year). Saving or
+deleting a Holiday or WeekOffPolicy (Holiday/signals.py) clears it in the
+saving process and bumps a version in the Django cache; other processes
+compare that version at most every WORK_CALENDAR_VERSION_CHECK_SECONDS and
+drop their calendars when it moved.
+"""
+import calendar as calendar_module
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from ServiceWeekOff.models import WeekOffPolicy
+from .models import Holiday
+
+logger = logging.getLogger(__name__)
+
+WORK_CALENDAR_VERSION_KEY = 'work_calendar_version'
+
+
+class YearCalendar:
+    """Holidays and week-off policies of one year as bitsets"""
+
+    def __init__(self, year, holiday_dates, policies=()):
+        self.year = year
+        self.start = date(year, 1, 1)
+        self.days = 366 if calendar_module.isleap(year) else 365
+        self.holiday_bits = 0
+        for holiday_date in holiday_dates:
+            if holiday_date.year == year:
+                self.holiday_bits |= 1 << (holiday_date - self.start).days
+        self._masks = {}
+        for policy in policies:
+            self.policy_bits(policy)
+
+    def policy_bits(self, policy):
+        """Week-off bitset of one policy (compiled on first use)"""
+        bits = self._masks.get(policy.id) if policy.id is not None else None
+        if bits is None:
+            week_days = policy.week_days if isinstance(policy.week_days, list) else []
+            weekdays = {index for index, name in enumerate(calendar_module.day_name) if name in week_days}
+            cycle = policy.week_off_cycle
+            bits = 0
+            if weekdays:
+                day = self.start
+                for index in range(self.days):
+                    if day.weekday() in weekdays and (not cycle or (day.day - 1) // 7 + 1 in cycle):
+                        bits |= 1 << index
+                    day += timedelta(days=1)
+            if policy.id is not None:
+                self._masks[policy.id] = bits
+        return bits
+
+    def week_off_bits(self, policies):
+        """Days that are a week-off under any of the policies"""
+        bits = 0
+        for policy in policies:
+            bits |= self.policy_bits(policy)
+        return bits
+
+    def range_bits(self, from_date, to_date):
+        """Bitset of the days from from_date to to_date (both included) that fall in this year"""
+        first = max((from_date - self.start).days, 0)
+        last = min((to_date - self.start).days, self.days - 1)
+        if last < first:
+            return 0
+        return ((1 << (last - first + 1)) - 1) << first
+
+    def is_holiday(self, day):
+        return day.year == self.year and bool(self.holiday_bits >> (day - self.start).days & 1)
+
+    def is_week_off(self, day, policies):
+        return day.year == self.year and bool(self.week_off_bits(policies) >> (day - self.start).days & 1)
+
+    def count(self, from_date, to_date, policies=(), count_week_offs=False, count_holidays=False):
+        """Days of the range that are not skipped: week-offs (unless counted) and holidays (unless counted)"""
+        skipped = 0
+        if not count_week_offs:
+            skipped |= self.week_off_bits(policies)
+        if not count_holidays:
+            skipped |= self.holiday_bits
+        return (self.range_bits(from_date, to_date) & ~skipped).bit_count()
+
+    def off_days(self, from_date, to_date, policies=()):
+        """Dates of the range that are a week-off or a holiday"""
+        bits = self.range_bits(from_date, to_date) & (self.holiday_bits | self.week_off_bits(policies))
+        days = []
+        while bits:
+            low = bits & -bits
+            days.append(self.start + timedelta(days=low.bit_length() - 1))
+            bits ^= low
+        return days
+
+
+class WorkCalendar:
+    _calendars = OrderedDict()
+    _lock = threading.Lock()
+    _version = None
+    _version_checked_at = 0.0
+
+    @staticmethod
+    def calendar(year, admin=None, organization=None):
+        """
+        YearCalendar of the admin's holidays and week-off policies (else the organization's);
+        two queries when not cached
+        """
+        admin_id = getattr(admin, 'pk', admin)
+        organization_id = getattr(organization, 'pk', organization)
+        if admin_id:
+            key = ('admin', admin_id, year)
+            holidays = Holiday.objects.filter(admin_id=admin_id)
+            policies = WeekOffPolicy.objects.filter(admin_id=admin_id)
+        elif organization_id:
+            key = ('organization', organization_id, year)
+            holidays = Holiday.objects.filter(organization_id=organization_id)
+            policies = WeekOffPolicy.objects.filter(admin__own_admin_profile__organization_id=organization_id)
+        else:
+            return YearCalendar(year, [])
+
+        def build():
+            return YearCalendar(
+                year,
+                holidays.filter(holiday_date__year=year, is_active=True).values_list('holiday_date', flat=True),
+                policies.filter(is_active=True)
+            )
+        return WorkCalendar._get(key, build)
+
+    @staticmethod
+    def _years(from_date, to_date, admin, organization):
+        for year in range(from_date.year, to_date.year + 1):
+            yield WorkCalendar.calendar(year, admin, organization)
+
+    @staticmethod
+    def working_days(from_date, to_date, policies=(), admin=None, organization=None,
+                     count_week_offs=False, count_holidays=False):
+        """Days from from_date to to_date (both included) that are neither a week-off nor a holiday"""
+        if from_date > to_date:
+            return 0
+        return sum(
+            year_calendar.count(from_date, to_date, policies, count_week_offs, count_holidays)
+            for year_calendar in WorkCalendar._years(from_date, to_date, admin, organization)
+        )
+
+    @staticmethod
+    def off_days(from_date, to_date, policies=(), admin=None, organization=None):
+        """Week-off and holiday dates from from_date to to_date"""
+        if from_date > to_date:
+            return []
+        days = []
+        for year_calendar in WorkCalendar._years(from_date, to_date, admin, organization):
+            days.extend(year_calendar.off_days(from_date, to_date, policies))
+        return days
+
+    @staticmethod
+    def _get(key, build):
+        WorkCalendar._check_version()
+        with WorkCalendar._lock:
+            year_calendar = WorkCalendar._calendars.get(key)
+            if year_calendar is not None:
+                WorkCalendar._calendars.move_to_end(key)
+                return year_calendar
+        year_calendar = build()
+        with WorkCalendar._lock:
+            WorkCalendar._calendars[key] = year_calendar
+            while len(WorkCalendar._calendars) > getattr(settings, 'WORK_CALENDAR_CACHE_SIZE', 256):
+                WorkCalendar._calendars.popitem(last=False)
+        return year_calendar
+
+    @staticmethod
+    def _check_version():
+        """Drop the local calendars if another process changed holidays or week-offs since the last check"""
+        now = time.monotonic()
+        if now - WorkCalendar._version_checked_at < getattr(settings, 'WORK_CALENDAR_VERSION_CHECK_SECONDS', 10):
+            return
+        WorkCalendar._version_checked_at = now
+        try:
+            version = cache.get(WORK_CALENDAR_VERSION_KEY)
+        except Exception as e:
+            logger.warning(f"Could not read the work calendar version: {str(e)}")
+            return
+        if version != WorkCalendar._version:
+            with WorkCalendar._lock:
+                WorkCalendar._calendars.clear()
+                WorkCalendar._version = version
+
+    @staticmethod
+    def invalidate():
+        """Forget every compiled calendar here and, through the cache version, in other processes"""
+        def clear():
+            version = uuid4().hex
+            with WorkCalendar._lock:
+                WorkCalendar._calendars.clear()
+                WorkCalendar._version = version
+            try:
+                cache.set(WORK_CALENDAR_VERSION_KEY, version, None)
+            except Exception as e:
+                logger.error(f"Could not publish the work calendar version: {str(e)}")
+        # After commit, so no process can rebuild a calendar from the uncommitted rows' old values
+        transaction.on_commit(clear)
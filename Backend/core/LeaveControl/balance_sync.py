@@ -1,44 +1,45 @@
 """
 Helper function to sync leave balance based on actual leave applications
 """
+import logging
 from decimal import Decimal
-from django.db import models
+from django.db import models, transaction
+from .leave_ledger import LeaveLedger, COUNTED_STATUSES
 from .models import EmployeeLeaveBalance, LeaveApplication
 
+logger = logging.getLogger(__name__)
+
 
 def sync_leave_balance(user_id, leave_type_id, year):
     """
-    Recalculate and sync 'used' count based on all pending + approved leaves
-    This ensures accuracy and fixes any inconsistencies
+    Recalculate 'used' from all pending + approved leaves of the leave year and book any difference
+    as a ledger adjustment. The apply flow keeps balances current through the ledger; this is a
+    repair tool for a single balance.
     """
-    # Get the balance record
-    balance = EmployeeLeaveBalance.objects.filter(
-        user__id=user_id,
-        leave_type_id=leave_type_id,
-        year=year
-    ).first()
-    
-    if not balance:
-        print(f"❌ Balance not found for user={user_id}, leave_type={leave_type_id}, year={year}")
-        return None
-    
-    # Calculate total used from all pending + approved leaves
-    total_used = LeaveApplication.objects.filter(
-        user__id=user_id,
-        leave_type_id=leave_type_id,
-        from_date__year=year,
-        status__in=['pending', 'approved']
-    ).aggregate(
-        total=models.Sum('total_days')
-    )['total'] or 0
-    
-    # Update balance
-    old_used = balance.used
-    balance.used = Decimal(str(total_used))
-    balance.save()
-    
-    print(f"✅ Balance synced: user={user_id}, leave_type={leave_type_id}, year={year}")
-    print(f"   Old used: {old_used}, New used: {balance.used}, Change: {balance.used - Decimal(str(old_used))}")
-    
-    return balance
+    with transaction.atomic():
+        balance = EmployeeLeaveBalance.objects.select_for_update(of=('self',)).filter(
+            user__id=user_id,
+            leave_type_id=leave_type_id,
+            year=year
+        ).first()
+
+        if not balance:
+            logger.warning(f"Balance not found for user={user_id}, leave_type={leave_type_id}, year={year}")
+            return None
 
+        total_used = LeaveApplication.objects.filter(
+            user__id=user_id,
+            leave_type_id=leave_type_id,
+            leave_year=year,
+            status__in=COUNTED_STATUSES
+        ).aggregate(
+            total=models.Sum('total_days')
+        )['total'] or Decimal('0.00')
+
+        difference = Decimal(str(total_used)) - balance.used
+        if difference:
+            LeaveLedger.record(balance.id, 'adjustment', used=difference, note='synced with leave applications')
+            balance.refresh_from_db()
+            logger.info(f"Balance synced: user={user_id}, leave_type={leave_type_id}, year={year}, used changed by {difference}")
+
+    return balance
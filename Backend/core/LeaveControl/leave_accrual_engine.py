@@ -0,0 +1,170 @@
+"""
+Organization-wide leave accrual in a fixed number of queries per chunk.
+
+LeaveAccrualEngine credits every accrual-enabled leave type to every eligible
+employee of an organization for the period containing the accrual date. The
+active employees (joined on or before that date) are read in chunks of
+LEAVE_ACCRUAL_CHUNK_SIZE; for each chunk the missing balances of the year are
+bulk-created, the balances are locked, the (user, leave type) pairs that
+already have a LeaveAccrualLog for their period key are skipped, and the
+credits are written with one bulk_update of the balances and one bulk_create
+of the logs (with their LeaveLedger entries). A chunk commits as a whole, and the unique (user, leave_type,
+period_key) log makes re-running a period (a retried task, a manual run)
+credit nothing twice. Credits go to the balance of the organization's leave
+year (LeaveYear) the accrual date falls in, and a yearly period is that
+leave year.
+"""
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from AuthN.models import UserProfile
+from .leave_ledger import LeaveLedger
+from .leave_year import LeaveYear
+from .models import LeaveType, EmployeeLeaveBalance, LeaveAccrualLog, LeaveLedgerEntry
+
+
+class LeaveAccrualEngine:
+
+    @staticmethod
+    def accrual_period(frequency, accrual_date, start_month=1):
+        """(period start, period end, period key) of the accrual period containing accrual_date"""
+        year = accrual_date.year
+        if frequency == 'quarterly':
+            quarter = (accrual_date.month - 1) // 3
+            end_month = quarter * 3 + 3
+            return (
+                date(year, quarter * 3 + 1, 1), date(year, end_month, monthrange(year, end_month)[1]),
+                f"{year}-Q{quarter + 1}"
+            )
+        if frequency == 'yearly':
+            leave_year = LeaveYear.of(accrual_date, start_month)
+            return (*LeaveYear.date_range(leave_year, start_month), str(leave_year))
+        return (
+            accrual_date.replace(day=1), accrual_date.replace(day=monthrange(year, accrual_date.month)[1]),
+            f"{year}-{accrual_date.month:02d}"
+        )
+
+    @staticmethod
+    def accrual_leave_types(organization):
+        """{admin id: [leave types accruing under that admin]} for the organization's admins"""
+        leave_types = defaultdict(list)
+        for leave_type in LeaveType.objects.filter(
+            admin__own_admin_profile__organization=organization,
+            accrual_enabled=True, is_active=True, accrual_rate__gt=0
+        ):
+            leave_types[leave_type.admin_id].append(leave_type)
+        return leave_types
+
+    @staticmethod
+    def run(organization, accrual_date=None):
+        """Accrue leave for the organization's employees; returns counters of what was done"""
+        accrual_date = accrual_date or date.today()
+        stats = {"employees": 0, "accrued": 0, "already_accrued": 0, "balances_created": 0}
+
+        leave_types = LeaveAccrualEngine.accrual_leave_types(organization)
+        if not leave_types:
+            return stats
+
+        start_month = LeaveYear.start_month(organization.id)
+        chunk_size = getattr(settings, 'LEAVE_ACCRUAL_CHUNK_SIZE', 2000)
+        employees = UserProfile.objects.filter(
+            organization=organization, admin_id__in=list(leave_types),
+            user__is_active=True, date_of_joining__lte=accrual_date
+        ).order_by('user_id').values_list('user_id', 'admin_id')
+
+        last_user_id = None
+        while True:
+            chunk = employees if last_user_id is None else employees.filter(user_id__gt=last_user_id)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                break
+            last_user_id = chunk[-1][0]
+            stats["employees"] += len(chunk)
+            for key, value in LeaveAccrualEngine._accrue_chunk(chunk, leave_types, accrual_date, start_month).items():
+                stats[key] += value
+        return stats
+
+    @staticmethod
+    def _accrue_chunk(chunk, leave_types, accrual_date, start_month=1):
+        """Credit one chunk of (user id, admin id) pairs inside a single transaction"""
+        year = LeaveYear.of(accrual_date, start_month)
+        now = timezone.now()
+        periods = {
+            leave_type.id: LeaveAccrualEngine.accrual_period(leave_type.accrual_frequency, accrual_date, start_month)
+            for types in leave_types.values() for leave_type in types
+        }
+        pairs = [(user_id, leave_type) for user_id, admin_id in chunk for leave_type in leave_types[admin_id]]
+        user_ids = [user_id for user_id, _ in chunk]
+        leave_type_ids = list(periods)
+        stats = {"accrued": 0, "already_accrued": 0, "balances_created": 0}
+        batch_size = getattr(settings, 'LEAVE_ACCRUAL_WRITE_BATCH_SIZE', 500)
+
+        with transaction.atomic():
+            balances = EmployeeLeaveBalance.objects.filter(
+                user_id__in=user_ids, leave_type_id__in=leave_type_ids, year=year
+            )
+            existing = set(balances.values_list('user_id', 'leave_type_id'))
+            missing = [
+                EmployeeLeaveBalance(user_id=user_id, leave_type=leave_type, year=year, assigned=leave_type.default_count)
+                for user_id, leave_type in pairs if (user_id, leave_type.id) not in existing
+            ]
+            if missing:
+                # ignore_conflicts: a balance created concurrently (e.g. by a leave request) is kept as it is
+                EmployeeLeaveBalance.objects.bulk_create(missing, ignore_conflicts=True, batch_size=batch_size)
+                stats["balances_created"] = len(missing)
+
+            locked = {
+                (balance.user_id, balance.leave_type_id): balance
+                for balance in balances.select_for_update()
+            }
+            # Openings only for the rows inserted here: a balance a concurrent writer created
+            # (skipped by ignore_conflicts) already has its own opening entry
+            unledgered = LeaveLedger.unledgered(
+                [locked[(balance.user_id, balance.leave_type_id)].id for balance in missing]
+            )
+            accrued_before = set(LeaveAccrualLog.objects.filter(
+                user_id__in=user_ids, leave_type_id__in=leave_type_ids,
+                period_key__in={period[2] for period in periods.values()}
+            ).values_list('user_id', 'leave_type_id', 'period_key'))
+
+            changed = []
+            logs = []
+            entries = [
+                LeaveLedger.entry(locked[(balance.user_id, balance.leave_type_id)], 'opening', assigned=balance.assigned)
+                for balance in missing if locked[(balance.user_id, balance.leave_type_id)].id in unledgered
+            ]
+            for user_id, leave_type in pairs:
+                period_start, period_end, period_key = periods[leave_type.id]
+                if (user_id, leave_type.id, period_key) in accrued_before:
+                    stats["already_accrued"] += 1
+                    continue
+                balance = locked[(user_id, leave_type.id)]
+                balance_before = balance.accrued
+                balance.accrued += leave_type.accrual_rate
+                balance.assigned += leave_type.accrual_rate
+                balance.last_accrued_at = now
+                balance.updated_at = now
+                changed.append(balance)
+                logs.append(LeaveAccrualLog(
+                    user_id=user_id, leave_type=leave_type, leave_balance=balance,
+                    accrual_date=accrual_date, accrual_period_start=period_start,
+                    accrual_period_end=period_end, period_key=period_key,
+                    days_accrued=leave_type.accrual_rate, balance_before=balance_before,
+                    balance_after=balance.accrued, is_processed=True, processed_at=now
+                ))
+                entries.append(LeaveLedger.entry(balance, 'accrual', assigned=leave_type.accrual_rate, note=period_key))
+
+            if changed:
+                EmployeeLeaveBalance.objects.bulk_update(
+                    changed, ['accrued', 'assigned', 'last_accrued_at', 'updated_at'], batch_size=batch_size
+                )
+                LeaveAccrualLog.objects.bulk_create(logs, batch_size=batch_size)
+                stats["accrued"] = len(logs)
+            if entries:
+                LeaveLedgerEntry.objects.bulk_create(entries, batch_size=batch_size)
+        return stats
@@ -8,14 +8,19 @@ from datetime import date, datetime, timedelta
 from django.utils import timezone
 from django.db.models import Q, Sum
 from .models import (
-    LeaveType, LeavePolicy, EmployeeLeaveBalance,
+    LeaveType, EmployeeLeaveBalance,
     LeaveApplication, LeaveAccrualLog
 )
 try:
-    from Holiday.models import Holiday
+    from .models import LeavePolicy
 except ImportError:
-    Holiday = None
+    LeavePolicy = None
+from Holiday.work_calendar import WorkCalendar
 from AuthN.models import BaseUserModel
+from .leave_accrual_engine import LeaveAccrualEngine
+from .leave_ledger import LeaveLedger
+from .leave_rollover_engine import LeaveRolloverEngine
+from .leave_year import LeaveYear
 
 
 class LeaveCalculator:
@@ -24,38 +29,23 @@ class LeaveCalculator:
     def __init__(self, employee, leave_type, year=None):
         self.employee = employee
         self.leave_type = leave_type
-        self.year = year or date.today().year
         self.user_profile = employee.own_user_profile
+        self.start_month = LeaveYear.start_month(self.user_profile.organization_id)
+        self.year = year or LeaveYear.of(date.today(), self.start_month)
     
     def calculate_leave_days(self, from_date, to_date, include_weekends=False, include_holidays=False):
         """Calculate total leave days between dates"""
         if from_date > to_date:
             return Decimal('0.00')
         
-        total_days = Decimal(str((to_date - from_date).days + 1))
-        
-        if not include_weekends:
-            # Subtract weekends
-            current_date = from_date
-            weekend_days = Decimal('0.00')
-            while current_date <= to_date:
-                if current_date.weekday() >= 5:  # Saturday = 5, Sunday = 6
-                    weekend_days += Decimal('1.00')
-                current_date += timedelta(days=1)
-            total_days -= weekend_days
-        
-        if not include_holidays and Holiday:
-            # Subtract holidays
-            try:
-                holidays = Holiday.objects.filter(
-                    holiday_date__gte=from_date,
-                    holiday_date__lte=to_date,
-                    organization=self.user_profile.organization
-                )
-                holiday_count = Decimal(str(holidays.count()))
-                total_days -= holiday_count
-            except:
-                pass
+        # Weekends are the employee's week-off policies; holidays are the organization's
+        week_offs = [] if include_weekends else list(self.user_profile.week_offs.filter(is_active=True))
+        total_days = Decimal(WorkCalendar.working_days(
+            from_date, to_date, week_offs,
+            organization=self.user_profile.organization_id,
+            count_week_offs=include_weekends,
+            count_holidays=include_holidays
+        ))
         
         return max(total_days, Decimal('0.00'))
     
@@ -100,6 +90,8 @@ class LeaveCalculator:
     
     def _get_applicable_policy(self):
         """Get applicable leave policy for employee"""
+        if LeavePolicy is None:
+            return None
         organization = self.user_profile.organization
         
         # Try employee-specific policy
@@ -209,14 +201,14 @@ class LeaveCalculator:
         balance = self.get_leave_balance()
         
         # Check if already accrued for this period
-        period_start, period_end = self._get_accrual_period(accrual_date)
+        period_start, period_end, period_key = LeaveAccrualEngine.accrual_period(
+            self.leave_type.accrual_frequency, accrual_date, self.start_month
+        )
         
         existing_log = LeaveAccrualLog.objects.filter(
             user=self.employee,
             leave_type=self.leave_type,
-            accrual_period_start=period_start,
-            accrual_period_end=period_end,
-            is_processed=True
+            period_key=period_key
         ).first()
         
         if existing_log:
@@ -225,12 +217,14 @@ class LeaveCalculator:
         # Calculate days to accrue
         days_to_accrue = self.leave_type.accrual_rate
         
-        # Create accrual log
+        # Credit through the ledger, then create accrual log
         balance_before = balance.accrued
+        LeaveLedger.record(balance.id, 'accrual', assigned=days_to_accrue, note=period_key)
         balance.accrued += days_to_accrue
-        balance.assigned += days_to_accrue
         balance.last_accrued_at = timezone.now()
-        balance.save()
+        EmployeeLeaveBalance.objects.filter(id=balance.id).update(
+            accrued=balance.accrued, last_accrued_at=balance.last_accrued_at
+        )
         
         accrual_log = LeaveAccrualLog.objects.create(
             user=self.employee,
@@ -239,6 +233,7 @@ class LeaveCalculator:
             accrual_date=accrual_date,
             accrual_period_start=period_start,
             accrual_period_end=period_end,
+            period_key=period_key,
             days_accrued=days_to_accrue,
             balance_before=balance_before,
             balance_after=balance.accrued,
@@ -248,87 +243,18 @@ class LeaveCalculator:
         
         return accrual_log
     
-    def _get_accrual_period(self, accrual_date):
-        """Get accrual period start and end dates"""
-        if self.leave_type.accrual_frequency == 'monthly':
-            period_start = accrual_date.replace(day=1)
-            if accrual_date.month == 12:
-                period_end = accrual_date.replace(day=31)
-            else:
-                next_month = accrual_date.replace(month=accrual_date.month + 1, day=1)
-                period_end = next_month - timedelta(days=1)
-        elif self.leave_type.accrual_frequency == 'quarterly':
-            quarter = (accrual_date.month - 1) // 3
-            period_start = date(accrual_date.year, quarter * 3 + 1, 1)
-            if quarter == 3:
-                period_end = date(accrual_date.year, 12, 31)
-            else:
-                next_quarter_start = date(accrual_date.year, (quarter + 1) * 3 + 1, 1)
-                period_end = next_quarter_start - timedelta(days=1)
-        else:  # yearly
-            period_start = date(accrual_date.year, 1, 1)
-            period_end = date(accrual_date.year, 12, 31)
-        
-        return period_start, period_end
-    
     def process_carry_forward(self, from_year, to_year):
         """Process carry forward from one year to next"""
-        if not self.leave_type.carry_forward_enabled:
-            return None
-        
-        from_balance = EmployeeLeaveBalance.objects.filter(
-            user=self.employee,
-            leave_type=self.leave_type,
-            year=from_year,
-            is_active=True
-        ).first()
-        
-        if not from_balance:
-            return None
-        
-        closing_balance = from_balance.closing_balance
-        max_carry_forward = self.leave_type.max_carry_forward or closing_balance
-        carry_forward_days = min(closing_balance, max_carry_forward)
-        
-        if carry_forward_days <= 0:
+        stats = LeaveRolloverEngine.rollover(
+            EmployeeLeaveBalance.objects.filter(user=self.employee, leave_type=self.leave_type, year=from_year),
+            to_year
+        )
+        if not stats['carried_forward']:
             return None
         
-        # Update from year balance
-        from_balance.carry_forward_to_next = carry_forward_days
-        from_balance.save()
-        
-        # Update or create to year balance
-        to_balance = EmployeeLeaveBalance.objects.filter(
-            user=self.employee,
-            leave_type=self.leave_type,
-            year=to_year,
-            is_active=True
-        ).first()
-        
-        if not to_balance:
-            admin = self.user_profile.admin
-            to_balance = EmployeeLeaveBalance.objects.create(
-                admin=admin,
-                user=self.employee,
-                leave_type=self.leave_type,
-                year=to_year,
-                assigned=self.leave_type.default_count,
-                opening_balance=self.leave_type.default_count
-            )
-        
-        to_balance.carry_forward_from_previous = carry_forward_days
-        to_balance.carried_forward = carry_forward_days
-        to_balance.assigned += carry_forward_days
-        
-        # Set expiry date
-        if self.leave_type.carry_forward_validity_months:
-            expiry_date = date(to_year, 1, 1) + timedelta(days=30 * self.leave_type.carry_forward_validity_months)
-            to_balance.carry_forward_expiry_date = expiry_date
-        
-        to_balance.save()
-        
         return {
-            'carried_forward': carry_forward_days,
+            'carried_forward': stats['carried_forward'],
+            'lapsed': stats['lapsed'],
             'from_year': from_year,
             'to_year': to_year
         }
@@ -0,0 +1,197 @@
+"""
+Leave balance ledger.
+
+Every change of a balance's assigned or used days is appended as a
+LeaveLedgerEntry, and in the same transaction the balance row is moved by
+the entry's deltas with F() expressions. The row therefore stays a
+materialized sum of its ledger: reading a balance is one row, however many
+applications the employee has, and concurrent changes never overwrite each
+other.
+
+Leave applications count against the balance of their leave year while
+pending or approved. application_changed() compares an application's usage
+before and after a change (create, approve, reject, cancel, date edit) and
+books the difference as usage entries; with require_available an increase
+is a conditional UPDATE that only matches while the balance covers it, so
+concurrent requests cannot overdraw it. reconcile() compares balance rows
+with the sums of their ledgers to detect drift from writes that bypassed
+the ledger.
+"""
+import logging
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .leave_year import LeaveYear
+from .models import EmployeeLeaveBalance, LeaveLedgerEntry
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+
+# Application statuses whose days count as used
+COUNTED_STATUSES = ('pending', 'approved')
+
+
+class InsufficientLeaveBalance(ValueError):
+    """The balance does not cover the days being drawn"""
+
+
+class LeaveLedger:
+
+    @staticmethod
+    def entry(balance, entry_type, assigned=ZERO, used=ZERO, application=None, note=''):
+        """Unsaved entry, for bulk writers that update the balance rows themselves"""
+        return LeaveLedgerEntry(
+            leave_balance=balance, entry_type=entry_type, assigned_delta=assigned, used_delta=used,
+            leave_application=application, note=note
+        )
+
+    @staticmethod
+    def record(balance_id, entry_type, assigned=ZERO, used=ZERO, application=None, note='', require_available=False):
+        """
+        Append one entry and move the balance by its deltas. With require_available, raises
+        InsufficientLeaveBalance (and writes nothing) unless assigned - used still covers `used`.
+        """
+        with transaction.atomic():
+            balances = EmployeeLeaveBalance.objects.filter(id=balance_id)
+            if require_available and used > 0:
+                balances = balances.filter(assigned__gte=F('used') + used - assigned)
+            if not balances.update(
+                assigned=F('assigned') + assigned, used=F('used') + used, updated_at=timezone.now()
+            ):
+                raise InsufficientLeaveBalance(f"Insufficient leave balance for {used} days")
+            LeaveLedgerEntry.objects.create(
+                leave_balance_id=balance_id, entry_type=entry_type, assigned_delta=assigned,
+                used_delta=used, leave_application=application, note=note
+            )
+
+    @staticmethod
+    def unledgered(balance_ids):
+        """The ids among balance_ids that have no ledger entry yet"""
+        if not balance_ids:
+            return set()
+        return set(balance_ids) - set(
+            LeaveLedgerEntry.objects.filter(leave_balance_id__in=balance_ids).values_list('leave_balance_id', flat=True)
+        )
+
+    @staticmethod
+    def open_balance(user, leave_type, year, assigned, note=''):
+        """Create a balance with an opening entry"""
+        with transaction.atomic():
+            balance = EmployeeLeaveBalance.objects.create(user=user, leave_type=leave_type, year=year, assigned=assigned)
+            LeaveLedgerEntry.objects.create(
+                leave_balance=balance, entry_type='opening', assigned_delta=assigned, note=note
+            )
+        return balance
+
+    @staticmethod
+    def application_usage(leave, start_month=None):
+        """((user id, leave type id, leave year), days) the application currently uses, or None"""
+        if leave.status not in COUNTED_STATUSES:
+            return None
+        if leave.leave_year is not None:
+            year = leave.leave_year
+        else:
+            if start_month is None:
+                start_month = LeaveYear.start_month(leave.organization_id)
+            year = LeaveYear.of(leave.from_date, start_month)
+        key = (leave.user_id, leave.leave_type_id, year)
+        return key, Decimal(str(leave.total_days))
+
+    @staticmethod
+    def application_changed(leave, previous=None, start_month=None, require_available=False):
+        """
+        Book the change of an application's usage; `previous` is application_usage() taken before
+        the change (None for a new application). With require_available, raises
+        InsufficientLeaveBalance when a balance does not cover an increase (or does not exist).
+        """
+        if start_month is None:
+            start_month = LeaveYear.start_month(leave.organization_id)
+        deltas = defaultdict(Decimal)
+        if previous:
+            deltas[previous[0]] -= previous[1]
+        current = LeaveLedger.application_usage(leave, start_month)
+        if current:
+            deltas[current[0]] += current[1]
+
+        for (user_id, leave_type_id, year), delta in deltas.items():
+            if not delta:
+                continue
+            balance_id = EmployeeLeaveBalance.objects.filter(
+                user_id=user_id, leave_type_id=leave_type_id, year=year
+            ).values_list('id', flat=True).first()
+            if balance_id is None:
+                if require_available and delta > 0:
+                    raise InsufficientLeaveBalance(f"Leave balance not found for year {year}")
+                logger.warning(f"No leave balance for user={user_id}, leave_type={leave_type_id}, year={year}: "
+                               f"usage {delta} of application {leave.id} not booked")
+                continue
+            LeaveLedger.record(
+                balance_id, 'usage', used=delta, application=leave, note=leave.status,
+                require_available=require_available
+            )
+
+    @staticmethod
+    def reconcile(organization=None, repair=False):
+        """
+        Compare balance rows with their ledger sums. Balances without entries (created before the
+        ledger) are 'unledgered'; with repair they get an opening entry of their current values,
+        and drifted rows are reset to their ledger sums.
+        """
+        chunk_size = getattr(settings, 'LEAVE_LEDGER_RECONCILE_CHUNK_SIZE', 5000)
+        balances = EmployeeLeaveBalance.objects.order_by('id')
+        if organization is not None:
+            balances = balances.filter(leave_type__admin__own_admin_profile__organization=organization)
+        stats = {"checked": 0, "unledgered": 0, "drifted": 0, "repaired": 0, "drift": []}
+
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                rows = list(
+                    balances.filter(id__gt=last_id).select_for_update(of=('self',))
+                    .values_list('id', 'assigned', 'used')[:chunk_size]
+                )
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                sums = {
+                    row['leave_balance_id']: row
+                    for row in LeaveLedgerEntry.objects.filter(leave_balance_id__in=[row[0] for row in rows])
+                    .values('leave_balance_id').annotate(assigned=Sum('assigned_delta'), used=Sum('used_delta'), entries=Count('id'))
+                }
+                openings = []
+                for balance_id, assigned, used in rows:
+                    stats["checked"] += 1
+                    ledger = sums.get(balance_id)
+                    if ledger is None:
+                        stats["unledgered"] += 1
+                        if repair:
+                            openings.append(LeaveLedgerEntry(
+                                leave_balance_id=balance_id, entry_type='opening', assigned_delta=assigned,
+                                used_delta=used, note='reconciliation'
+                            ))
+                        continue
+                    if ledger['assigned'] == assigned and ledger['used'] == used:
+                        continue
+                    stats["drifted"] += 1
+                    if len(stats["drift"]) < 100:
+                        stats["drift"].append({
+                            "balance_id": balance_id, "assigned": assigned, "used": used,
+                            "ledger_assigned": ledger['assigned'], "ledger_used": ledger['used'],
+                        })
+                    logger.warning(f"Leave balance {balance_id} drifted from its ledger: assigned {assigned} vs "
+                                   f"{ledger['assigned']}, used {used} vs {ledger['used']}")
+                    if repair:
+                        EmployeeLeaveBalance.objects.filter(id=balance_id).update(
+                            assigned=ledger['assigned'], used=ledger['used'], updated_at=timezone.now()
+                        )
+                        stats["repaired"] += 1
+                if openings:
+                    LeaveLedgerEntry.objects.bulk_create(openings)
+                    stats["repaired"] += len(openings)
+        return stats
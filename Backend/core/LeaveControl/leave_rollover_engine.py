@@ -0,0 +1,204 @@
+"""
+Set-based year-end leave rollover.
+
+Closing a leave year turns every balance's unused days (assigned - used)
+into a carry-forward, capped by the leave type's max_carry_forward and only
+for carry_forward_enabled types, and a lapse for the rest. The carry-forward
+is added to the next year's balance, which is bulk-created (default_count
+plus the carry-forward) where it does not exist yet. Opening and
+carry-forward amounts are booked as LeaveLedger entries.
+
+run() closes an organization's (or an admin's) balances in chunks of
+LEAVE_ROLLOVER_CHUNK_SIZE, each chunk in one transaction with a fixed number
+of queries. A closed balance gets rolled_over_at, and only balances without
+it are picked up, so an interrupted run resumes where it stopped and a
+repeated run changes nothing. report() computes the same figures without
+writing anything (the dry run).
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .leave_ledger import LeaveLedger
+from .models import LeaveType, EmployeeLeaveBalance, LeaveLedgerEntry
+
+ZERO = Decimal('0.00')
+
+
+class LeaveRolloverEngine:
+
+    @staticmethod
+    def leave_types(organization=None, admin=None):
+        """Active leave types of the organization's admins, or of one admin"""
+        leave_types = LeaveType.objects.filter(is_active=True)
+        if admin is not None:
+            return leave_types.filter(admin=admin)
+        return leave_types.filter(admin__own_admin_profile__organization=organization)
+
+    @staticmethod
+    def closing(assigned, used, leave_type):
+        """(carried forward, lapsed) days of a balance at year end"""
+        unused = max(assigned - used, ZERO)
+        carried = ZERO
+        if leave_type.carry_forward_enabled:
+            carried = unused if leave_type.max_carry_forward is None else min(unused, leave_type.max_carry_forward)
+        return carried, unused - carried
+
+    @staticmethod
+    def pending_balances(from_year, organization=None, admin=None):
+        """Balances of from_year not closed yet"""
+        return EmployeeLeaveBalance.objects.filter(
+            year=from_year, rolled_over_at__isnull=True,
+            leave_type__in=LeaveRolloverEngine.leave_types(organization, admin)
+        )
+
+    @staticmethod
+    def report(from_year, organization=None, admin=None):
+        """Dry run: per leave type, what run() would carry forward, lapse and create"""
+        leave_types = {leave_type.id: leave_type for leave_type in LeaveRolloverEngine.leave_types(organization, admin)}
+        rows = defaultdict(lambda: {
+            "balances": 0, "closing_balance": ZERO, "carried_forward": ZERO, "lapsed": ZERO, "balances_to_create": 0
+        })
+        next_year = EmployeeLeaveBalance.objects.filter(
+            user_id=OuterRef('user_id'), leave_type_id=OuterRef('leave_type_id'), year=from_year + 1
+        )
+        pending = EmployeeLeaveBalance.objects.filter(
+            year=from_year, rolled_over_at__isnull=True, leave_type_id__in=list(leave_types)
+        ).annotate(has_next_year=Exists(next_year)).values_list('leave_type_id', 'assigned', 'used', 'has_next_year')
+
+        for leave_type_id, assigned, used, has_next_year in pending.iterator(
+            chunk_size=getattr(settings, 'LEAVE_ROLLOVER_CHUNK_SIZE', 2000)
+        ):
+            carried, lapsed = LeaveRolloverEngine.closing(assigned, used, leave_types[leave_type_id])
+            row = rows[leave_type_id]
+            row["balances"] += 1
+            row["closing_balance"] += max(assigned - used, ZERO)
+            row["carried_forward"] += carried
+            row["lapsed"] += lapsed
+            row["balances_to_create"] += 0 if has_next_year else 1
+
+        already_closed = EmployeeLeaveBalance.objects.filter(
+            year=from_year, rolled_over_at__isnull=False, leave_type_id__in=list(leave_types)
+        ).count()
+        report = []
+        for leave_type_id, row in rows.items():
+            leave_type = leave_types[leave_type_id]
+            report.append({
+                "leave_type_id": leave_type.id,
+                "leave_type_code": leave_type.code,
+                "leave_type_name": leave_type.name,
+                "carry_forward_enabled": leave_type.carry_forward_enabled,
+                "max_carry_forward": leave_type.max_carry_forward,
+                **row,
+            })
+        report.sort(key=lambda row: row["leave_type_code"])
+        return {
+            "from_year": from_year,
+            "to_year": from_year + 1,
+            "already_rolled_over": already_closed,
+            "leave_types": report,
+            "totals": {
+                "balances": sum(row["balances"] for row in report),
+                "closing_balance": sum((row["closing_balance"] for row in report), ZERO),
+                "carried_forward": sum((row["carried_forward"] for row in report), ZERO),
+                "lapsed": sum((row["lapsed"] for row in report), ZERO),
+                "balances_to_create": sum(row["balances_to_create"] for row in report),
+            },
+        }
+
+    @staticmethod
+    def run(from_year, organization=None, admin=None):
+        """Close the pending balances of from_year chunk by chunk; returns counters of what was done"""
+        chunk_size = getattr(settings, 'LEAVE_ROLLOVER_CHUNK_SIZE', 2000)
+        pending = LeaveRolloverEngine.pending_balances(from_year, organization, admin).order_by('id')
+        stats = {"balances": 0, "carried_forward": ZERO, "lapsed": ZERO, "balances_created": 0}
+        last_id = 0
+        while True:
+            ids = list(pending.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            for key, value in LeaveRolloverEngine.rollover(
+                EmployeeLeaveBalance.objects.filter(id__in=ids), from_year + 1
+            ).items():
+                stats[key] += value
+        return stats
+
+    @staticmethod
+    def rollover(balances, to_year):
+        """Close `balances` (one chunk) into to_year inside a single transaction"""
+        now = timezone.now()
+        stats = {"balances": 0, "carried_forward": ZERO, "lapsed": ZERO, "balances_created": 0}
+        batch_size = getattr(settings, 'LEAVE_ROLLOVER_WRITE_BATCH_SIZE', 500)
+
+        with transaction.atomic():
+            # Re-checked under the lock: a concurrent run may have closed some of them meanwhile
+            closing = list(
+                balances.filter(rolled_over_at__isnull=True).select_for_update(of=('self',)).select_related('leave_type')
+            )
+            if not closing:
+                return stats
+            user_ids = {balance.user_id for balance in closing}
+            leave_type_ids = {balance.leave_type_id for balance in closing}
+
+            next_year = EmployeeLeaveBalance.objects.filter(
+                user_id__in=user_ids, leave_type_id__in=leave_type_ids, year=to_year
+            )
+            existing = set(next_year.values_list('user_id', 'leave_type_id'))
+            missing = []
+            for balance in closing:
+                key = (balance.user_id, balance.leave_type_id)
+                if key not in existing:
+                    existing.add(key)
+                    missing.append(EmployeeLeaveBalance(
+                        user_id=balance.user_id, leave_type=balance.leave_type, year=to_year,
+                        assigned=balance.leave_type.default_count
+                    ))
+            if missing:
+                # ignore_conflicts: a balance created concurrently (e.g. by accrual) is kept as it is
+                EmployeeLeaveBalance.objects.bulk_create(missing, ignore_conflicts=True, batch_size=batch_size)
+                stats["balances_created"] = len(missing)
+            opening = {
+                (balance.user_id, balance.leave_type_id): balance
+                for balance in next_year.select_for_update()
+            }
+
+            # Openings only for the rows inserted here: a balance a concurrent writer created
+            # (skipped by ignore_conflicts) already has its own opening entry
+            unledgered = LeaveLedger.unledgered(
+                [opening[(balance.user_id, balance.leave_type_id)].id for balance in missing]
+            )
+            entries = [
+                LeaveLedger.entry(opening[(balance.user_id, balance.leave_type_id)], 'opening', assigned=balance.assigned)
+                for balance in missing if opening[(balance.user_id, balance.leave_type_id)].id in unledgered
+            ]
+            opened = {}
+            for balance in closing:
+                carried, lapsed = LeaveRolloverEngine.closing(balance.assigned, balance.used, balance.leave_type)
+                balance.carried_to_next = carried
+                balance.lapsed = lapsed
+                balance.rolled_over_at = now
+                balance.updated_at = now
+                if carried:
+                    target = opening[(balance.user_id, balance.leave_type_id)]
+                    target.carried_forward += carried
+                    target.assigned += carried
+                    target.updated_at = now
+                    opened[target.id] = target
+                    entries.append(LeaveLedger.entry(target, 'carry_forward', assigned=carried, note=f"from {balance.year}"))
+                stats["balances"] += 1
+                stats["carried_forward"] += carried
+                stats["lapsed"] += lapsed
+
+            EmployeeLeaveBalance.objects.bulk_update(
+                closing, ['carried_to_next', 'lapsed', 'rolled_over_at', 'updated_at'], batch_size=batch_size
+            )
+            EmployeeLeaveBalance.objects.bulk_update(
+                list(opened.values()), ['carried_forward', 'assigned', 'updated_at'], batch_size=batch_size
+            )
+            LeaveLedgerEntry.objects.bulk_create(entries, batch_size=batch_size)
+        return stats
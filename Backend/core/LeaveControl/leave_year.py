@@ -0,0 +1,56 @@
+"""
+Leave year of an organization.
+
+OrganizationSettings.leave_year_type decides when a leave year starts:
+calendar years start in January, financial years in April and custom years
+in leave_year_start_month. Leave year N is the year starting in N (the
+financial year 2025 runs from 1 April 2025 to 31 March 2026), and a leave
+balance's year and a LeaveApplication's leave_year are the leave year their
+dates fall in, fixed when they are written.
+"""
+import calendar
+from datetime import date
+
+from AuthN.models import OrganizationSettings
+
+
+class LeaveYear:
+
+    @staticmethod
+    def start_month(organization_id):
+        """First month (1-12) of the organization's leave year"""
+        return LeaveYear._start_month(OrganizationSettings.objects.filter(organization_id=organization_id))
+
+    @staticmethod
+    def start_month_for(admin_id=None, user_id=None):
+        """start_month() of the organization of an admin or an employee, in one query"""
+        if admin_id:
+            rows = OrganizationSettings.objects.filter(organization__under_organization_profile__user_id=admin_id)
+        else:
+            rows = OrganizationSettings.objects.filter(organization__under_organization_profile_user__user_id=user_id)
+        return LeaveYear._start_month(rows)
+
+    @staticmethod
+    def _start_month(rows):
+        row = rows.values_list('leave_year_type', 'leave_year_start_month').first()
+        if not row:
+            return 1
+        leave_year_type, start_month = row
+        if leave_year_type == 'financial':
+            return 4
+        if leave_year_type == 'custom':
+            return start_month or 1
+        return 1
+
+    @staticmethod
+    def of(day, start_month=1):
+        """Leave year that `day` falls in"""
+        return day.year if day.month >= start_month else day.year - 1
+
+    @staticmethod
+    def date_range(year, start_month=1):
+        """(first day, last day) of leave year `year`"""
+        if start_month == 1:
+            return date(year, 1, 1), date(year, 12, 31)
+        end_month = start_month - 1
+        return date(year, start_month, 1), date(year + 1, end_month, calendar.monthrange(year + 1, end_month)[1])
@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, When
+from django.db.models.functions import ExtractYear
+
+from LeaveControl.leave_ledger import LeaveLedger
+from LeaveControl.leave_year import LeaveYear
+from LeaveControl.models import LeaveApplication
+
+
+class Command(BaseCommand):
+    help = ('Stamps LeaveApplication.leave_year on applications saved before the column existed, or '
+            'recomputes it for every application after an organization changed its leave year type')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization', help='Only this organization id')
+        parser.add_argument('--recompute', action='store_true',
+                            help='Recompute leave_year on all applications and move their booked usage to the new year')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Applications updated per statement')
+
+    def handle(self, *args, **options):
+        organization_ids = LeaveApplication.objects.values_list('organization_id', flat=True).order_by().distinct()
+        if options['organization']:
+            organization_ids = [options['organization']]
+
+        total = 0
+        for organization_id in organization_ids:
+            start_month = LeaveYear.start_month(organization_id)
+            if options['recompute']:
+                updated = self.recompute(organization_id, start_month, options['chunk_size'])
+            else:
+                updated = self.stamp(organization_id, start_month, options['chunk_size'])
+            if updated:
+                self.stdout.write(f'Organization {organization_id}: {updated} applications stamped')
+            total += updated
+
+        self.stdout.write(self.style.SUCCESS(f'Leave year stamped on {total} applications'))
+
+    def stamp(self, organization_id, start_month, chunk_size):
+        """Set leave_year where it is missing, chunk by chunk in SQL"""
+        # Leave year N starts on the 1st of start_month in N (see LeaveYear.of)
+        leave_year = Case(
+            When(from_date__month__gte=start_month, then=ExtractYear('from_date')),
+            default=ExtractYear('from_date') - 1
+        )
+        applications = LeaveApplication.objects.filter(
+            organization_id=organization_id, leave_year__isnull=True
+        ).order_by('id')
+
+        last_id = 0
+        updated = 0
+        while True:
+            ids = list(applications.filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            updated += LeaveApplication.objects.filter(id__in=ids).update(leave_year=leave_year)
+        return updated
+
+    def recompute(self, organization_id, start_month, chunk_size):
+        """
+        Re-stamp applications whose leave year moved. Pending and approved ones also move the usage
+        booked against the old year's balance to the new year's (LeaveLedger.application_changed).
+        """
+        applications = LeaveApplication.objects.filter(organization_id=organization_id).order_by('id')
+
+        last_id = 0
+        updated = 0
+        while True:
+            rows = list(applications.filter(id__gt=last_id).values_list('id', 'from_date', 'leave_year')[:chunk_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            moved = {
+                application_id: LeaveYear.of(from_date, start_month)
+                for application_id, from_date, leave_year in rows
+                if leave_year != LeaveYear.of(from_date, start_month)
+            }
+            if not moved:
+                continue
+
+            with transaction.atomic():
+                for leave in LeaveApplication.objects.select_for_update().filter(id__in=list(moved)):
+                    # Usage as booked, against the stored leave_year's balance
+                    previous = LeaveLedger.application_usage(leave, start_month)
+                    leave.leave_year = moved[leave.id]
+                    LeaveApplication.objects.filter(id=leave.id).update(leave_year=leave.leave_year)
+                    LeaveLedger.application_changed(leave, previous, start_month)
+            updated += len(moved)
+        return updated
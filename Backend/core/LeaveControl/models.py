@@ -6,11 +6,18 @@ from django.db import models
 from datetime import datetime
 from decimal import Decimal
 from AuthN.models import *
+from .leave_year import LeaveYear
 
 
 # ==================== LEAVE TYPE ====================
 class LeaveType(models.Model):
     """Leave Type Master"""
+    ACCRUAL_FREQUENCY_CHOICES = [
+        ('monthly', 'Monthly'),
+        ('quarterly', 'Quarterly'),
+        ('yearly', 'Yearly'),
+    ]
+    
     id = models.BigAutoField(primary_key=True)
     admin = models.ForeignKey(
         BaseUserModel, on_delete=models.CASCADE,
@@ -26,6 +33,15 @@ class LeaveType(models.Model):
     is_paid = models.BooleanField(default=True)
     is_active = models.BooleanField(default=True)
     
+    # Accrual Settings (credited by LeaveAccrualEngine on top of default_count)
+    accrual_enabled = models.BooleanField(default=False)
+    accrual_rate = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)  # Days credited per period
+    accrual_frequency = models.CharField(max_length=20, choices=ACCRUAL_FREQUENCY_CHOICES, default='monthly')
+    
+    # Year-end Settings (LeaveRolloverEngine): the unused balance is carried up to max_carry_forward, the rest lapses
+    carry_forward_enabled = models.BooleanField(default=False)
+    max_carry_forward = models.DecimalField(max_digits=5, decimal_places=2, blank=True, null=True)  # Empty = no limit
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
@@ -47,11 +63,19 @@ class EmployeeLeaveBalance(models.Model):
         related_name='leave_balances'
     )
     leave_type = models.ForeignKey(LeaveType, on_delete=models.CASCADE, related_name='employee_balances')
-    year = models.PositiveIntegerField()
+    year = models.PositiveIntegerField()  # Leave year (see LeaveYear): the year the organization's leave year starts in
     
     # Balance Details
     assigned = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)
     used = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)
+    accrued = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)  # Part of assigned credited by accrual
+    last_accrued_at = models.DateTimeField(blank=True, null=True)
+    
+    # Year-end rollover
+    carried_forward = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)  # Part of assigned brought from last year
+    carried_to_next = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)
+    lapsed = models.DecimalField(max_digits=5, decimal_places=2, default=0.00)
+    rolled_over_at = models.DateTimeField(blank=True, null=True)  # Set once this year's balance was closed
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -75,6 +99,44 @@ class EmployeeLeaveBalance(models.Model):
         return f"{self.user.email} - {self.leave_type.code} ({self.year}): {self.balance} days"
 
 
+# ==================== LEAVE ACCRUAL LOG ====================
+class LeaveAccrualLog(models.Model):
+    """One accrual credit - period_key (2026-10, 2026-Q4, 2026) makes a period accrue once per user and leave type"""
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(
+        BaseUserModel, on_delete=models.CASCADE,
+        limit_choices_to={'role': 'user'},
+        related_name='leave_accrual_logs'
+    )
+    leave_type = models.ForeignKey(LeaveType, on_delete=models.CASCADE, related_name='accrual_logs')
+    leave_balance = models.ForeignKey(EmployeeLeaveBalance, on_delete=models.CASCADE, related_name='accrual_logs')
+    
+    # Period
+    accrual_date = models.DateField()
+    accrual_period_start = models.DateField()
+    accrual_period_end = models.DateField()
+    period_key = models.CharField(max_length=10)
+    
+    # Credit
+    days_accrued = models.DecimalField(max_digits=5, decimal_places=2)
+    balance_before = models.DecimalField(max_digits=5, decimal_places=2)  # Accrued days before this credit
+    balance_after = models.DecimalField(max_digits=5, decimal_places=2)
+    
+    is_processed = models.BooleanField(default=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ('user', 'leave_type', 'period_key')
+        ordering = ['-accrual_date']
+        indexes = [
+            models.Index(fields=['leave_type', 'period_key']),
+        ]
+    
+    def __str__(self):
+        return f"{self.user.email} - {self.leave_type.code} ({self.period_key}): +{self.days_accrued} days"
+
+
 # ==================== LEAVE APPLICATION ====================
 class LeaveApplication(models.Model):
     """Leave Application"""
@@ -108,6 +170,7 @@ class LeaveApplication(models.Model):
     to_date = models.DateField()
     total_days = models.DecimalField(max_digits=5, decimal_places=2)
     reason = models.TextField()
+    leave_year = models.PositiveIntegerField(blank=True, null=True)  # Leave year of from_date, set on save
     
     # Status & Approval
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
@@ -125,7 +188,64 @@ class LeaveApplication(models.Model):
         indexes = [
             models.Index(fields=['user', 'status']),
             models.Index(fields=['from_date', 'to_date']),
+            models.Index(fields=['admin', 'leave_year', 'status']),
+            models.Index(fields=['admin', 'leave_year', '-applied_at', '-id']),
+            models.Index(fields=['user', 'leave_year', '-applied_at', '-id']),
         ]
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # What leave_year was computed from, so save() only looks the leave year up again when it moved
+        instance._leave_year_inputs = (instance.__dict__.get('organization_id'), instance.__dict__.get('from_date'))
+        return instance
+    
+    def save(self, *args, **kwargs):
+        # Year listings and balances are keyed by the organization's leave year, not the calendar year
+        inputs = (self.organization_id, self.from_date)
+        if self.from_date and (self.leave_year is None or inputs != getattr(self, '_leave_year_inputs', None)):
+            self.leave_year = LeaveYear.of(self.from_date, LeaveYear.start_month(self.organization_id))
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'leave_year'}
+        super().save(*args, **kwargs)
+        self._leave_year_inputs = inputs
+    
     def __str__(self):
         return f"{self.user.email} - {self.leave_type.code} ({self.from_date} to {self.to_date})"
+
+
+# ==================== LEAVE LEDGER ====================
+class LeaveLedgerEntry(models.Model):
+    """
+    Append-only history of a leave balance - every change of assigned/used is one entry, written in the
+    same transaction as the balance update, so the balance row always equals the sum of its entries
+    """
+    ENTRY_TYPE_CHOICES = [
+        ('opening', 'Opening Balance'),
+        ('accrual', 'Accrual'),
+        ('usage', 'Usage'),
+        ('adjustment', 'Adjustment'),
+        ('carry_forward', 'Carry Forward'),
+    ]
+    
+    id = models.BigAutoField(primary_key=True)
+    leave_balance = models.ForeignKey(EmployeeLeaveBalance, on_delete=models.CASCADE, related_name='ledger_entries')
+    entry_type = models.CharField(max_length=20, choices=ENTRY_TYPE_CHOICES)
+    assigned_delta = models.DecimalField(max_digits=6, decimal_places=2, default=0.00)
+    used_delta = models.DecimalField(max_digits=6, decimal_places=2, default=0.00)
+    leave_application = models.ForeignKey(
+        LeaveApplication, on_delete=models.SET_NULL,
+        null=True, blank=True,
+        related_name='ledger_entries'
+    )
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['leave_balance', 'entry_type']),
+        ]
+    
+    def __str__(self):
+        return f"{self.leave_balance_id} {self.entry_type}: assigned {self.assigned_delta:+}, used {self.used_delta:+}"
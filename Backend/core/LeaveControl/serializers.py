@@ -14,8 +14,9 @@ class LeaveTypeSerializer(serializers.ModelSerializer):
         model = LeaveType
         fields = [
             'id', 'admin', 'name', 'code', 'default_count', 
-            'is_paid', 'is_active', 'description', 'created_at', 'updated_at',
-            'admin_email'
+            'is_paid', 'is_active', 'description', 'accrual_enabled', 'accrual_rate',
+            'accrual_frequency', 'carry_forward_enabled', 'max_carry_forward',
+            'created_at', 'updated_at', 'admin_email'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
 
@@ -44,7 +45,10 @@ class EmployeeLeaveBalanceSerializer(serializers.ModelSerializer):
     class Meta:
         model = EmployeeLeaveBalance
         fields = '__all__'
-        read_only_fields = ['id', 'balance', 'created_at', 'updated_at']
+        read_only_fields = [
+            'id', 'balance', 'accrued', 'last_accrued_at', 'carried_forward', 'carried_to_next',
+            'lapsed', 'rolled_over_at', 'created_at', 'updated_at'
+        ]
 
 
 class EmployeeLeaveBalanceUpdateSerializer(serializers.ModelSerializer):
@@ -64,11 +68,11 @@ class LeaveApplicationSerializer(serializers.ModelSerializer):
     class Meta:
         model = LeaveApplication
         fields = '__all__'
-        read_only_fields = ['id', 'applied_at']
+        read_only_fields = ['id', 'leave_year', 'applied_at']
 
 
 class LeaveApplicationUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = LeaveApplication
         fields = '__all__'
-        read_only_fields = ['id', 'user', 'admin', 'organization', 'applied_at']
+        read_only_fields = ['id', 'user', 'admin', 'organization', 'leave_year', 'applied_at']
@@ -8,7 +8,8 @@ from .views import (
     LeaveTypeAPIView, 
     EmployeeLeaveBalanceAPIView, 
     AssignLeaveAPIView,
-    LeaveApplicationAPIView
+    LeaveApplicationAPIView,
+    LeaveCarryForwardReportAPIView
 )
 
 urlpatterns = [
@@ -26,6 +27,8 @@ urlpatterns = [
     path('leave-balances/<uuid:admin_id>/<uuid:user_id>', EmployeeLeaveBalanceAPIView.as_view(), name='admin-leave-balances-user'),
     path('leave-balances/<uuid:admin_id>/<uuid:user_id>/<int:pk>', EmployeeLeaveBalanceAPIView.as_view(), name='admin-leave-balance-detail'),
     
+    # ==================== YEAR-END CARRY FORWARD (Dry Run) ====================
+    path('leave-carry-forward/<uuid:admin_id>', LeaveCarryForwardReportAPIView.as_view(), name='leave-carry-forward-report'),
     
     # ==================== LEAVE APPLICATIONS ====================
     # Admin routes (view all employees)
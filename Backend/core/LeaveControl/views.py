@@ -1,14 +1,24 @@
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from datetime import datetime
+from decimal import Decimal
 from .models import LeaveType, EmployeeLeaveBalance, LeaveApplication
 from .serializers import (
     LeaveTypeSerializer, LeaveTypeUpdateSerializer,
     EmployeeLeaveBalanceSerializer, EmployeeLeaveBalanceUpdateSerializer,
     LeaveApplicationSerializer, LeaveApplicationUpdateSerializer
 )
+from .leave_ledger import LeaveLedger, InsufficientLeaveBalance
+from .leave_rollover_engine import LeaveRolloverEngine
+from .leave_year import LeaveYear
 from AuthN.models import AdminProfile, UserProfile
 
 
@@ -245,7 +255,6 @@ class EmployeeLeaveBalanceAPIView(APIView):
             }, status=status.HTTP_400_BAD_REQUEST)
         
         # Validation: assigned should be >= used (cannot reduce below used)
-        from decimal import Decimal
         used_value = Decimal(str(leave_balance.used))
         assigned_decimal = Decimal(str(assigned))
         
@@ -256,9 +265,13 @@ class EmployeeLeaveBalanceAPIView(APIView):
                 "data": None
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Update only assigned field
-        leave_balance.assigned = assigned
-        leave_balance.save()
+        # Update only assigned field (booked as an adjustment)
+        if assigned_decimal != leave_balance.assigned:
+            LeaveLedger.record(
+                leave_balance.id, 'adjustment', assigned=assigned_decimal - leave_balance.assigned,
+                note='assigned changed by admin'
+            )
+            leave_balance.refresh_from_db()
         
         serializer = EmployeeLeaveBalanceSerializer(leave_balance)
         return Response({
@@ -290,6 +303,31 @@ class EmployeeLeaveBalanceAPIView(APIView):
         })
 
 
+class LeaveCarryForwardReportAPIView(APIView):
+    """
+    Year-end carry-forward dry run - nothing is written
+    GET /leave-carry-forward/<admin_id>?year=2025 -> What closing the year would carry forward,
+    lapse and create, per leave type (year defaults to last year)
+    """
+    
+    def get(self, request, admin_id):
+        admin = get_object_or_404(AdminProfile, user_id=admin_id)
+        try:
+            year = int(request.GET.get('year') or datetime.now().year - 1)
+        except ValueError:
+            return Response({
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": "year must be a number",
+                "data": None
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        return Response({
+            "status": status.HTTP_200_OK,
+            "message": f"Carry-forward report for year {year} fetched successfully",
+            "data": LeaveRolloverEngine.report(year, admin=admin.user)
+        })
+
+
 class AssignLeaveAPIView(APIView):
     """
     Flexible Leave Assignment API - Single aur Bulk dono handle karta hai
@@ -431,12 +469,8 @@ class AssignLeaveAPIView(APIView):
             
             # Create new balance
             try:
-                balance = EmployeeLeaveBalance.objects.create(
-                    user=user,
-                    leave_type_id=leave_type_id,
-                    year=year,
-                    assigned=assigned,
-                    used=0
+                balance = LeaveLedger.open_balance(
+                    user, leave_type, year, Decimal(str(assigned)), note='assigned by admin'
                 )
                 created_balances.append({
                     "id": balance.id,
@@ -480,55 +514,39 @@ class LeaveApplicationAPIView(APIView):
     Supports both admin_id (all employees) and user_id (specific user)
     """
     
-    def get_year_date_range(self, organization_id, year):
+    @staticmethod
+    def encode_cursor(leave):
+        raw = json.dumps([leave.applied_at.isoformat(), str(leave.id)])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Raises ValueError for a malformed cursor"""
+        try:
+            applied_at, leave_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+            applied_at = datetime.fromisoformat(applied_at)
+            leave_id = int(leave_id)
+        except Exception:
+            raise ValueError("Invalid cursor")
+        return applied_at, leave_id
+
+    @staticmethod
+    def page(leaves, page_size, cursor=None):
         """
-        Calculate date range based on organization's leave year type
-        Returns: (start_date, end_date) tuple
+        Keyset page ordered by (-applied_at, -id), read off the (admin|user, leave_year, -applied_at, -id)
+        indexes. `cursor` is the previous response's next_cursor. Returns (leaves, next_cursor).
         """
-        from AuthN.models import OrganizationSettings, BaseUserModel
-        from datetime import date
-        
-        try:
-            org = BaseUserModel.objects.get(id=organization_id, role='organization')
-            org_settings = OrganizationSettings.objects.filter(organization=org).first()
-            
-            if not org_settings:
-                # Default to calendar year if no settings
-                return date(year, 1, 1), date(year, 12, 31)
-            
-            leave_year_type = org_settings.leave_year_type
-            start_month = org_settings.leave_year_start_month or 1
-            
-            if leave_year_type == 'calendar':
-                # Calendar Year: Jan 1 to Dec 31
-                start_date = date(year, 1, 1)
-                end_date = date(year, 12, 31)
-            elif leave_year_type == 'financial':
-                # Financial Year (India): Apr 1 to Mar 31 next year
-                # If year is 2025, it means Apr 1, 2025 to Mar 31, 2026
-                start_date = date(year, 4, 1)
-                end_date = date(year + 1, 3, 31)
-            elif leave_year_type == 'custom':
-                # Custom year based on start_month
-                start_date = date(year, start_month, 1)
-                # End date is last day of month before start_month next year
-                if start_month == 1:
-                    end_date = date(year, 12, 31)
-                else:
-                    import calendar
-                    end_month = start_month - 1
-                    end_year = year + 1
-                    last_day = calendar.monthrange(end_year, end_month)[1]
-                    end_date = date(end_year, end_month, last_day)
-            else:
-                # Default to calendar
-                start_date = date(year, 1, 1)
-                end_date = date(year, 12, 31)
-            
-            return start_date, end_date
-        except Exception as e:
-            # Fallback to calendar year
-            return date(year, 1, 1), date(year, 12, 31)
+        leaves = leaves.order_by('-applied_at', '-id')
+        if cursor:
+            applied_at, leave_id = LeaveApplicationAPIView.decode_cursor(cursor)
+            leaves = leaves.filter(Q(applied_at__lt=applied_at) | Q(applied_at=applied_at, id__lt=leave_id))
+
+        rows = list(leaves[:page_size + 1])
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = LeaveApplicationAPIView.encode_cursor(rows[-1])
+        return rows, next_cursor
 
     def get(self, request, admin_id=None, user_id=None, pk=None):
         """
@@ -536,7 +554,10 @@ class LeaveApplicationAPIView(APIView):
         GET /leave-applications/<admin_id>/<user_id>?year=2025 -> Specific employee's applications (year REQUIRED)
         GET /leave-applications/<admin_id>/<user_id>/<pk> -> Specific application (year not needed)
         
-        Year filtering respects organization's leave year type (calendar/financial/custom)
+        Year filtering respects organization's leave year type (calendar/financial/custom): `year` is the
+        leave year, matched against LeaveApplication.leave_year. Listings are returned newest first in pages
+        of `page_size` (default LEAVE_APPLICATION_PAGE_SIZE); pass the response's next_cursor as `cursor`
+        for the next page. Optional `status` filters by application status.
         """
         # Specific leave application by ID (no year needed)
         if pk:
@@ -576,89 +597,60 @@ class LeaveApplicationAPIView(APIView):
                 "data": None
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Get organization_id from admin or user
-        from AuthN.models import UserProfile
-        if admin_id:
-            admin_profile = UserProfile.objects.filter(user_id=admin_id).first()
-            if admin_profile:
-                org_id = admin_profile.organization_id
-            else:
-                org_id = None
-        elif user_id:
-            user_profile = UserProfile.objects.filter(user_id=user_id).first()
-            if user_profile:
-                org_id = user_profile.organization_id
-            else:
-                org_id = None
-        else:
-            org_id = None
-        
-        # Calculate date range based on organization's leave year type
-        if org_id:
-            start_date, end_date = self.get_year_date_range(org_id, year)
-            date_filter = {
-                'from_date__gte': start_date,
-                'from_date__lte': end_date
-            }
-        else:
-            # Fallback to calendar year if no org settings
-            from datetime import date
-            start_date = date(year, 1, 1)
-            end_date = date(year, 12, 31)
-            date_filter = {
-                'from_date__gte': start_date,
-                'from_date__lte': end_date
-            }
+        try:
+            page_size = int(request.GET.get('page_size', settings.LEAVE_APPLICATION_PAGE_SIZE))
+        except ValueError:
+            return Response({
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": "page_size must be an integer",
+                "data": None
+            }, status=status.HTTP_400_BAD_REQUEST)
+        page_size = min(max(page_size, 1), settings.LEAVE_APPLICATION_MAX_PAGE_SIZE)
         
-        # Admin viewing all employees' applications
+        # Admin viewing all employees' applications, or a specific user's applications
         if admin_id and not user_id:
-            from AuthN.models import UserProfile
-            admin_users = UserProfile.objects.filter(admin_id=admin_id).values_list('user_id', flat=True)
-            leaves = LeaveApplication.objects.filter(
-                user__id__in=admin_users,
-                **date_filter
-            ).select_related('user', 'leave_type', 'reviewed_by').order_by('-applied_at')
-            
-            serializer = LeaveApplicationSerializer(leaves, many=True)
-            
+            leaves = LeaveApplication.objects.filter(admin_id=admin_id, leave_year=year)
+            message = f"All employees leave applications for year {year}"
+        elif user_id:
+            leaves = LeaveApplication.objects.filter(user_id=user_id, leave_year=year)
+            message = f"Leave applications fetched successfully for year {year}"
+        else:
             return Response({
-                "status": status.HTTP_200_OK,
-                "message": f"All employees leave applications for year {year}",
-                "count": leaves.count(),
-                "year": year,
-                "date_range": {
-                    "start_date": start_date.isoformat(),
-                    "end_date": end_date.isoformat()
-                },
-                "data": serializer.data
-            })
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": "Invalid request",
+                "data": None
+            }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Specific user's applications
-        if user_id:
-            leaves = LeaveApplication.objects.filter(
-                user__id=user_id,
-                **date_filter
-            ).order_by('-applied_at')
-            
-            serializer = LeaveApplicationSerializer(leaves, many=True)
-            
+        status_param = request.GET.get('status')
+        if status_param:
+            leaves = leaves.filter(status=status_param)
+        
+        try:
+            rows, next_cursor = self.page(
+                leaves.select_related('user__own_user_profile', 'leave_type', 'reviewed_by'), page_size, cursor=request.GET.get('cursor')
+            )
+        except ValueError as e:
             return Response({
-                "status": status.HTTP_200_OK,
-                "message": f"Leave applications fetched successfully for year {year}",
-                "count": leaves.count(),
-                "year": year,
-                "date_range": {
-                    "start_date": start_date.isoformat(),
-                    "end_date": end_date.isoformat()
-                },
-                "data": serializer.data
-            })
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": str(e),
+                "data": None
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        start_date, end_date = LeaveYear.date_range(year, LeaveYear.start_month_for(admin_id=admin_id, user_id=user_id))
+        serializer = LeaveApplicationSerializer(rows, many=True)
         
         return Response({
-            "status": status.HTTP_400_BAD_REQUEST,
-            "message": "Invalid request",
-            "data": None
-        }, status=status.HTTP_400_BAD_REQUEST)
+            "status": status.HTTP_200_OK,
+            "message": message,
+            "count": leaves.count(),
+            "year": year,
+            "date_range": {
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat()
+            },
+            "next_cursor": next_cursor,
+            "data": serializer.data
+        })
 
     def post(self, request, admin_id=None, user_id=None, pk=None):
         """Create leave application"""
@@ -723,11 +715,12 @@ class LeaveApplicationAPIView(APIView):
                     }
                 }, status=status.HTTP_400_BAD_REQUEST)
 
-            # Validate and fetch leave balance
+            # Validate and fetch leave balance (of the organization's leave year)
+            start_month = LeaveYear.start_month(org_id_val)
             balance = EmployeeLeaveBalance.objects.filter(
                 user__id=target_user_id,
                 leave_type_id=data['leave_type'],
-                year=from_date_obj.year
+                year=LeaveYear.of(from_date_obj, start_month)
             ).first()
 
             if not balance:
@@ -746,16 +739,17 @@ class LeaveApplicationAPIView(APIView):
 
         serializer = LeaveApplicationSerializer(data=data)
         if serializer.is_valid():
-            leave_app = serializer.save()
-
-            # Sync balance based on all pending + approved leaves
-            if from_date and to_date:
-                from .balance_sync import sync_leave_balance
-                sync_leave_balance(
-                    user_id=target_user_id,
-                    leave_type_id=leave_app.leave_type.id,
-                    year=from_date_obj.year
-                )
+            try:
+                with transaction.atomic():
+                    leave_app = serializer.save()
+                    # Pending leave counts as used; the balance is drawn only if it still covers the days
+                    LeaveLedger.application_changed(leave_app, require_available=True)
+            except InsufficientLeaveBalance as e:
+                return Response({
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "message": str(e),
+                    "data": None
+                }, status=status.HTTP_400_BAD_REQUEST)
 
             return Response({
                 "status": status.HTTP_201_CREATED,
@@ -771,26 +765,27 @@ class LeaveApplicationAPIView(APIView):
 
     def put(self, request, admin_id=None, user_id=None, pk=None):
         """Update leave application - Handle status changes and balance updates"""
-        leave = get_object_or_404(LeaveApplication, id=pk)
-        old_status = leave.status
         new_status = request.data.get('status')
+        try:
+            with transaction.atomic():
+                # Locked, so concurrent status changes book their usage one after the other
+                leave = get_object_or_404(LeaveApplication.objects.select_for_update(), id=pk)
+                start_month = LeaveYear.start_month(leave.organization_id)
+                previous = LeaveLedger.application_usage(leave, start_month)
+                
+                serializer = LeaveApplicationUpdateSerializer(leave, data=request.data, partial=True)
+                if serializer.is_valid():
+                    serializer.save()
+                    # Book the change of used days (status, dates or leave type)
+                    LeaveLedger.application_changed(leave, previous, start_month, require_available=True)
+        except InsufficientLeaveBalance as e:
+            return Response({
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": str(e),
+                "data": None
+            }, status=status.HTTP_400_BAD_REQUEST)
         
-        print(f"🔄 PUT Leave: ID={pk}, Old Status={old_status}, New Status={new_status}")
-        
-        serializer = LeaveApplicationUpdateSerializer(leave, data=request.data, partial=True)
-        if serializer.is_valid():
-            serializer.save()
-            
-            # Sync balance based on all pending + approved leaves
-            if new_status and old_status != new_status:
-                print(f"📊 Status changed from {old_status} to {new_status}")
-                from .balance_sync import sync_leave_balance
-                sync_leave_balance(
-                    user_id=leave.user.id,
-                    leave_type_id=leave.leave_type.id,
-                    year=leave.from_date.year
-                )
-            
+        if not serializer.errors:
             return Response({
                 "status": status.HTTP_200_OK,
                 "message": f"Leave application {new_status or 'updated'} successfully",
@@ -804,33 +799,30 @@ class LeaveApplicationAPIView(APIView):
 
     def delete(self, request, admin_id=None, user_id=None, pk=None):
         """Cancel leave application - Only pending leaves can be cancelled"""
-        leave = get_object_or_404(LeaveApplication, id=pk)
-        
-        # Only pending leaves can be cancelled
-        if leave.status != 'pending':
-            return Response({
-                "status": status.HTTP_400_BAD_REQUEST,
-                "message": f"Cannot cancel {leave.status} leave. Only pending leaves can be cancelled.",
-                "data": {
-                    "current_status": leave.status,
-                    "from_date": leave.from_date,
-                    "to_date": leave.to_date
-                }
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Store info before cancelling
-        user_id = leave.user.id
-        leave_type_id = leave.leave_type.id
-        year = leave.from_date.year
-        total_days = leave.total_days
-        
-        # Mark as cancelled
-        leave.status = 'cancelled'
-        leave.save()
-        
-        # Sync balance based on all pending + approved leaves
-        from .balance_sync import sync_leave_balance
-        sync_leave_balance(user_id, leave_type_id, year)
+        with transaction.atomic():
+            # Locked, so a concurrent cancel or review sees this one's status
+            leave = get_object_or_404(LeaveApplication.objects.select_for_update(), id=pk)
+            
+            # Only pending leaves can be cancelled
+            if leave.status != 'pending':
+                return Response({
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "message": f"Cannot cancel {leave.status} leave. Only pending leaves can be cancelled.",
+                    "data": {
+                        "current_status": leave.status,
+                        "from_date": leave.from_date,
+                        "to_date": leave.to_date
+                    }
+                }, status=status.HTTP_400_BAD_REQUEST)
+            
+            # Store info before cancelling
+            total_days = leave.total_days
+            previous = LeaveLedger.application_usage(leave)
+            
+            # Mark as cancelled and restore the balance
+            leave.status = 'cancelled'
+            leave.save()
+            LeaveLedger.application_changed(leave, previous)
         
         return Response({
             "status": status.HTTP_200_OK,
@@ -13,11 +13,13 @@ from datetime import date
 from decimal import Decimal
 import openpyxl
 from io import BytesIO
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
 
 from .models import PayrollRecord, SalaryComponent, PayrollComponentEntry
 from .serializers import PayrollRecordSerializer
 from .payroll_excel_service import PayrollExcelService
+from .payroll_record_writer import PayrollRecordWriter
+from .payslip_service import PayslipService
 from AuthN.models import BaseUserModel, UserProfile
 from utils.pagination_utils import CustomPagination
 
@@ -49,54 +51,18 @@ class UpdatePayrollReportView(APIView):
             )
             
             # Recalculate payroll
-            user_profile = employee.own_user_profile
+            user_profile = UserProfile.objects.select_related('user', 'admin', 'organization').get(user=employee)
             calculator = PayrollCalculator(employee, month, year, user_profile.admin, organization)
             payroll_data = calculator.calculate_payroll()
             
-            # Update payroll record
-            payroll.basic_salary = payroll_data['earnings'].get('BASIC', {}).get('amount', 0)
-            payroll.hra = payroll_data['earnings'].get('HRA', {}).get('amount', 0)
-            payroll.special_allowance = payroll_data['earnings'].get('SPECIAL_ALLOWANCE', {}).get('amount', 0)
-            payroll.overtime_amount = payroll_data['earnings'].get('OVERTIME', {}).get('amount', 0)
-            payroll.gross_salary = payroll_data['gross_salary']
-            payroll.pf_employee = payroll_data['deductions'].get('PF_EMPLOYEE', {}).get('amount', 0)
-            payroll.esi_employee = payroll_data['deductions'].get('ESI_EMPLOYEE', {}).get('amount', 0)
-            payroll.professional_tax = payroll_data['deductions'].get('PROFESSIONAL_TAX', {}).get('amount', 0)
-            payroll.tds = payroll_data['deductions'].get('TDS', {}).get('amount', 0)
-            payroll.advance_deduction = payroll_data['deductions'].get('ADVANCE', {}).get('amount', 0)
-            payroll.loan_deduction = payroll_data['deductions'].get('LOAN', {}).get('amount', 0)
-            payroll.total_deductions = payroll_data['total_deductions']
-            payroll.net_salary = payroll_data['net_salary']
-            payroll.earnings_breakdown = payroll_data['earnings']
-            payroll.deductions_breakdown = payroll_data['deductions']
-            payroll.save()
-            
-            # Update component entries
-            PayrollComponentEntry.objects.filter(payroll=payroll).delete()
-            
-            for code, comp_data in payroll_data['earnings'].items():
-                try:
-                    component = SalaryComponent.objects.get(code=code, organization=organization)
-                    PayrollComponentEntry.objects.create(
-                        payroll=payroll,
-                        component=component,
-                        amount=comp_data['amount'],
-                        is_earning=True
-                    )
-                except SalaryComponent.DoesNotExist:
-                    pass
+            # Update the record in place and replace its component entries
+            writer = PayrollRecordWriter(organization, month, year, upsert=True)
+            writer.existing_employee_ids([employee.id])
+            writer.save(user_profile, payroll_data)
             
-            for code, comp_data in payroll_data['deductions'].items():
-                try:
-                    component = SalaryComponent.objects.get(code=code, organization=organization)
-                    PayrollComponentEntry.objects.create(
-                        payroll=payroll,
-                        component=component,
-                        amount=comp_data['amount'],
-                        is_earning=False
-                    )
-                except SalaryComponent.DoesNotExist:
-                    pass
+            payroll = PayrollRecord.objects.select_related(
+                'employee__own_user_profile', 'admin', 'organization'
+            ).prefetch_related('component_entries__component').get(id=payroll.id)
             
             serializer = PayrollRecordSerializer(payroll)
             return Response({
@@ -188,52 +154,37 @@ class BIPayrollReportView(APIView):
 # ==================== PAYROLL DOWNLOAD INFO ====================
 
 class PayrollDownloadInfo(APIView):
-    """Get payroll download information for Excel export"""
+    """
+    Get payroll download information for Excel export. With ?export_format=xlsx|csv|ndjson
+    the month's register is streamed as a file instead of returned as JSON.
+    """
     permission_classes = [IsAuthenticated]
     
     def get(self, request, org_id, month, year):
         """Get payroll data formatted for download"""
         try:
             organization = get_object_or_404(BaseUserModel, id=org_id, role='organization')
+            file_format = request.query_params.get('export_format')
+            if file_format and file_format not in PayrollExcelService.CONTENT_TYPES:
+                return Response({
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "message": "export_format must be 'xlsx', 'csv' or 'ndjson'",
+                    "data": []
+                }, status=status.HTTP_400_BAD_REQUEST)
             
             payrolls = PayrollRecord.objects.filter(
                 organization=organization,
                 payroll_month=month,
                 payroll_year=year
-            ).select_related('employee', 'admin')
+            )
             
-            download_data = []
-            for payroll in payrolls:
-                try:
-                    user_profile = payroll.employee.own_user_profile
-                    download_data.append({
-                        'employee_id': user_profile.custom_employee_id,
-                        'employee_name': user_profile.user_name,
-                        'email': payroll.employee.email,
-                        'basic_salary': float(payroll.basic_salary),
-                        'hra': float(payroll.hra),
-                        'special_allowance': float(payroll.special_allowance),
-                        'overtime': float(payroll.overtime_amount),
-                        'gross_salary': float(payroll.gross_salary),
-                        'pf_employee': float(payroll.pf_employee),
-                        'esi_employee': float(payroll.esi_employee),
-                        'professional_tax': float(payroll.professional_tax),
-                        'tds': float(payroll.tds),
-                        'advance': float(payroll.advance_deduction),
-                        'loan': float(payroll.loan_deduction),
-                        'total_deductions': float(payroll.total_deductions),
-                        'net_salary': float(payroll.net_salary),
-                        'present_days': payroll.present_days,
-                        'absent_days': payroll.absent_days,
-                        'working_days': payroll.working_days
-                    })
-                except:
-                    continue
+            if file_format:
+                return PayrollExcelService.register_response(payrolls, f"payroll_{month}_{year}", file_format)
             
             return Response({
                 "status": status.HTTP_200_OK,
                 "message": "Download info fetched successfully",
-                "data": download_data
+                "data": list(PayrollExcelService.register_rows(payrolls))
             })
             
         except Exception as e:
@@ -598,3 +549,67 @@ class EmployeePayslipAPI(APIView):
                 "data": []
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+
+class EmployeePayslipPDFAPI(APIView):
+    """
+    One employee's payslip as a PDF (rendered once per record content, then served from cache).
+    Names outside the cp1252 character set print as '?' (see payslip_pdf).
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, admin_id, uniqueID, month, year):
+        try:
+            admin = get_object_or_404(BaseUserModel, id=admin_id, role='admin')
+            payroll = PayslipService.records(
+                employee__own_user_profile__custom_employee_id=uniqueID,
+                admin=admin,
+                payroll_month=month,
+                payroll_year=year
+            ).first()
+            
+            if not payroll:
+                return Response({
+                    "status": status.HTTP_404_NOT_FOUND,
+                    "message": "Payroll not found",
+                    "data": []
+                }, status=status.HTTP_404_NOT_FOUND)
+            
+            return FileResponse(
+                open(PayslipService.pdf_path(payroll), 'rb'),
+                as_attachment=True,
+                filename=PayslipService.file_name(payroll),
+                content_type='application/pdf'
+            )
+            
+        except Exception as e:
+            return Response({
+                "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                "message": str(e),
+                "data": []
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class EmployeePayslipZipAPI(APIView):
+    """Streaming ZIP of the payslip PDFs of an admin's whole team for a month"""
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, admin_id, month, year):
+        try:
+            admin = get_object_or_404(BaseUserModel, id=admin_id, role='admin')
+            if not PayrollRecord.objects.filter(admin=admin, payroll_month=month, payroll_year=year).exists():
+                return Response({
+                    "status": status.HTTP_404_NOT_FOUND,
+                    "message": "Payroll not found",
+                    "data": []
+                }, status=status.HTTP_404_NOT_FOUND)
+            
+            response = StreamingHttpResponse(PayslipService.team_zip(admin, month, year), content_type='application/zip')
+            response['Content-Disposition'] = f'attachment; filename="payslips_{year}_{month:02d}.zip"'
+            return response
+            
+        except Exception as e:
+            return Response({
+                "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                "message": str(e),
+                "data": []
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -9,11 +9,11 @@ from django.utils import timezone
 from django.db.models import Q
 from calendar import monthrange
 
-from WorkLog.models import Attendance
+from WorkLog.models import Attendance, DailyAttendanceSummary
 from LeaveControl.models import LeaveApplication, LeaveType
 from ServiceShift.models import ServiceShift
 from ServiceWeekOff.models import WeekOffPolicy
-from Holiday.models import Holiday
+from Holiday.work_calendar import WorkCalendar
 from AuthN.models import BaseUserModel, UserProfile
 
 
@@ -28,9 +28,10 @@ class AttendanceCalculationService:
         self.admin = admin
         self.user_profile = None
         self.week_off_policies = []
-        self.holidays = []
+        self.calendar = None
         self.leave_applications = []
         self.attendance_records = []
+        self._attendance_by_date = {}
         
         # Initialize data
         self._load_employee_data()
@@ -58,33 +59,12 @@ class AttendanceCalculationService:
         elif self.organization:
             # Fallback to organization's week-off policies
             self.week_off_policies = list(
-                WeekOffPolicy.objects.filter(organization=self.organization, is_active=True)
+                WeekOffPolicy.objects.filter(admin__own_admin_profile__organization=self.organization, is_active=True)
             )
     
     def _load_holidays(self):
-        """Load holidays for the month"""
-        start_date = date(self.year, self.month, 1)
-        _, last_day = monthrange(self.year, self.month)
-        end_date = date(self.year, self.month, last_day)
-        
-        if self.admin:
-            self.holidays = list(
-                Holiday.objects.filter(
-                    admin=self.admin,
-                    holiday_date__gte=start_date,
-                    holiday_date__lte=end_date,
-                    is_active=True
-                )
-            )
-        elif self.organization:
-            self.holidays = list(
-                Holiday.objects.filter(
-                    organization=self.organization,
-                    holiday_date__gte=start_date,
-                    holiday_date__lte=end_date,
-                    is_active=True
-                )
-            )
+        """Load the year's compiled holiday/week-off calendar (shared, cached per admin or organization)"""
+        self.calendar = WorkCalendar.calendar(self.year, admin=self.admin, organization=self.organization)
     
     def _load_leave_applications(self):
         """Load approved leave applications for the month"""
@@ -102,50 +82,36 @@ class AttendanceCalculationService:
         )
     
     def _load_attendance_records(self):
-        """Load attendance records for the month"""
+        """Load the month's daily attendance rollup (one row per day, multi-punch days merged)"""
         self.attendance_records = list(
-            Attendance.objects.filter(
+            DailyAttendanceSummary.objects.filter(
                 user=self.employee,
                 attendance_date__year=self.year,
                 attendance_date__month=self.month
             ).select_related('assign_shift')
         )
+        self._attendance_by_date = {att.attendance_date: att for att in self.attendance_records}
     
     def _is_week_off(self, check_date):
         """Check if a date is a week-off based on employee's week-off policies"""
-        if not self.week_off_policies:
-            return False
-        
-        weekday_name = check_date.strftime('%A')  # Monday, Tuesday, etc.
-        
-        for policy in self.week_off_policies:
-            week_days = policy.week_days if isinstance(policy.week_days, list) else []
-            
-            if weekday_name in week_days:
-                # Check week-off cycle if applicable
-                if policy.week_off_cycle:
-                    week_number = (check_date.day - 1) // 7 + 1
-                    if week_number in policy.week_off_cycle:
-                        return True
-                else:
-                    return True
-        
-        return False
+        return self.calendar.is_week_off(check_date, self.week_off_policies)
     
     def _is_holiday(self, check_date):
         """Check if a date is a holiday"""
-        return any(holiday.holiday_date == check_date for holiday in self.holidays)
+        return self.calendar.is_holiday(check_date)
     
     def _get_leave_for_date(self, check_date):
         """Get leave application for a specific date"""
         for leave in self.leave_applications:
             if leave.from_date <= check_date <= leave.to_date:
+                # LeaveApplication has no duration_type yet: every leave counts as full days
+                duration_type = getattr(leave, 'duration_type', 'full_day')
                 # Check if it's a half-day
-                if leave.duration_type == 'half_day':
+                if duration_type == 'half_day':
                     # For half-day, check if it's first or second half
                     # This is simplified - can be enhanced based on from_time/to_time
                     return leave, 0.5
-                elif leave.duration_type == 'short_leave':
+                elif duration_type == 'short_leave':
                     # Short leave is typically 2-4 hours, count as 0.25 day
                     return leave, 0.25
                 else:
@@ -155,34 +121,30 @@ class AttendanceCalculationService:
     def _is_comp_off_leave(self, leave):
         """Check if leave is compensatory off (should not be counted in payroll)"""
         if leave and leave.leave_type:
-            return leave.leave_type.category == 'compensatory'
+            # LeaveType has no category yet, so no leave is treated as comp-off
+            return getattr(leave.leave_type, 'category', None) == 'compensatory'
         return False
     
     def _is_lop_leave(self, leave):
         """Check if leave is Loss of Pay (LOP)"""
         if leave and leave.leave_type:
-            return leave.leave_type.category == 'lwp' or not leave.leave_type.is_paid
+            return getattr(leave.leave_type, 'category', None) == 'lwp' or not leave.leave_type.is_paid
         return False
     
     def _get_attendance_for_date(self, check_date):
         """Get attendance record for a specific date"""
-        for att in self.attendance_records:
-            if att.attendance_date == check_date:
-                return att
-        return None
+        return self._attendance_by_date.get(check_date)
     
     def _calculate_sandwich_days(self, start_date, end_date):
         """Calculate sandwich days (week-offs/holidays between two leave/absent days)"""
         sandwich_days = []
-        current_date = start_date + timedelta(days=1)
-        
-        while current_date < end_date:
-            if self._is_week_off(current_date) or self._is_holiday(current_date):
-                # Check if there's attendance for this day
-                att = self._get_attendance_for_date(current_date)
-                if not att or att.attendance_status != 'present':
-                    sandwich_days.append(current_date)
-            current_date += timedelta(days=1)
+        for current_date in self.calendar.off_days(
+            start_date + timedelta(days=1), end_date - timedelta(days=1), self.week_off_policies
+        ):
+            # Check if there's attendance for this day
+            att = self._get_attendance_for_date(current_date)
+            if not att or att.attendance_status != 'present':
+                sandwich_days.append(current_date)
         
         return sandwich_days
     
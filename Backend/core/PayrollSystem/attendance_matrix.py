@@ -0,0 +1,273 @@
+"""
+Vectorized attendance-to-payable-days calculation for a whole PayrollBatch.
+
+AttendanceCalculationService walks every calendar day of every employee and
+scans the holiday, leave and attendance lists for each one. AttendanceMatrix
+lays the month out as (employees x days) NumPy arrays instead: in-service,
+week-off, holiday, leave (units and kind) and attendance (present, late,
+early exit, minutes) are filled once, and every counter of
+calculate_detailed_attendance() is a masked sum over a row.
+
+The results are the same as the per-day service (checked by
+attendance_matrix_benchmark.py on a golden set that exercises every branch);
+only the per-day breakdown is opt-in, since payroll records store the
+counters alone. numpy is optional: without it NUMPY_AVAILABLE is False and
+PayrollBatch keeps using the per-day service.
+"""
+from calendar import monthrange
+from datetime import date, timedelta
+from decimal import Decimal
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+# Leave kinds in the `leave_kind` matrix
+NO_LEAVE, PAID_LEAVE, LOP_LEAVE, COMP_OFF_LEAVE = 0, 1, 2, 3
+
+
+class AttendanceMatrix:
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.start_date = date(batch.year, batch.month, 1)
+        self.days = monthrange(batch.year, batch.month)[1]
+        self.dates = [self.start_date + timedelta(days=day) for day in range(self.days)]
+        self.rows = {profile.user_id: row for row, profile in enumerate(batch.profiles)}
+        self._leaves = []  # [[LeaveApplication]] per row, indexed by `leave_index`
+
+        shape = (len(batch.profiles), self.days)
+        self.in_service = self._in_service_mask(batch.profiles)
+        self.week_off = self._week_off_mask(batch.profiles)
+        self.holiday = np.zeros(self.days, dtype=bool)
+        for holiday in batch.holidays:
+            if self.start_date <= holiday.holiday_date <= self.dates[-1]:
+                self.holiday[(holiday.holiday_date - self.start_date).days] = True
+
+        self.leave_index = np.full(shape, -1, dtype=np.int16)
+        self.leave_units = np.zeros(shape, dtype=np.float64)
+        self.leave_kind = np.zeros(shape, dtype=np.int8)
+        self._fill_leaves(batch)
+
+        self.has_attendance = np.zeros(shape, dtype=bool)
+        self.present = np.zeros(shape, dtype=bool)
+        self.is_late = np.zeros(shape, dtype=bool)
+        self.late_minutes = np.zeros(shape, dtype=np.int64)
+        self.is_early_exit = np.zeros(shape, dtype=bool)
+        self.early_exit_minutes = np.zeros(shape, dtype=np.int64)
+        self.working_minutes = np.zeros(shape, dtype=np.int64)
+        self.overtime_minutes = np.zeros(shape, dtype=np.int64)
+        self._fill_attendance(batch)
+
+        self._calculate()
+
+    def _in_service_mask(self, profiles):
+        """Days on or after the joining date"""
+        joining_day = np.array([
+            min(max((profile.date_of_joining - self.start_date).days, 0), self.days)
+            if profile.date_of_joining else 0
+            for profile in profiles
+        ], dtype=np.int64).reshape(-1, 1)
+        return np.arange(self.days) >= joining_day
+
+    def _week_off_mask(self, profiles):
+        """Same rules as AttendanceCalculationService._is_week_off, computed once per distinct policy set"""
+        weekday_names = [day.strftime('%A') for day in self.dates]
+        week_numbers = [(day.day - 1) // 7 + 1 for day in self.dates]
+
+        masks = {}
+        mask_rows = []
+        for profile in profiles:
+            policies = profile.active_week_offs
+            key = tuple(policy.pk for policy in policies)
+            if key not in masks:
+                mask = np.zeros(self.days, dtype=bool)
+                for policy in policies:
+                    week_days = policy.week_days if isinstance(policy.week_days, list) else []
+                    for day in range(self.days):
+                        if weekday_names[day] in week_days and (
+                            not policy.week_off_cycle or week_numbers[day] in policy.week_off_cycle
+                        ):
+                            mask[day] = True
+                masks[key] = mask
+            mask_rows.append(masks[key])
+        return np.array(mask_rows, dtype=bool).reshape(len(profiles), self.days)
+
+    @staticmethod
+    def _leave_kind(leave_type):
+        """Same rules as AttendanceCalculationService._is_comp_off_leave / _is_lop_leave"""
+        category = getattr(leave_type, 'category', None)
+        if leave_type and category == 'compensatory':
+            return COMP_OFF_LEAVE
+        if leave_type and (category == 'lwp' or not leave_type.is_paid):
+            return LOP_LEAVE
+        return PAID_LEAVE
+
+    def _fill_leaves(self, batch):
+        kinds = {}  # {leave_type_id: kind}
+        for user_id, row in self.rows.items():
+            leaves = batch.leaves.get(user_id, [])
+            self._leaves.append(leaves)
+            # The first leave covering a day wins, as in _get_leave_for_date
+            for index, leave in enumerate(leaves):
+                first = max((leave.from_date - self.start_date).days, 0)
+                last = min((leave.to_date - self.start_date).days, self.days - 1)
+                if first > last:
+                    continue
+                free = self.leave_index[row, first:last + 1] < 0
+                duration_type = getattr(leave, 'duration_type', 'full_day')
+                if duration_type == 'half_day':
+                    units = 0.5
+                elif duration_type == 'short_leave':
+                    units = 0.25
+                else:
+                    units = 1.0
+                kind = kinds.get(leave.leave_type_id)
+                if kind is None:
+                    kind = kinds[leave.leave_type_id] = self._leave_kind(leave.leave_type)
+                self.leave_index[row, first:last + 1][free] = index
+                self.leave_units[row, first:last + 1][free] = units
+                self.leave_kind[row, first:last + 1][free] = kind
+
+    def _fill_attendance(self, batch):
+        days_by_row = [batch.attendance.get(user_id, {}) for user_id in self.rows]
+        values = [day for days in days_by_row for day in days.values()]
+        if not values:
+            return
+
+        rows = np.repeat(np.arange(len(days_by_row)), [len(days) for days in days_by_row])
+        days = np.array([day.attendance_date.toordinal() for day in values]) - self.start_date.toordinal()
+
+        self.has_attendance[rows, days] = True
+        self.present[rows, days] = [day.attendance_status == 'present' for day in values]
+        self.is_late[rows, days] = [bool(day.is_late) for day in values]
+        self.late_minutes[rows, days] = [day.late_minutes or 0 for day in values]
+        self.is_early_exit[rows, days] = [bool(day.is_early_exit) for day in values]
+        self.early_exit_minutes[rows, days] = [day.early_exit_minutes or 0 for day in values]
+        worked = np.array([day.total_working_minutes or 0 for day in values], dtype=np.int64)
+        self.working_minutes[rows, days] = worked
+        shift_minutes = np.array([
+            (day.assign_shift.duration_minutes or 0) if day.assign_shift else 0 for day in values
+        ], dtype=np.int64)
+        self.overtime_minutes[rows, days] = np.where(
+            (shift_minutes > 0) & (worked > shift_minutes), worked - shift_minutes, 0
+        )
+
+    def _calculate(self):
+        in_service = self.in_service
+        week_off = in_service & self.week_off
+        holiday = in_service & ~self.week_off & self.holiday
+        regular = in_service & ~self.week_off & ~self.holiday
+        present = self.present
+        has_leave = regular & (self.leave_index >= 0)
+        paid_leave = has_leave & (self.leave_kind == PAID_LEAVE)
+        lop_leave = has_leave & (self.leave_kind == LOP_LEAVE)
+        comp_off = has_leave & (self.leave_kind == COMP_OFF_LEAVE)
+
+        worked_day = in_service & present
+        # Late / early exit are counted on worked week-offs and regular days, not on holidays
+        counted_punctuality = worked_day & ~holiday
+        absent = regular & ((self.has_attendance & ~present) | (~self.has_attendance & ~has_leave))
+        overtime = regular & present & (self.overtime_minutes > 0)
+
+        # An absent week-off/holiday between two absent days (none with the current rules)
+        sandwich = np.zeros_like(absent)
+        sandwich[:, 1:-1] = (
+            absent[:, 1:-1] & absent[:, :-2] & absent[:, 2:] & (week_off | holiday)[:, 1:-1]
+        )
+
+        self.day_flags = {
+            'week_off': week_off, 'holiday': holiday, 'absent': absent,
+            'sandwich': sandwich, 'counted_punctuality': counted_punctuality, 'overtime': overtime
+        }
+        late = counted_punctuality & self.is_late
+        early_exit = counted_punctuality & self.is_early_exit
+        self.totals = {
+            'working_days': regular.sum(axis=1) + ((week_off | holiday) & present).sum(axis=1),
+            'present_days': worked_day.sum(axis=1) + comp_off.sum(axis=1),
+            'absent_days': absent.sum(axis=1),
+            'leave_days': np.where(has_leave, self.leave_units, 0).sum(axis=1),
+            'lop_days': np.where(lop_leave, self.leave_units, 0).sum(axis=1),
+            'half_day_leaves': (paid_leave & (self.leave_units == 0.5)).sum(axis=1) * 0.5,
+            'week_off_days': week_off.sum(axis=1),
+            'holiday_days': holiday.sum(axis=1),
+            'sandwich_absent_days': sandwich.sum(axis=1),
+            'payable_days': worked_day.sum(axis=1) + np.where(paid_leave | comp_off, self.leave_units, 0).sum(axis=1),
+            'late_days': late.sum(axis=1),
+            'early_exit_days': early_exit.sum(axis=1),
+            'total_late_minutes': np.where(late, self.late_minutes, 0).sum(axis=1),
+            'total_early_exit_minutes': np.where(early_exit, self.early_exit_minutes, 0).sum(axis=1),
+        }
+
+    def _overtime_hours(self, row):
+        # Summed day by day in Decimal like the per-day service, so the rounding matches exactly
+        total = Decimal('0.00')
+        for day in np.flatnonzero(self.day_flags['overtime'][row]):
+            total += Decimal(str(int(self.overtime_minutes[row, day]))) / Decimal('60')
+        return total
+
+    def detailed_attendance(self, user_id, day_wise=False):
+        """calculate_detailed_attendance() result for one employee of the batch"""
+        row = self.rows[user_id]
+        totals = {key: values[row] for key, values in self.totals.items()}
+        return {
+            'total_calendar_days': self.days,
+            'working_days': int(totals['working_days']),
+            'present_days': int(totals['present_days']),
+            'absent_days': int(totals['absent_days']),
+            'leave_days': Decimal(str(float(totals['leave_days']))),
+            'lop_days': Decimal(str(float(totals['lop_days']))),
+            'half_day_leaves': Decimal(str(float(totals['half_day_leaves']))),
+            'week_off_days': int(totals['week_off_days']),
+            'holiday_days': int(totals['holiday_days']),
+            'sandwich_absent_days': int(totals['sandwich_absent_days']),
+            'payable_days': Decimal(str(float(totals['payable_days']))),
+            'late_days': int(totals['late_days']),
+            'early_exit_days': int(totals['early_exit_days']),
+            'total_late_minutes': int(totals['total_late_minutes']),
+            'total_early_exit_minutes': int(totals['total_early_exit_minutes']),
+            'overtime_hours': self._overtime_hours(row),
+            'day_wise_data': self.day_wise_data(row) if day_wise else []
+        }
+
+    def day_wise_data(self, row):
+        """The per-day breakdown of calculate_detailed_attendance() for one row"""
+        flags = self.day_flags
+        leaves = self._leaves[row]
+        day_wise = []
+        for day in np.flatnonzero(self.in_service[row]):
+            week_off = bool(flags['week_off'][row, day])
+            holiday = bool(flags['holiday'][row, day])
+            regular = not week_off and not holiday
+            leave_index = int(self.leave_index[row, day]) if regular else -1
+            leave = leaves[leave_index] if leave_index >= 0 else None
+            present = bool(self.present[row, day])
+            punctual = bool(flags['counted_punctuality'][row, day])
+            late = punctual and bool(self.is_late[row, day])
+            early_exit = punctual and bool(self.is_early_exit[row, day])
+            overtime = bool(flags['overtime'][row, day])
+            day_wise.append({
+                'date': self.dates[day],
+                'is_week_off': week_off,
+                'is_holiday': holiday,
+                'is_leave': leave is not None,
+                'is_comp_off': leave is not None and bool(self.leave_kind[row, day] == COMP_OFF_LEAVE),
+                'is_lop': leave is not None and bool(self.leave_kind[row, day] == LOP_LEAVE),
+                'is_present': present,
+                'is_absent': bool(flags['absent'][row, day]),
+                'is_sandwich': bool(flags['sandwich'][row, day]),
+                'is_late': late,
+                'is_early_exit': early_exit,
+                'late_minutes': int(self.late_minutes[row, day]) if late else 0,
+                'early_exit_minutes': int(self.early_exit_minutes[row, day]) if early_exit else 0,
+                'working_minutes': int(self.working_minutes[row, day]) if present else 0,
+                'overtime_hours': (
+                    Decimal(str(int(self.overtime_minutes[row, day]))) / Decimal('60') if overtime else Decimal('0.00')
+                ),
+                'leave_type': (leave.leave_type.code if leave.leave_type else None) if leave else None,
+                'leave_days': Decimal(str(float(self.leave_units[row, day]))) if leave else Decimal('0.00')
+            })
+        return day_wise
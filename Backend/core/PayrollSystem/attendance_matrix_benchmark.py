@@ -0,0 +1,188 @@
+"""
+Golden check and benchmark: AttendanceMatrix vs the per-day AttendanceCalculationService.
+
+A synthetic PayrollBatch is built in memory (unsaved model instances, nothing
+is written to the database) with randomized but seeded data covering every
+branch of calculate_detailed_attendance(): joining mid-month and after the
+month, cycled and plain week-off policies, holidays on week-offs, worked
+week-offs and holidays, paid / LOP / comp-off leaves of full, half and short
+duration that overlap each other and the month boundaries, absent and
+non-present statuses, late and early exits, overtime with and without a
+shift duration.
+
+Every employee's matrix result (including the day-wise breakdown) must equal
+the per-day result. Then both are timed over the whole batch (counters only).
+
+Usage (from Backend/core):
+    python PayrollSystem/attendance_matrix_benchmark.py [--employees 10000] [--golden 2000] [--seed 7]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+from decimal import Decimal
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+django.setup()
+
+from AuthN.models import BaseUserModel, UserProfile
+from Holiday.models import Holiday
+from LeaveControl.models import LeaveApplication, LeaveType
+from ServiceWeekOff.models import WeekOffPolicy
+from PayrollSystem.attendance_calculation_service import AttendanceCalculationService
+from PayrollSystem.attendance_matrix import AttendanceMatrix, NUMPY_AVAILABLE
+from PayrollSystem.payroll_batch import AttendanceDay, BatchAttendanceCalculation, PayrollBatch, ShiftDuration
+
+
+def _leave_type(admin, id, code, is_paid, category=None):
+    leave_type = LeaveType(id=id, admin=admin, name=code, code=code, is_paid=is_paid)
+    if category:
+        leave_type.category = category  # Not a model field yet; the calculation reads it when present
+    return leave_type
+
+
+def _synthetic_batch(employee_count, seed, month=3, year=2025):
+    rng = random.Random(seed)
+    organization = BaseUserModel(id=uuid.uuid4(), email='org@bench.local', username='org', role='organization')
+    admin = BaseUserModel(id=uuid.uuid4(), email='admin@bench.local', username='admin', role='admin')
+    batch = PayrollBatch(organization, month, year, admin=admin)
+    first_day = date(year, month, 1)
+    last_day = date(year, month + 1, 1) - timedelta(days=1)
+    month_days = (last_day - first_day).days + 1
+
+    policy_sets = [
+        [WeekOffPolicy(id=1, admin=admin, week_days=['Sunday'], week_off_cycle=[1, 2, 3, 4, 5])],
+        [WeekOffPolicy(id=1, admin=admin, week_days=['Sunday'], week_off_cycle=[1, 2, 3, 4, 5]),
+         WeekOffPolicy(id=2, admin=admin, week_days=['Saturday'], week_off_cycle=[2, 4])],
+        [WeekOffPolicy(id=3, admin=admin, week_days=['Monday', 'Wednesday'], week_off_cycle=[])],
+        [WeekOffPolicy(id=4, admin=admin, week_days='Sunday', week_off_cycle=[1])],  # Not a list: ignored
+        [],
+    ]
+    leave_types = [
+        _leave_type(admin, 1, 'CL', True),
+        _leave_type(admin, 2, 'LWP', False),
+        _leave_type(admin, 3, 'CO', True, 'compensatory'),
+        _leave_type(admin, 4, 'LOP', True, 'lwp'),
+    ]
+    shifts = [ShiftDuration(540), ShiftDuration(480), ShiftDuration(None), None]
+    batch.holidays = [
+        Holiday(id=index, admin=admin, organization=organization, name=f"Holiday {index}", holiday_date=first_day + timedelta(days=day))
+        for index, day in enumerate([2, 8, 15, 20], start=1)  # A Monday, a Sunday, a Saturday, a Thursday
+    ]
+
+    for i in range(employee_count):
+        user = BaseUserModel(id=uuid.uuid4(), email=f"employee{i}@bench.local", username=f"employee{i}", role='user')
+        roll = rng.random()
+        if roll < 0.8:
+            joining = date(2020, 1, 1)
+        elif roll < 0.9:
+            joining = first_day + timedelta(days=rng.randrange(month_days))
+        elif roll < 0.95:
+            joining = last_day + timedelta(days=3)
+        else:
+            joining = None
+        profile = UserProfile(
+            id=uuid.uuid4(), user=user, admin=admin, organization=organization,
+            user_name=f"Employee {i:05d}", date_of_joining=joining
+        )
+        profile.active_week_offs = rng.choice(policy_sets)
+        batch.profiles.append(profile)
+
+        leaves = []
+        for index in range(rng.choice([0, 0, 1, 2, 3])):
+            start = first_day + timedelta(days=rng.randrange(-5, month_days))
+            leave = LeaveApplication(
+                id=i * 10 + index, admin=admin, organization=organization, user=user,
+                leave_type=rng.choice(leave_types), from_date=start, to_date=start + timedelta(days=rng.randrange(0, 6)),
+                total_days=Decimal('1'), status='approved'
+            )
+            duration_type = rng.choice([None, 'full_day', 'half_day', 'short_leave'])
+            if duration_type:
+                leave.duration_type = duration_type  # Not a model field yet, see above
+            leaves.append(leave)
+        if leaves:
+            batch.leaves[user.id] = leaves
+
+        days = {}
+        for day in range(month_days):
+            if rng.random() < 0.25:
+                continue
+            attendance_date = first_day + timedelta(days=day)
+            late = rng.random() < 0.2
+            early_exit = rng.random() < 0.1
+            days[attendance_date] = AttendanceDay(
+                attendance_date=attendance_date,
+                attendance_status=rng.choices(['present', 'absent', 'half_day'], [0.85, 0.1, 0.05])[0],
+                total_working_minutes=rng.choice([None, 0, rng.randrange(300, 700)]),
+                is_late=late, late_minutes=rng.choice([None, rng.randrange(1, 60)]) if late else 0,
+                is_early_exit=early_exit, early_exit_minutes=rng.choice([None, rng.randrange(1, 60)]) if early_exit else 0,
+                assign_shift=rng.choice(shifts)
+            )
+        batch.attendance[user.id] = days
+
+    batch._loaded = True
+    return batch
+
+
+def _per_day(batch, profile):
+    return AttendanceCalculationService.calculate_detailed_attendance(BatchAttendanceCalculation(batch, profile))
+
+
+def _golden_check(employee_count, seed):
+    batch = _synthetic_batch(employee_count, seed)
+    matrix = AttendanceMatrix(batch)
+    mismatches = 0
+    for profile in batch.profiles:
+        expected = _per_day(batch, profile)
+        actual = matrix.detailed_attendance(profile.user_id, day_wise=True)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 5:
+                keys = [key for key in expected if actual.get(key) != expected[key]]
+                print(f"  {profile.user_name}: differs in {keys}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--employees', type=int, default=10000, help="Employees in the timed batch (default: 10000)")
+    parser.add_argument('--golden', type=int, default=2000, help="Employees in the golden check (default: 2000)")
+    parser.add_argument('--seed', type=int, default=7, help="Random seed of the synthetic data (default: 7)")
+    args = parser.parse_args()
+
+    if not NUMPY_AVAILABLE:
+        raise SystemExit("numpy is not installed")
+
+    mismatches = _golden_check(args.golden, args.seed)
+    if mismatches:
+        raise SystemExit(f"Golden check: {mismatches} of {args.golden} employees differ from the per-day calculation")
+    print(f"Golden check: {args.golden} employees identical to the per-day calculation (day-wise data included)")
+
+    batch = _synthetic_batch(args.employees, args.seed + 1)
+    started = time.perf_counter()
+    for profile in batch.profiles:
+        _per_day(batch, profile)
+    per_day_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    matrix = AttendanceMatrix(batch)
+    build_seconds = time.perf_counter() - started
+    for profile in batch.profiles:
+        matrix.detailed_attendance(profile.user_id)
+    matrix_seconds = time.perf_counter() - started
+
+    print(f"{args.employees} employees, one month")
+    print(f"{'mode':<10}{'seconds':>10}{'employees/s':>14}")
+    print(f"{'per-day':<10}{per_day_seconds:>10.2f}{args.employees / per_day_seconds:>14.0f}")
+    print(f"{'matrix':<10}{matrix_seconds:>10.2f}{args.employees / matrix_seconds:>14.0f}"
+          f"   (building the arrays: {build_seconds:.2f}s, speedup {per_day_seconds / matrix_seconds:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -434,6 +434,11 @@ class PayrollRecord(models.Model):
     )
     remarks = models.TextField(null=True, blank=True)
     
+    # Inputs changed since the record was calculated (see payroll_change_tracker)
+    is_stale = models.BooleanField(default=False)
+    stale_since = models.DateTimeField(null=True, blank=True)
+    stale_reason = models.CharField(max_length=50, null=True, blank=True)
+    
     # Component breakdown (JSON)
     earnings_breakdown = models.JSONField(default=dict, null=True, blank=True)
     deductions_breakdown = models.JSONField(default=dict, null=True, blank=True)
@@ -527,3 +532,81 @@ class TDSSlab(models.Model):
 
     def __str__(self):
         return f"FY {self.financial_year} - {self.age_group} - {self.income_from} to {self.income_to or 'Above'}"
+
+
+# --------------------
+# 13. Payroll Run (Background Generation Job)
+# --------------------
+class PayrollRun(models.Model):
+    """
+    Payroll generation for an organization (or one admin's employees) and month,
+    processed by process_payroll_run_task in chunks that each commit and advance
+    `checkpoint`, so a retried run resumes after the last committed chunk.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed')
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    organization = models.ForeignKey(
+        BaseUserModel, on_delete=models.CASCADE,
+        limit_choices_to={'role': 'organization'},
+        related_name='payroll_runs'
+    )
+    admin = models.ForeignKey(
+        BaseUserModel, on_delete=models.CASCADE,
+        limit_choices_to={'role': 'admin'},
+        null=True, blank=True,
+        related_name='admin_payroll_runs'
+    )
+    employee_ids = models.JSONField(default=list, blank=True)  # Optional subset of employees
+    regenerate = models.BooleanField(default=False)  # Recalculate employees that already have a record
+    payroll_month = models.IntegerField()
+    payroll_year = models.IntegerField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    
+    # Progress
+    total_employees = models.IntegerField(default=0)
+    processed_count = models.IntegerField(default=0)
+    generated_count = models.IntegerField(default=0)
+    skipped_count = models.IntegerField(default=0)  # Payroll already existed
+    failed_count = models.IntegerField(default=0)
+    checkpoint = models.JSONField(null=True, blank=True)  # [user_name, profile id] of the last committed employee
+    errors = models.JSONField(default=list, blank=True)  # Per-employee errors (capped)
+    error = models.TextField(null=True, blank=True)  # Run-level failure
+    
+    created_by = models.ForeignKey(
+        BaseUserModel, on_delete=models.SET_NULL,
+        null=True, blank=True,
+        related_name='created_payroll_runs'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Last committed chunk
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['organization', 'payroll_year', 'payroll_month', 'status']),
+        ]
+        # One pending/running run per organization (or admin) and month; two constraints because
+        # NULL admins would not collide in one
+        constraints = [
+            models.UniqueConstraint(
+                fields=['organization', 'admin', 'payroll_month', 'payroll_year'],
+                condition=models.Q(status__in=['pending', 'running'], admin__isnull=False),
+                name='uniq_active_payroll_run_admin'
+            ),
+            models.UniqueConstraint(
+                fields=['organization', 'payroll_month', 'payroll_year'],
+                condition=models.Q(status__in=['pending', 'running'], admin__isnull=True),
+                name='uniq_active_payroll_run_org'
+            ),
+        ]
+
+    def __str__(self):
+        return f"Payroll Run {self.payroll_month}/{self.payroll_year} - {self.organization.email} ({self.status})"
@@ -0,0 +1,416 @@
+"""
+Organization-wide payroll calculation from preloaded reference data.
+
+PayrollBatch loads everything PayrollCalculator and AttendanceCalculationService
+read per employee (settings, structures and their components, overrides,
+advances, compiled PT/TDS slab tables, holidays, week-offs, leaves and the daily attendance
+rollup) for one organization and month in a fixed number of queries, indexes
+it by employee, and computes each employee with the unchanged calculation
+logic reading from those indexes. With numpy installed (and
+PAYROLL_ATTENDANCE_MATRIX on), the attendance counters of all employees come
+from one AttendanceMatrix instead of the per-day walk; batch results then
+carry an empty day_wise_data, which payroll records never store.
+
+Because a loaded batch needs no database, run() can also shard the employees
+across a process pool (PAYROLL_PARALLEL_WORKERS): each worker receives a
+pickled shard() of the batch, calculates with every query forbidden, and
+returns the payroll dicts to the parent, which does all the writing.
+"""
+import logging
+from calendar import monthrange
+from collections import defaultdict, namedtuple
+from contextlib import ExitStack
+from datetime import date
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Prefetch, Q
+
+from AuthN.models import UserProfile
+from Holiday.models import Holiday
+from Holiday.work_calendar import YearCalendar
+from LeaveControl.models import LeaveApplication
+from ServiceWeekOff.models import WeekOffPolicy
+from WorkLog.models import DailyAttendanceSummary
+from .attendance_calculation_service import AttendanceCalculationService
+from .attendance_matrix import AttendanceMatrix, NUMPY_AVAILABLE
+from .models import (
+    PayrollSettings, EmployeeSalaryStructure, StructureComponent,
+    EmployeeSalaryComponent, EmployeeAdvance
+)
+from .payroll_calculator import PayrollCalculator
+from .payroll_pool import process_pool
+from .tax_slab_registry import TaxSlabRegistry, TDSTable
+
+logger = logging.getLogger(__name__)
+
+# The DailyAttendanceSummary fields the attendance calculation reads. Plain tuples
+# keep a 5,000-employee month light in memory and cheap to send to pool workers.
+AttendanceDay = namedtuple('AttendanceDay', [
+    'attendance_date', 'attendance_status', 'total_working_minutes', 'is_late', 'late_minutes',
+    'is_early_exit', 'early_exit_minutes', 'assign_shift'
+])
+ShiftDuration = namedtuple('ShiftDuration', ['duration_minutes'])
+
+
+def _forbid_queries(execute, sql, params, many, context):
+    raise RuntimeError("Payroll workers calculate from the batch snapshot and must not query the database")
+
+
+def _calculate_shard(shard):
+    """Worker entry point: [(user_id, payroll_data, error message)] for every profile of a shard"""
+    results = []
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(_forbid_queries))
+        for profile in shard.profiles:
+            try:
+                results.append((profile.user_id, shard.calculate(profile), None))
+            except Exception as e:
+                results.append((profile.user_id, None, str(e)))
+    return results
+
+
+class BatchAttendanceCalculation(AttendanceCalculationService):
+    """AttendanceCalculationService fed from a PayrollBatch instead of per-employee queries"""
+
+    def __init__(self, batch, profile):
+        self.batch = batch
+        self.profile = profile
+        super().__init__(profile.user, batch.month, batch.year, batch.organization, batch.admin)
+
+    def _load_employee_data(self):
+        self.user_profile = self.profile
+
+    def _load_week_off_policies(self):
+        self.week_off_policies = self.profile.active_week_offs
+
+    def _load_holidays(self):
+        self.calendar = self.batch.work_calendar()
+
+    def _load_leave_applications(self):
+        self.leave_applications = self.batch.leaves.get(self.profile.user_id, [])
+
+    def _load_attendance_records(self):
+        self._attendance_by_date = self.batch.attendance.get(self.profile.user_id, {})
+        self.attendance_records = list(self._attendance_by_date.values())
+
+    def calculate_detailed_attendance(self):
+        matrix = self.batch.attendance_matrix()
+        if matrix is None:
+            return super().calculate_detailed_attendance()
+        return matrix.detailed_attendance(self.profile.user_id)
+
+
+class BatchPayrollCalculator(PayrollCalculator):
+    """PayrollCalculator fed from a PayrollBatch instead of per-employee queries"""
+
+    def __init__(self, batch, profile):
+        self.batch = batch
+        self.profile = profile
+        super().__init__(profile.user, batch.month, batch.year, batch.admin, batch.organization)
+
+    def _load_settings(self):
+        self.settings = self.batch.settings
+
+    def _load_employee_profile(self):
+        self.user_profile = self.profile
+
+    def _get_attendance_service(self):
+        return BatchAttendanceCalculation(self.batch, self.profile)
+
+    def _get_employee_salary_structure(self):
+        return self.batch.structures.get(self.profile.user_id)
+
+    def _get_structure_components(self):
+        salary_structure = self._get_employee_salary_structure()
+        return self.batch.structure_components.get(salary_structure.id, []) if salary_structure else []
+
+    def _get_component_overrides(self):
+        return self.batch.overrides.get(self.profile.user_id, {})
+
+    def _get_pt_table(self, state):
+        return self.batch.pt_table(state)
+
+    def _get_tds_table(self, financial_year, age_group):
+        return self.batch.tds_table(financial_year, age_group)
+
+    def _get_advances(self):
+        return self.batch.advances.get(self.profile.user_id, [])
+
+
+class PayrollBatch:
+    """
+    Payroll for every selected employee of an organization for one month.
+
+    Employees are the admin's (when `admin` is given) or the organization's,
+    optionally narrowed to `employee_ids` and less any passed to exclude().
+    Call load() once, then calculate() per profile or iterate run().
+    """
+
+    def __init__(self, organization, month, year, admin=None, employee_ids=None):
+        self.organization = organization
+        self.month = month
+        self.year = year
+        self.admin = admin
+        self.employee_ids = employee_ids or []
+        self.excluded_employee_ids = set()
+        self.payroll_date = date(year, month, 1)
+        self.end_date = date(year, month, monthrange(year, month)[1])
+
+        self.profiles = []
+        self.settings = None
+        self.holidays = []
+        self.leaves = {}
+        self.attendance = {}
+        self.structures = {}
+        self.structure_components = {}
+        self.overrides = {}
+        self.advances = {}
+        self._pt_tables = {}
+        self._tds_tables = {}
+        self._attendance_matrix = None
+        self._work_calendar = None
+        self._loaded = False
+
+    def employees(self):
+        """UserProfile queryset of the employees in this run"""
+        if self.employee_ids:
+            profiles = UserProfile.objects.filter(user_id__in=self.employee_ids, user__role='user')
+        elif self.admin:
+            profiles = UserProfile.objects.filter(admin=self.admin)
+        else:
+            profiles = UserProfile.objects.filter(organization=self.organization)
+        if self.excluded_employee_ids:
+            profiles = profiles.exclude(user_id__in=self.excluded_employee_ids)
+        return profiles
+
+    def exclude(self, user_ids):
+        """Leave these employees out of the run (e.g. those that already have a record); call before load()"""
+        self.excluded_employee_ids.update(user_ids)
+        return self
+
+    def load(self):
+        """Read all reference data for the run; the query count does not depend on the number of employees"""
+        employees = self.employees()
+        # Subquery, so large organizations never hit bind-parameter limits
+        user_ids = employees.values('user_id')
+
+        self.profiles = list(
+            employees.select_related('user', 'admin', 'organization').prefetch_related(
+                Prefetch('week_offs', queryset=WeekOffPolicy.objects.filter(is_active=True), to_attr='active_week_offs')
+            ).order_by('user_name', 'id')
+        )
+
+        # Same precedence as PayrollCalculator._load_settings: the admin's row, else the organization's first
+        settings_rows = list(PayrollSettings.objects.filter(organization=self.organization).order_by('pk'))
+        admin_id = self.admin.id if self.admin else None
+        self.settings = next(
+            (row for row in settings_rows if row.admin_id == admin_id),
+            settings_rows[0] if settings_rows else None
+        )
+
+        holidays = Holiday.objects.filter(
+            holiday_date__gte=self.payroll_date,
+            holiday_date__lte=self.end_date,
+            is_active=True
+        )
+        self.holidays = list(holidays.filter(admin=self.admin) if self.admin else holidays.filter(organization=self.organization))
+
+        leaves = defaultdict(list)
+        for leave in LeaveApplication.objects.filter(
+            user_id__in=user_ids,
+            status='approved',
+            from_date__lte=self.end_date,
+            to_date__gte=self.payroll_date
+        ).select_related('leave_type'):
+            leaves[leave.user_id].append(leave)
+        self.leaves = leaves
+
+        attendance = defaultdict(dict)
+        shifts = {}
+        for user_id, *day, shift_id, duration_minutes in DailyAttendanceSummary.objects.filter(
+            user_id__in=user_ids,
+            attendance_date__gte=self.payroll_date,
+            attendance_date__lte=self.end_date
+        ).values_list(
+            'user_id', 'attendance_date', 'attendance_status', 'total_working_minutes', 'is_late',
+            'late_minutes', 'is_early_exit', 'early_exit_minutes', 'assign_shift_id', 'assign_shift__duration_minutes'
+        ):
+            if shift_id is not None and shift_id not in shifts:
+                shifts[shift_id] = ShiftDuration(duration_minutes)
+            attendance[user_id][day[0]] = AttendanceDay(*day, shifts.get(shift_id))
+        self.attendance = attendance
+
+        # Latest assignment in effect on the 1st wins, as in _get_employee_salary_structure
+        structures = {}
+        for assignment in EmployeeSalaryStructure.objects.filter(
+            employee_id__in=user_ids,
+            effective_from__lte=self.payroll_date,
+            is_active=True
+        ).filter(
+            Q(effective_to__isnull=True) | Q(effective_to__gte=self.payroll_date)
+        ).select_related('structure').order_by('employee_id', '-effective_from'):
+            structures.setdefault(assignment.employee_id, assignment.structure)
+        self.structures = structures
+
+        structure_components = defaultdict(list)
+        for comp in StructureComponent.objects.filter(
+            structure_id__in={structure.id for structure in structures.values()},
+            is_active=True
+        ).select_related('component').order_by('component__priority'):
+            structure_components[comp.structure_id].append(comp)
+        self.structure_components = structure_components
+
+        overrides = defaultdict(dict)
+        for override in EmployeeSalaryComponent.objects.filter(
+            employee_id__in=user_ids,
+            effective_from__lte=self.payroll_date,
+            is_active=True
+        ).filter(
+            Q(effective_to__isnull=True) | Q(effective_to__gte=self.payroll_date)
+        ):
+            overrides[override.employee_id][override.component_id] = override.amount
+        self.overrides = overrides
+
+        advances = defaultdict(list)
+        for advance in EmployeeAdvance.objects.filter(
+            employee_id__in=user_ids,
+            status='approved',
+            remaining_amount__gt=0
+        ):
+            advances[advance.employee_id].append(advance)
+        self.advances = advances
+
+        if self.settings and self.settings.pt_enabled and self.settings.pt_state:
+            self.pt_table(self.settings.pt_state)
+        # PayrollCalculator._calculate_tds uses the financial year of today
+        self.tds_table(PayrollCalculator.financial_year(), 'general')
+        self._loaded = True
+        return self
+
+    def shard(self, profiles):
+        """Loaded copy of the batch holding only `profiles` and their data (what a worker is sent)"""
+        user_ids = {profile.user_id for profile in profiles}
+        structure_ids = {self.structures[user_id].id for user_id in user_ids if user_id in self.structures}
+
+        shard = PayrollBatch(self.organization, self.month, self.year, admin=self.admin)
+        shard.profiles = list(profiles)
+        shard.settings = self.settings
+        shard.holidays = self.holidays
+        shard.leaves = {user_id: self.leaves[user_id] for user_id in user_ids if user_id in self.leaves}
+        shard.attendance = {user_id: self.attendance[user_id] for user_id in user_ids if user_id in self.attendance}
+        shard.structures = {user_id: self.structures[user_id] for user_id in user_ids if user_id in self.structures}
+        shard.structure_components = {
+            structure_id: self.structure_components[structure_id]
+            for structure_id in structure_ids if structure_id in self.structure_components
+        }
+        shard.overrides = {user_id: self.overrides[user_id] for user_id in user_ids if user_id in self.overrides}
+        shard.advances = {user_id: self.advances[user_id] for user_id in user_ids if user_id in self.advances}
+        shard._pt_tables = self._pt_tables
+        shard._tds_tables = self._tds_tables
+        shard._loaded = True
+        return shard
+
+    def variant(self, **replacements):
+        """Loaded copy of the batch sharing all its data except the given attributes (e.g. settings=...)"""
+        # Not copy.copy(): that would go through __getstate__ and re-encode the attendance
+        variant = PayrollBatch.__new__(PayrollBatch)
+        variant.__dict__.update(self.__dict__)
+        variant.__dict__.update(replacements)
+        return variant
+
+    def work_calendar(self):
+        """YearCalendar of the loaded holidays, compiled on first use (week-off policies are added as they are met)"""
+        if self._work_calendar is None:
+            self._work_calendar = YearCalendar(self.year, [holiday.holiday_date for holiday in self.holidays])
+        return self._work_calendar
+
+    def attendance_matrix(self):
+        """AttendanceMatrix of the loaded employees, built on first use; None if it is not available"""
+        if not NUMPY_AVAILABLE or not getattr(settings, 'PAYROLL_ATTENDANCE_MATRIX', True):
+            return None
+        if self._attendance_matrix is None:
+            self._attendance_matrix = AttendanceMatrix(self)
+        return self._attendance_matrix
+
+    def __getstate__(self):
+        # Attendance travels to pool workers as plain tuples, which pickle far faster than named tuples
+        state = self.__dict__.copy()
+        state['_attendance_matrix'] = None  # Each worker builds its shard's own
+        state['attendance'] = {
+            user_id: [
+                (day.attendance_date.toordinal(), *day[1:7], day.assign_shift.duration_minutes if day.assign_shift else None)
+                for day in days.values()
+            ]
+            for user_id, days in self.attendance.items()
+        }
+        return state
+
+    def __setstate__(self, state):
+        # A shift without a duration and no shift read the same in the calculation (no overtime)
+        shifts = {}
+        for rows in state['attendance'].values():
+            for row in rows:
+                if row[-1] is not None and row[-1] not in shifts:
+                    shifts[row[-1]] = ShiftDuration(row[-1])
+        state['attendance'] = {
+            user_id: {
+                day.attendance_date: day
+                for day in (AttendanceDay(date.fromordinal(row[0]), *row[1:-1], shifts.get(row[-1])) for row in rows)
+            }
+            for user_id, rows in state['attendance'].items()
+        }
+        self.__dict__.update(state)
+
+    @staticmethod
+    def process_pool(workers=None):
+        """
+        Pool for run(pool=...) (see payroll_pool), or None when parallel mode is off
+        (PAYROLL_PARALLEL_WORKERS <= 1). Workers are spawned, not forked, so they never
+        inherit the parent's database connections.
+        """
+        workers = workers if workers is not None else getattr(settings, 'PAYROLL_PARALLEL_WORKERS', 0)
+        return process_pool(workers)
+
+    def pt_table(self, state):
+        """Compiled PT slabs of a state, kept on the batch so pool workers never need the registry"""
+        if state not in self._pt_tables:
+            self._pt_tables[state] = TaxSlabRegistry.pt_table(state)
+        return self._pt_tables[state]
+
+    def tds_table(self, financial_year, age_group):
+        """Compiled TDS slabs of a financial year and age group, kept on the batch like pt_table()"""
+        if financial_year not in self._tds_tables:
+            self._tds_tables[financial_year] = TaxSlabRegistry.tds_tables(financial_year)
+        return self._tds_tables[financial_year].get(age_group) or TDSTable([])
+
+    def calculate(self, profile):
+        """calculate_payroll() result for one loaded profile; raises like PayrollCalculator"""
+        return BatchPayrollCalculator(self, profile).calculate_payroll()
+
+    def run(self, pool=None, shard_size=None):
+        """
+        Yield (profile, payroll_data, error) for every employee, loading first if needed.
+        With a process_pool(), employees are calculated on the pool's workers in shards of
+        `shard_size` (PAYROLL_PARALLEL_SHARD_SIZE), several per worker so they stay busy.
+        """
+        if not self._loaded:
+            self.load()
+        if pool is None:
+            for profile in self.profiles:
+                try:
+                    yield profile, self.calculate(profile), None
+                except Exception as e:
+                    yield profile, None, e
+            return
+
+        shard_size = shard_size or getattr(settings, 'PAYROLL_PARALLEL_SHARD_SIZE', 250)
+        profiles_by_user = {profile.user_id: profile for profile in self.profiles}
+        shards = [
+            self.shard(self.profiles[start:start + shard_size])
+            for start in range(0, len(self.profiles), shard_size)
+        ]
+        for results in pool.map(_calculate_shard, shards):
+            for user_id, payroll_data, error in results:
+                yield profiles_by_user[user_id], payroll_data, Exception(error) if error is not None else None
@@ -15,10 +15,20 @@ from .models import (
 )
 from AuthN.models import BaseUserModel, UserProfile
 from .attendance_calculation_service import AttendanceCalculationService
+from .tax_slab_registry import TaxSlabRegistry
 
 
 class PayrollCalculator:
-    """Main payroll calculation service with advanced features"""
+    """
+    Main payroll calculation service with advanced features
+
+    Reference data (settings, salary structure, components, overrides, slabs,
+    advances) is read through the _get_* methods, each loaded at most once per
+    calculator; PayrollBatch overrides them to serve a whole organization from
+    preloaded indexes.
+    """
+    
+    _NOT_LOADED = object()
     
     def __init__(self, employee, month, year, admin=None, organization=None):
         self.employee = employee
@@ -31,6 +41,9 @@ class PayrollCalculator:
         self.earnings = {}
         self.deductions = {}
         self.user_profile = None
+        self._salary_structure = self._NOT_LOADED
+        self._structure_components = None
+        self._component_overrides = None
         
         # Load settings
         self._load_settings()
@@ -58,13 +71,16 @@ class PayrollCalculator:
         except UserProfile.DoesNotExist:
             self.user_profile = None
     
+    def _get_attendance_service(self):
+        return AttendanceCalculationService(
+            self.employee, self.month, self.year,
+            self.organization, self.admin
+        )
+    
     def _load_attendance(self):
         """Load attendance data using advanced calculation service"""
         try:
-            attendance_service = AttendanceCalculationService(
-                self.employee, self.month, self.year, 
-                self.organization, self.admin
-            )
+            attendance_service = self._get_attendance_service()
             detailed_attendance = attendance_service.calculate_detailed_attendance()
             
             # Map to expected format
@@ -155,39 +171,74 @@ class PayrollCalculator:
     
     def _get_employee_salary_structure(self):
         """Get active salary structure for employee"""
-        payroll_date = date(self.year, self.month, 1)
-        
-        structure_assignment = EmployeeSalaryStructure.objects.filter(
-            employee=self.employee,
-            effective_from__lte=payroll_date,
-            is_active=True
-        ).filter(
-            Q(effective_to__isnull=True) | Q(effective_to__gte=payroll_date)
-        ).order_by('-effective_from').first()
-        
-        return structure_assignment.structure if structure_assignment else None
+        if self._salary_structure is self._NOT_LOADED:
+            payroll_date = date(self.year, self.month, 1)
+            
+            structure_assignment = EmployeeSalaryStructure.objects.filter(
+                employee=self.employee,
+                effective_from__lte=payroll_date,
+                is_active=True
+            ).filter(
+                Q(effective_to__isnull=True) | Q(effective_to__gte=payroll_date)
+            ).select_related('structure').order_by('-effective_from').first()
+            
+            self._salary_structure = structure_assignment.structure if structure_assignment else None
+        return self._salary_structure
+    
+    def _get_structure_components(self):
+        """Active components of the employee's structure, in priority order"""
+        if self._structure_components is None:
+            salary_structure = self._get_employee_salary_structure()
+            self._structure_components = list(
+                StructureComponent.objects.filter(
+                    structure=salary_structure,
+                    is_active=True
+                ).select_related('component').order_by('component__priority')
+            ) if salary_structure else []
+        return self._structure_components
+    
+    def _get_component_overrides(self):
+        """{component id: amount} of the employee's overrides in effect for the payroll month"""
+        if self._component_overrides is None:
+            payroll_date = date(self.year, self.month, 1)
+            employee_overrides = EmployeeSalaryComponent.objects.filter(
+                employee=self.employee,
+                effective_from__lte=payroll_date,
+                is_active=True
+            ).filter(
+                Q(effective_to__isnull=True) | Q(effective_to__gte=payroll_date)
+            )
+            self._component_overrides = {override.component_id: override.amount for override in employee_overrides}
+        return self._component_overrides
+    
+    def _get_pt_table(self, state):
+        """Compiled professional tax slabs of a state"""
+        return TaxSlabRegistry.pt_table(state)
+    
+    def _get_tds_table(self, financial_year, age_group):
+        """Compiled TDS slabs of a financial year and age group"""
+        return TaxSlabRegistry.tds_table(financial_year, age_group)
+    
+    def _get_advances(self):
+        """Approved advances/loans with an outstanding balance"""
+        return list(
+            EmployeeAdvance.objects.filter(
+                employee=self.employee,
+                status='approved',
+                remaining_amount__gt=0
+            )
+        )
     
     def _calculate_earnings(self, salary_structure):
         """Calculate all earnings components with advanced proration"""
         # Get structure components
-        structure_components = StructureComponent.objects.filter(
-            structure=salary_structure,
-            component__component_type='earning',
-            is_active=True
-        ).select_related('component').order_by('component__priority')
+        structure_components = [
+            comp for comp in self._get_structure_components()
+            if comp.component.component_type == 'earning'
+        ]
         
         # Get employee overrides
-        payroll_date = date(self.year, self.month, 1)
-        employee_overrides = EmployeeSalaryComponent.objects.filter(
-            employee=self.employee,
-            component__component_type='earning',
-            effective_from__lte=payroll_date,
-            is_active=True
-        ).filter(
-            Q(effective_to__isnull=True) | Q(effective_to__gte=payroll_date)
-        ).select_related('component')
-        
-        override_dict = {override.component.id: override.amount for override in employee_overrides}
+        override_dict = self._get_component_overrides()
         
         # Calculate basic salary first (needed for percentage calculations)
         basic_salary = Decimal('0.00')
@@ -271,11 +322,10 @@ class PayrollCalculator:
         # Bonus (Diwali, Annual, etc.)
         if self.settings and self.settings.bonus_enabled:
             # Check for bonus components in salary structure
-            bonus_components = StructureComponent.objects.filter(
-                structure=self._get_employee_salary_structure(),
-                component__code__in=['BONUS', 'DIWALI_BONUS', 'ANNUAL_BONUS'],
-                is_active=True
-            ).select_related('component')
+            bonus_components = [
+                comp for comp in self._get_structure_components()
+                if comp.component.code in ['BONUS', 'DIWALI_BONUS', 'ANNUAL_BONUS']
+            ]
             
             for bonus_comp in bonus_components:
                 component = bonus_comp.component
@@ -372,12 +422,10 @@ class PayrollCalculator:
         # Check if other components are marked for PF calculation
         salary_structure = self._get_employee_salary_structure()
         if salary_structure:
-            structure_components = StructureComponent.objects.filter(
-                structure=salary_structure,
-                component__is_pf_applicable=True,
-                component__component_type='earning',
-                is_active=True
-            ).select_related('component')
+            structure_components = [
+                comp for comp in self._get_structure_components()
+                if comp.component.is_pf_applicable and comp.component.component_type == 'earning'
+            ]
             
             # Sum all PF applicable components
             pf_applicable_amount = Decimal('0.00')
@@ -404,14 +452,12 @@ class PayrollCalculator:
         # Check if specific components are marked for ESI calculation
         salary_structure = self._get_employee_salary_structure()
         if salary_structure:
-            structure_components = StructureComponent.objects.filter(
-                structure=salary_structure,
-                component__is_esi_applicable=True,
-                component__component_type='earning',
-                is_active=True
-            ).select_related('component')
+            structure_components = [
+                comp for comp in self._get_structure_components()
+                if comp.component.is_esi_applicable and comp.component.component_type == 'earning'
+            ]
             
-            if structure_components.exists():
+            if structure_components:
                 # Sum all ESI applicable components
                 esi_applicable_amount = Decimal('0.00')
                 for comp in structure_components:
@@ -464,31 +510,12 @@ class PayrollCalculator:
         # For annual PT, divide by 12; for monthly PT, use as is
         # This depends on state policy - Maharashtra has monthly PT
         
-        # Query PT slab
-        slab_query = ProfessionalTaxSlab.objects.filter(
-            state=self.settings.pt_state,
-            salary_from__lte=gross_salary,
-            is_active=True
-        ).filter(
-            Q(salary_to__isnull=True) | Q(salary_to__gte=gross_salary)
-        )
-        
         # Filter by gender if applicable (some states have different rates for women)
         # This would require a gender field in ProfessionalTaxSlab model
         # For now, we'll use the general slab
         
-        slab = slab_query.order_by('-salary_from').first()
-        
-        if slab:
-            pt_amount = slab.tax_amount
-            
-            # Some states have reduced PT for women (e.g., Maharashtra)
-            # This would typically be configured in the slab or settings
-            # For now, placeholder - can be enhanced based on state rules
-            
-            return pt_amount
-        
-        return Decimal('0.00')
+        # Highest slab whose range contains the gross salary
+        return self._get_pt_table(self.settings.pt_state).amount(gross_salary)
     
     def _calculate_gratuity(self, basic_salary, payable_days, working_days):
         """Calculate Gratuity (typically for full & final settlement)"""
@@ -516,14 +543,19 @@ class PayrollCalculator:
         
         return gratuity_amount
     
+    @staticmethod
+    def financial_year(on_date=None):
+        """Indian financial year label (April-March) of a date, e.g. 2024-25"""
+        on_date = on_date or date.today()
+        if on_date.month >= 4:
+            return f"{on_date.year}-{str(on_date.year + 1)[-2:]}"
+        return f"{on_date.year - 1}-{str(on_date.year)[-2:]}"
+    
     def _calculate_tds(self, annual_income):
         """Calculate TDS based on income tax slabs with age-based calculation"""
         # Get current financial year
         current_date = date.today()
-        if current_date.month >= 4:
-            financial_year = f"{current_date.year}-{str(current_date.year + 1)[-2:]}"
-        else:
-            financial_year = f"{current_date.year - 1}-{str(current_date.year)[-2:]}"
+        financial_year = self.financial_year(current_date)
         
         # Get age group based on employee's date of birth
         age_group = 'general'
@@ -538,46 +570,12 @@ class PayrollCalculator:
             else:
                 age_group = 'general'
         
-        slabs = TDSSlab.objects.filter(
-            financial_year=financial_year,
-            age_group=age_group,
-            income_from__lte=annual_income,
-            is_active=True
-        ).order_by('income_from')
-        
-        total_tax = Decimal('0.00')
-        remaining_income = annual_income
-        
-        for slab in slabs:
-            if remaining_income <= 0:
-                break
-            
-            # Calculate taxable income for this slab
-            slab_max = slab.income_to if slab.income_to else annual_income
-            slab_min = slab.income_from
-            
-            if remaining_income <= slab_min:
-                break
-            
-            slab_income = min(remaining_income, slab_max) - slab_min + 1
-            if slab_income <= 0:
-                continue
-            
-            tax_on_slab = (slab_income * slab.tax_rate) / 100
-            total_tax += tax_on_slab
-            remaining_income -= slab_income
-        
-        return total_tax
+        # Each slab taxes the income that falls inside it at its own rate
+        return self._get_tds_table(financial_year, age_group).tax(annual_income)
     
     def _calculate_advance_deductions(self):
         """Calculate advance and loan deductions"""
-        payroll_date = date(self.year, self.month, 1)
-        
-        advances = EmployeeAdvance.objects.filter(
-            employee=self.employee,
-            status='approved',
-            remaining_amount__gt=0
-        )
+        advances = self._get_advances()
         
         total_advance_deduction = Decimal('0.00')
         total_loan_deduction = Decimal('0.00')
@@ -609,23 +607,12 @@ class PayrollCalculator:
         if not salary_structure:
             return
         
-        structure_components = StructureComponent.objects.filter(
-            structure=salary_structure,
-            component__component_type='deduction',
-            is_active=True
-        ).select_related('component')
-        
-        payroll_date = date(self.year, self.month, 1)
-        employee_overrides = EmployeeSalaryComponent.objects.filter(
-            employee=self.employee,
-            component__component_type='deduction',
-            effective_from__lte=payroll_date,
-            is_active=True
-        ).filter(
-            Q(effective_to__isnull=True) | Q(effective_to__gte=payroll_date)
-        ).select_related('component')
-        
-        override_dict = {override.component.id: override.amount for override in employee_overrides}
+        structure_components = [
+            comp for comp in self._get_structure_components()
+            if comp.component.component_type == 'deduction'
+        ]
+        
+        override_dict = self._get_component_overrides()
         basic_salary = self.earnings.get('BASIC', {}).get('amount', Decimal('0.00'))
         
         for comp in structure_components:
@@ -0,0 +1,173 @@
+"""
+Incremental payroll recomputation.
+
+When an input of an already calculated month changes (attendance, a leave,
+a salary structure or component override assignment, an advance), the
+affected PayrollRecords are flagged is_stale instead of forcing a full
+regeneration. Only draft/processed records are flagged; approved and paid
+payroll is never touched. recompute() then recalculates just the stale
+employees of a month and writes only the records whose figures changed.
+
+Marking runs after the writing transaction commits and is a single UPDATE
+per distinct date range. Saves and deletes are covered by the receivers in
+PayrollSystem/signals.py. Moving an existing row to other dates marks both
+its old and its new range.
+
+Attendance is not marked per punch, to keep the check-in/out path free of
+payroll writes. mark_attendance_changes() instead sweeps the daily
+attendance summaries refreshed since its previous run (a watermark in the
+Django cache, re-checking PAYROLL_ATTENDANCE_SWEEP_OVERLAP_MINUTES before
+it) and marks their months; it runs from mark_payroll_attendance_task and
+at the start of every recompute(). Days whose attendance disappeared (their
+summary is deleted) are marked by the summary refresh directly.
+"""
+import logging
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from WorkLog.models import DailyAttendanceSummary
+from .models import PayrollRecord
+from .payroll_batch import PayrollBatch
+from .payroll_record_writer import PayrollRecordWriter
+
+logger = logging.getLogger(__name__)
+
+
+class PayrollChangeTracker:
+
+    RECOMPUTABLE_STATUSES = ('draft', 'processed')
+    ATTENDANCE_WATERMARK_KEY = 'payroll_attendance_watermark'
+
+    @staticmethod
+    def mark_dirty(ranges, reason):
+        """
+        Flag the records of `ranges` as stale once the surrounding transaction commits.
+        Each range is (employee_id, from_date, to_date); a None bound is open-ended.
+        """
+        by_range = defaultdict(set)
+        for employee_id, from_date, to_date in ranges:
+            by_range[(from_date, to_date)].add(employee_id)
+        if by_range:
+            transaction.on_commit(lambda: PayrollChangeTracker._mark_quietly(by_range, reason))
+
+    @staticmethod
+    def _mark_quietly(by_range, reason):
+        # Runs after commit: a failure here must not fail the change that triggered it
+        try:
+            PayrollChangeTracker._mark(by_range, reason)
+        except Exception as e:
+            logger.error(f"Error marking payroll stale ({reason}) for {len(by_range)} range(s): {str(e)}")
+
+    @staticmethod
+    def _mark(by_range, reason):
+        ranges = Q()
+        for (from_date, to_date), employee_ids in by_range.items():
+            condition = Q(employee_id__in=employee_ids)
+            if from_date:
+                # payroll_date is the 1st of the payroll month
+                condition &= Q(payroll_date__gte=date(from_date.year, from_date.month, 1))
+            if to_date:
+                condition &= Q(payroll_date__lte=to_date)
+            ranges |= condition
+
+        PayrollRecord.objects.filter(ranges, status__in=PayrollChangeTracker.RECOMPUTABLE_STATUSES).update(
+            is_stale=True, stale_since=timezone.now(), stale_reason=reason
+        )
+
+    @staticmethod
+    def mark_attendance_changes(now=None):
+        """
+        Flag the months of the attendance summaries refreshed since the previous sweep.
+        Returns the number of employee-months looked at.
+        """
+        now = now or timezone.now()
+        watermark = cache.get(PayrollChangeTracker.ATTENDANCE_WATERMARK_KEY)
+        if watermark is None:
+            watermark = now - timedelta(hours=getattr(settings, 'PAYROLL_ATTENDANCE_SWEEP_INITIAL_LOOKBACK_HOURS', 36))
+        since = watermark - timedelta(minutes=getattr(settings, 'PAYROLL_ATTENDANCE_SWEEP_OVERLAP_MINUTES', 10))
+
+        by_range = defaultdict(set)
+        for user_id, attendance_date in DailyAttendanceSummary.objects.filter(
+            updated_at__gt=since, updated_at__lte=now
+        ).values_list('user_id', 'attendance_date').distinct().iterator(chunk_size=5000):
+            month_start = attendance_date.replace(day=1)
+            month_end = attendance_date.replace(day=monthrange(attendance_date.year, attendance_date.month)[1])
+            by_range[(month_start, month_end)].add(user_id)
+
+        if by_range:
+            PayrollChangeTracker._mark(by_range, 'attendance')
+        cache.set(PayrollChangeTracker.ATTENDANCE_WATERMARK_KEY, now, None)
+        return sum(len(employee_ids) for employee_ids in by_range.values())
+
+    @staticmethod
+    def stale_records(organization, month, year, admin=None):
+        records = PayrollRecord.objects.filter(
+            organization=organization,
+            payroll_month=month,
+            payroll_year=year,
+            is_stale=True,
+            status__in=PayrollChangeTracker.RECOMPUTABLE_STATUSES
+        )
+        if admin:
+            records = records.filter(admin=admin)
+        return records
+
+    @staticmethod
+    def recompute(organization, month, year, admin=None):
+        """
+        Recalculate the month's stale records and update the ones whose figures changed.
+        Returns {"recomputed", "unchanged", "failed", "errors"}.
+        """
+        started = timezone.now()
+        # Attendance changed since the last sweep would otherwise be missed until the next one
+        PayrollChangeTracker.mark_attendance_changes()
+        stale = list(
+            PayrollChangeTracker.stale_records(organization, month, year, admin).select_related('employee')
+        )
+        errors = []
+
+        with transaction.atomic():
+            writer = PayrollRecordWriter(organization, month, year, upsert=True)
+            unchanged_ids = []
+
+            # Same settings precedence as UpdatePayrollReportView: each record's own admin first
+            records_by_admin = defaultdict(dict)
+            for record in stale:
+                records_by_admin[record.admin][record.employee_id] = record
+
+            for record_admin, records in records_by_admin.items():
+                writer.existing_record_ids.update({employee_id: record.id for employee_id, record in records.items()})
+                batch = PayrollBatch(organization, month, year, admin=record_admin, employee_ids=list(records)).load()
+                for user_profile, payroll_data, error in batch.run():
+                    record = records[user_profile.user_id]
+                    if error is not None:
+                        errors.append(f"Error for {record.employee.email}: {str(error)}")
+                    elif writer.is_unchanged(record, user_profile, payroll_data):
+                        unchanged_ids.append(record.id)
+                    else:
+                        writer.add(user_profile, payroll_data)
+
+            written, write_failures = writer.flush()
+            errors.extend(f"Error for {user_profile.user.email}: {str(e)}" for user_profile, e in write_failures)
+            recomputed = len(written)
+            unchanged = len(unchanged_ids)
+            PayrollRecord.objects.filter(id__in=unchanged_ids).update(is_stale=False)
+
+            # Changes marked while this recompute was reading its inputs keep their records stale
+            PayrollRecord.objects.filter(
+                id__in=[record.id for record in stale], stale_since__gt=started
+            ).update(is_stale=True)
+
+        return {
+            "recomputed": recomputed,
+            "unchanged": unchanged,
+            "failed": len(errors),
+            "errors": errors
+        }
@@ -3,111 +3,165 @@ Payroll Excel Export/Import Service
 Handles Excel operations for payroll data
 """
 
+import csv
+import json
+import tempfile
 import openpyxl
-from openpyxl.styles import PatternFill, Font, Alignment, Border, Side
+from itertools import chain, islice
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill, Font, Alignment, NamedStyle
+from openpyxl.utils import get_column_letter
 from io import BytesIO
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
 from decimal import Decimal
-import uuid
+
+
+class _Echo:
+    """File-like object whose write() hands the value back, for streaming csv.writer output"""
+
+    def write(self, value):
+        return value
 
 
 class PayrollExcelService:
-    """Service for payroll Excel operations"""
+    """
+    Service for payroll Excel operations
+
+    The payroll register (one row per PayrollRecord) is read with values_list()
+    over the record, employee and profile join and iterated in chunks of
+    PAYROLL_EXPORT_CHUNK_SIZE, so exporting a large month keeps memory flat:
+    CSV and NDJSON stream row by row; XLSX goes through a write_only workbook
+    spooled to a temporary file.
+    """
+    
+    # (row key, header, PayrollRecord field path)
+    REGISTER_COLUMNS = [
+        ('employee_id', "Employee ID", 'employee__own_user_profile__custom_employee_id'),
+        ('employee_name', "Employee Name", 'employee__own_user_profile__user_name'),
+        ('email', "Email", 'employee__email'),
+        ('basic_salary', "Basic", 'basic_salary'),
+        ('hra', "HRA", 'hra'),
+        ('special_allowance', "Special Allowance", 'special_allowance'),
+        ('overtime', "Overtime", 'overtime_amount'),
+        ('gross_salary', "Gross Salary", 'gross_salary'),
+        ('pf_employee', "PF (Emp)", 'pf_employee'),
+        ('esi_employee', "ESI (Emp)", 'esi_employee'),
+        ('professional_tax', "Professional Tax", 'professional_tax'),
+        ('tds', "TDS", 'tds'),
+        ('advance', "Advance", 'advance_deduction'),
+        ('loan', "Loan", 'loan_deduction'),
+        ('total_deductions', "Total Deductions", 'total_deductions'),
+        ('net_salary', "Net Salary", 'net_salary'),
+        ('present_days', "Present Days", 'present_days'),
+        ('absent_days', "Absent Days", 'absent_days'),
+        ('working_days', "Working Days", 'working_days'),
+    ]
+    CONTENT_TYPES = {
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "csv": "text/csv",
+        "ndjson": "application/x-ndjson",
+    }
+    # write_only sheets need column widths before the first row, so they are sized from this many rows
+    WIDTH_SAMPLE_ROWS = 500
+    MAX_COLUMN_WIDTH = 30
     
     @staticmethod
-    def generate_payroll_excel(payroll_records, month, year):
-        """Generate comprehensive payroll Excel report"""
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = f"Payroll_{month}_{year}"
-        
-        # Header styling
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=11)
-        border = Border(
-            left=Side(style='thin'),
-            right=Side(style='thin'),
-            top=Side(style='thin'),
-            bottom=Side(style='thin')
+    def register_rows(payroll_records):
+        """Yield one dict per record of a PayrollRecord queryset (keys of REGISTER_COLUMNS, amounts as floats)"""
+        keys = [key for key, _, _ in PayrollExcelService.REGISTER_COLUMNS]
+        chunk_size = getattr(settings, 'PAYROLL_EXPORT_CHUNK_SIZE', 2000)
+        values = payroll_records.order_by('employee__own_user_profile__user_name', 'id').values_list(
+            *[field for _, _, field in PayrollExcelService.REGISTER_COLUMNS]
         )
+        for row in values.iterator(chunk_size=chunk_size):
+            yield dict(zip(keys, (float(value) if isinstance(value, Decimal) else value for value in row)))
+    
+    @staticmethod
+    def write_xlsx(rows, output, title="Payroll"):
+        """Write register rows to `output` (path or binary file) with a write_only workbook. Returns the row count."""
+        columns = PayrollExcelService.REGISTER_COLUMNS
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet(title)
         
-        # Headers
-        headers = [
-            "Employee ID", "Employee Name", "Email",
-            "Basic", "HRA", "Special Allowance", "Overtime", "Gross Salary",
-            "PF (Emp)", "ESI (Emp)", "Professional Tax", "TDS", "Advance", "Loan",
-            "Total Deductions", "Net Salary",
-            "Present Days", "Absent Days", "Working Days"
-        ]
+        rows = ([row[key] for key, _, _ in columns] for row in rows)
+        sample = list(islice(rows, PayrollExcelService.WIDTH_SAMPLE_ROWS))
         
-        # Write headers
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
+        # Auto width from the header and the sampled rows
+        widths = [len(header) for _, header, _ in columns]
+        for row in sample:
+            for col, value in enumerate(row):
+                widths[col] = max(widths[col], len(str(value)))
+        for col, width in enumerate(widths, 1):
+            ws.column_dimensions[get_column_letter(col)].width = min(width + 2, PayrollExcelService.MAX_COLUMN_WIDTH)
+        
+        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+        header_font = Font(bold=True, color="FFFFFF", size=11)
+        header = []
+        for _, title_text, _ in columns:
+            cell = WriteOnlyCell(ws, value=title_text)
             cell.fill = header_fill
             cell.font = header_font
             cell.alignment = Alignment(horizontal="center", vertical="center")
-            cell.border = border
+            header.append(cell)
+        ws.append(header)
         
-        # Write data
-        for row_idx, payroll in enumerate(payroll_records, 2):
-            try:
-                user_profile = payroll.employee.own_user_profile
-                row_data = [
-                    user_profile.custom_employee_id,
-                    user_profile.user_name,
-                    payroll.employee.email,
-                    float(payroll.basic_salary),
-                    float(payroll.hra),
-                    float(payroll.special_allowance),
-                    float(payroll.overtime_amount),
-                    float(payroll.gross_salary),
-                    float(payroll.pf_employee),
-                    float(payroll.esi_employee),
-                    float(payroll.professional_tax),
-                    float(payroll.tds),
-                    float(payroll.advance_deduction),
-                    float(payroll.loan_deduction),
-                    float(payroll.total_deductions),
-                    float(payroll.net_salary),
-                    payroll.present_days,
-                    payroll.absent_days,
-                    payroll.working_days
-                ]
-                
-                for col, value in enumerate(row_data, 1):
-                    cell = ws.cell(row=row_idx, column=col, value=value)
-                    cell.border = border
-                    if isinstance(value, (int, float)):
-                        cell.number_format = '#,##0.00'
-                        cell.alignment = Alignment(horizontal="right")
-                    else:
-                        cell.alignment = Alignment(horizontal="left")
-            except Exception as e:
-                continue
+        # Amounts (and day counts) as '#,##0.00', right aligned; one named style shared by every cell
+        amount_style = NamedStyle(name="register_amount", number_format='#,##0.00', alignment=Alignment(horizontal="right"))
+        wb.add_named_style(amount_style)
         
-        # Auto width
-        for col in ws.columns:
-            max_len = 0
-            letter = col[0].column_letter
-            for cell in col:
-                try:
-                    max_len = max(max_len, len(str(cell.value)))
-                except:
-                    pass
-            ws.column_dimensions[letter].width = min(max_len + 2, 30)
+        def styled(value):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                cell = WriteOnlyCell(ws, value=value)
+                cell.style = amount_style.name
+                return cell
+            return value
+        
+        count = 0
+        for row in chain(sample, rows):
+            ws.append([styled(value) for value in row])
+            count += 1
         
-        # Save to memory
-        output = BytesIO()
         wb.save(output)
-        output.seek(0)
+        return count
+    
+    @staticmethod
+    def iter_csv(rows):
+        """Yield CSV lines (header first) one row at a time"""
+        columns = PayrollExcelService.REGISTER_COLUMNS
+        writer = csv.writer(_Echo())
+        yield writer.writerow([header for _, header, _ in columns])
+        for row in rows:
+            yield writer.writerow([row[key] for key, _, _ in columns])
+    
+    @staticmethod
+    def iter_ndjson(rows):
+        """Yield one JSON object per line"""
+        for row in rows:
+            yield json.dumps(row) + "\n"
+    
+    @staticmethod
+    def register_response(payroll_records, filename, file_format="xlsx"):
+        """Streaming download of the register of a PayrollRecord queryset"""
+        rows = PayrollExcelService.register_rows(payroll_records)
+        content_type = PayrollExcelService.CONTENT_TYPES[file_format]
         
-        response = HttpResponse(
-            output.getvalue(),
-            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        )
-        response["Content-Disposition"] = f'attachment; filename="payroll_{month}_{year}.xlsx"'
+        if file_format in ("csv", "ndjson"):
+            iterate = PayrollExcelService.iter_csv if file_format == "csv" else PayrollExcelService.iter_ndjson
+            response = StreamingHttpResponse(iterate(rows), content_type=content_type)
+            response["Content-Disposition"] = f'attachment; filename="{filename}.{file_format}"'
+            return response
         
-        return response
+        # Spooled to disk, streamed back in chunks; FileResponse closes (and so deletes) the file
+        output = tempfile.TemporaryFile()
+        PayrollExcelService.write_xlsx(rows, output, title=filename[:31])  # Sheet titles are capped at 31 characters
+        output.seek(0)
+        return FileResponse(output, as_attachment=True, filename=f"{filename}.xlsx", content_type=content_type)
+    
+    @staticmethod
+    def generate_payroll_excel(payroll_records, month, year):
+        """Generate comprehensive payroll Excel report"""
+        return PayrollExcelService.register_response(payroll_records, f"payroll_{month}_{year}", "xlsx")
     
     @staticmethod
     def generate_sample_excel(component_type='deduction'):
@@ -0,0 +1,204 @@
+"""
+Benchmark: serial vs process-pool payroll calculation (PayrollBatch.run).
+
+A synthetic, fully loaded PayrollBatch is built in memory (unsaved model
+instances, nothing is written to the database): N employees over a mix of
+salary structures, overrides, advances, approved leaves, a weekly off, a
+holiday and a month of daily attendance. The same batch is then calculated
+serially and with process pools of increasing size; every parallel result is
+checked against the serial one.
+
+Reported per mode: pool start-up seconds (spawning workers and setting up
+Django, paid once per payroll run), calculation wall-clock seconds, employees
+per second and speedup over serial, without and with the start-up.
+
+Usage (from Backend/core):
+    python PayrollSystem/payroll_parallel_benchmark.py [--employees 10000] [--workers 2 4 8] [--shard-size 250]
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+from decimal import Decimal
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+django.setup()
+
+from AuthN.models import BaseUserModel, UserProfile
+from Holiday.models import Holiday
+from LeaveControl.models import LeaveApplication, LeaveType
+from ServiceWeekOff.models import WeekOffPolicy
+from PayrollSystem.models import (
+    PayrollSettings, SalaryComponent, SalaryStructure, StructureComponent,
+    EmployeeAdvance, ProfessionalTaxSlab, TDSSlab
+)
+from PayrollSystem.payroll_batch import AttendanceDay, PayrollBatch, ShiftDuration
+from PayrollSystem.payroll_calculator import PayrollCalculator
+from PayrollSystem.tax_slab_registry import ProfessionalTaxTable, TDSTable
+
+
+def _as_loaded(instance):
+    """Unsaved instances keep DecimalField defaults as floats; the database returns Decimals"""
+    for field in instance._meta.concrete_fields:
+        if field.get_internal_type() == 'DecimalField':
+            value = getattr(instance, field.attname)
+            if value is not None:
+                setattr(instance, field.attname, field.to_python(value))
+    return instance
+
+
+def _synthetic_batch(employee_count, month=1, year=2025):
+    organization = BaseUserModel(id=uuid.uuid4(), email='org@bench.local', username='org', role='organization')
+    admin = BaseUserModel(id=uuid.uuid4(), email='admin@bench.local', username='admin', role='admin')
+    batch = PayrollBatch(organization, month, year, admin=admin)
+
+    batch.settings = _as_loaded(PayrollSettings(id=1, organization=organization, admin=admin, pt_state='Maharashtra', esi_enabled=True))
+    batch._pt_tables['Maharashtra'] = ProfessionalTaxTable([
+        ProfessionalTaxSlab(id=1, state='Maharashtra', salary_from=Decimal('0'), salary_to=Decimal('7500'), tax_amount=Decimal('0')),
+        ProfessionalTaxSlab(id=2, state='Maharashtra', salary_from=Decimal('7501'), salary_to=Decimal('10000'), tax_amount=Decimal('175')),
+        ProfessionalTaxSlab(id=3, state='Maharashtra', salary_from=Decimal('10001'), salary_to=None, tax_amount=Decimal('200')),
+    ])
+    financial_year = PayrollCalculator.financial_year()
+    batch._tds_tables[financial_year] = {
+        age_group: TDSTable([
+            TDSSlab(financial_year=financial_year, age_group=age_group, income_from=Decimal(low), income_to=high, tax_rate=Decimal(rate))
+            for low, high, rate in [('0', Decimal('300000'), '0'), ('300001', Decimal('700000'), '5'),
+                                    ('700001', Decimal('1000000'), '10'), ('1000001', None, '20')]
+        ])
+        for age_group in ('general', 'senior', 'super_senior')
+    }
+
+    components = {}
+    for index, (code, component_type, calculation_type, value, pf, esi) in enumerate([
+        ('BASIC', 'earning', 'fixed', None, True, True),
+        ('HRA', 'earning', 'percentage', Decimal('40'), False, True),
+        ('SPECIAL_ALLOWANCE', 'earning', 'fixed', None, False, True),
+        ('CONVEYANCE', 'earning', 'fixed', None, False, False),
+        ('BONUS', 'earning', 'fixed', None, False, False),
+        ('CANTEEN', 'deduction', 'fixed', None, False, False),
+    ], start=1):
+        components[code] = SalaryComponent(
+            id=index, organization=organization, name=code, code=code, component_type=component_type,
+            calculation_type=calculation_type, calculation_value=value,
+            is_pf_applicable=pf, is_esi_applicable=esi, priority=index
+        )
+
+    structures = []
+    for index, basic in enumerate([Decimal('12000'), Decimal('25000'), Decimal('60000')], start=1):
+        structure = SalaryStructure(id=index, organization=organization, name=f"Band {index}")
+        batch.structure_components[structure.id] = [
+            StructureComponent(id=index * 10 + position, structure=structure, component=components[code], amount=amount)
+            for position, (code, amount) in enumerate([
+                ('BASIC', basic), ('HRA', Decimal('0')), ('SPECIAL_ALLOWANCE', basic / 2),
+                ('CONVEYANCE', Decimal('1600')), ('BONUS', Decimal('1000')), ('CANTEEN', Decimal('450')),
+            ])
+        ]
+        structures.append(structure)
+
+    shift = ShiftDuration(duration_minutes=540)
+    week_off = WeekOffPolicy(id=1, admin=admin, week_days=['Sunday'], week_off_cycle=[1, 2, 3, 4, 5])
+    paid_leave = LeaveType(id=1, admin=admin, name='Casual', code='CL', is_paid=True)
+    unpaid_leave = LeaveType(id=2, admin=admin, name='Leave Without Pay', code='LWP', is_paid=False)
+    first_day = date(year, month, 1)
+    batch.holidays = [Holiday(id=1, admin=admin, organization=organization, name='Holiday', holiday_date=first_day + timedelta(days=13))]
+
+    for i in range(employee_count):
+        user = BaseUserModel(id=uuid.uuid4(), email=f"employee{i}@bench.local", username=f"employee{i}", role='user')
+        profile = UserProfile(
+            id=uuid.uuid4(), user=user, admin=admin, organization=organization, user_name=f"Employee {i:05d}",
+            gender='Male', date_of_joining=date(2020, 1, 1), date_of_birth=date(1960 + i % 40, 6, 1)
+        )
+        profile.active_week_offs = [week_off]
+        batch.profiles.append(profile)
+
+        batch.structures[user.id] = structures[i % len(structures)]
+        if i % 4 == 0:
+            batch.overrides[user.id] = {components['BASIC'].id: Decimal(20000 + i % 5000)}
+        if i % 10 == 0:
+            batch.advances[user.id] = [_as_loaded(EmployeeAdvance(
+                id=i, employee=user, admin=admin, advance_type='loan' if i % 20 else 'advance',
+                amount=Decimal('10000'), remaining_amount=Decimal('6000'), installment_amount=Decimal('2000'),
+                advance_date=first_day, status='approved'
+            ))]
+        if i % 3 == 0:
+            batch.leaves[user.id] = [LeaveApplication(
+                id=i, admin=admin, organization=organization, user=user,
+                leave_type=paid_leave if i % 2 else unpaid_leave,
+                from_date=first_day + timedelta(days=5), to_date=first_day + timedelta(days=6),
+                total_days=Decimal('2'), status='approved'
+            )]
+
+        days = {}
+        for day in range(28):
+            attendance_date = first_day + timedelta(days=day)
+            if (i + day) % 11 == 0:
+                continue  # absent
+            late_minutes = (i + day) % 25
+            days[attendance_date] = AttendanceDay(
+                attendance_date=attendance_date, attendance_status='present',
+                total_working_minutes=540 + (i + day) % 90, is_late=late_minutes > 10, late_minutes=late_minutes,
+                is_early_exit=(i + day) % 13 == 0, early_exit_minutes=15 if (i + day) % 13 == 0 else 0, assign_shift=shift
+            )
+        batch.attendance[user.id] = days
+
+    batch._loaded = True
+    return batch
+
+
+def _warm_up(_):
+    time.sleep(0.1)  # Keeps one worker from taking every warm-up task
+    return os.getpid()
+
+
+def _timed(batch, pool=None, shard_size=None):
+    started = time.perf_counter()
+    results = {profile.user_id: (payroll_data, str(error) if error else None)
+               for profile, payroll_data, error in batch.run(pool=pool, shard_size=shard_size)}
+    return time.perf_counter() - started, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--employees', type=int, default=10000, help="Synthetic employees (default: 10000)")
+    parser.add_argument('--workers', type=int, nargs='+', default=None,
+                        help="Pool sizes (>= 2) to measure (default: 2, 4, ... up to the CPU count)")
+    parser.add_argument('--shard-size', type=int, default=250, help="Employees per worker task (default: 250)")
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    # A pool of one is not a parallel mode (process_pool() returns None for it)
+    pool_sizes = args.workers or [n for n in (2, 4, 8, 16, 32) if n <= max(cpus, 2)]
+    pool_sizes = [n for n in pool_sizes if n >= 2]
+
+    batch = _synthetic_batch(args.employees)
+    serial_seconds, expected = _timed(batch)
+    failed = sum(1 for _, error in expected.values() if error)
+    if failed:
+        raise SystemExit(f"{failed} synthetic employees failed to calculate")
+
+    print(f"{args.employees} employees, {cpus} CPU(s), shard size {args.shard_size}")
+    print(f"{'mode':<12}{'start-up s':>12}{'calc s':>10}{'employees/s':>14}{'speedup':>10}{'incl. start-up':>16}")
+    print(f"{'serial':<12}{0.0:>12.2f}{serial_seconds:>10.2f}{args.employees / serial_seconds:>14.0f}{1.0:>10.2f}{1.0:>16.2f}")
+    for workers in pool_sizes:
+        started = time.perf_counter()
+        pool = PayrollBatch.process_pool(workers)
+        try:
+            # Start every worker before timing the calculation
+            list(pool.map(_warm_up, range(workers)))
+            startup_seconds = time.perf_counter() - started
+            seconds, results = _timed(batch, pool, args.shard_size)
+        finally:
+            pool.shutdown()
+        if results != expected:
+            raise SystemExit(f"{workers} workers: results differ from the serial calculation")
+        print(f"{f'{workers} workers':<12}{startup_seconds:>12.2f}{seconds:>10.2f}{args.employees / seconds:>14.0f}"
+              f"{serial_seconds / seconds:>10.2f}{serial_seconds / (seconds + startup_seconds):>16.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Process pools for payroll calculation and payslip rendering.
+
+Workers are spawned, so each one imports what it runs from scratch. This
+module imports nothing from Django at load time: unpickling the pool's
+initializer imports it before Django is set up, and a module with model
+imports (payroll_batch) would fail there with AppRegistryNotReady.
+
+Outside Celery the pool is a ProcessPoolExecutor. A Celery prefork child is
+daemonic, and multiprocessing refuses to start processes from it, so there
+the pool is a billiard pool (Celery's multiprocessing fork, which allows it)
+behind the same map/shutdown calls.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def init_worker():
+    """Pool initializer: spawned workers start without Django set up"""
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+    django.setup()
+
+
+class BilliardPool:
+    """The ProcessPoolExecutor calls the payroll code makes (map, shutdown) over a billiard pool"""
+
+    def __init__(self, workers):
+        import billiard
+
+        self._pool = billiard.get_context('spawn').Pool(processes=workers, initializer=init_worker)
+
+    def map(self, fn, iterable, chunksize=1):
+        return self._pool.map(fn, list(iterable), chunksize)
+
+    def shutdown(self, wait=True):
+        self._pool.close()
+        if wait:
+            self._pool.join()
+
+
+def process_pool(workers):
+    """A pool of `workers` spawned processes, or None when workers <= 1 or no pool can be started here"""
+    if workers <= 1:
+        return None
+    if multiprocessing.current_process().daemon:
+        try:
+            return BilliardPool(workers)
+        except ImportError:
+            logger.warning("Process pool unavailable in a daemonic process without billiard; running serially")
+            return None
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker
+    )
@@ -0,0 +1,223 @@
+"""
+Persistence of calculated payroll (PayrollRecord + PayrollComponentEntry).
+
+Shared by GeneratePayrollAPIView, UpdatePayrollReportView and the background
+PayrollRun runner, so all of them write records the same way. The
+organization's SalaryComponent map and the month's existing records are read
+once per writer; records are queued with add() and written by flush() with a
+bulk insert for the records and one for their component entries.
+
+With upsert=True, employees that already have a record for the month get it
+updated in place (same id, status, remarks and payslip fields) and their
+component entries replaced, instead of failing on the unique constraint.
+"""
+from datetime import date
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import PayrollRecord, PayrollComponentEntry, SalaryComponent
+
+
+def json_safe(value):
+    """Decimals (nested in dicts/lists) as floats, so breakdowns can be stored in JSONField"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    return value
+
+
+class PayrollRecordWriter:
+
+    # Calculated fields refreshed when an existing record is upserted
+    UPSERT_FIELDS = [
+        'admin', 'payroll_date', 'total_days', 'present_days', 'absent_days', 'leave_days', 'working_days',
+        'overtime_hours', 'basic_salary', 'hra', 'special_allowance', 'overtime_amount', 'gross_salary',
+        'pf_employee', 'esi_employee', 'professional_tax', 'tds', 'advance_deduction', 'loan_deduction',
+        'total_deductions', 'net_salary', 'earnings_breakdown', 'deductions_breakdown', 'is_stale', 'updated_at'
+    ]
+
+    def __init__(self, organization, month, year, created_by=None, upsert=False, batch_size=None):
+        self.organization = organization
+        self.month = month
+        self.year = year
+        self.payroll_date = date(year, month, 1)
+        self.created_by = created_by
+        self.upsert = upsert
+        self.batch_size = batch_size or getattr(settings, 'PAYROLL_WRITE_BATCH_SIZE', 500)
+        self.components_by_code = {
+            component.code: component
+            for component in SalaryComponent.objects.filter(organization=organization)
+        }
+        self.existing_record_ids = {}  # {employee_id: record id}
+        self._pending = []  # [(user_profile, record, entries)]
+
+    def existing_employee_ids(self, user_ids):
+        """
+        Employees (from an id list or values('user_id') subquery) that already have a record
+        for the month. Their record ids are remembered so add() can upsert them.
+        """
+        existing = dict(
+            PayrollRecord.objects.filter(
+                employee_id__in=user_ids,
+                payroll_month=self.month,
+                payroll_year=self.year
+            ).values_list('employee_id', 'id')
+        )
+        self.existing_record_ids.update(existing)
+        return set(existing)
+
+    def build_record(self, user_profile, payroll_data):
+        """Unsaved PayrollRecord for one employee's calculate_payroll() result"""
+        attendance_data = payroll_data['attendance_data']
+        earnings = payroll_data['earnings']
+        deductions = payroll_data['deductions']
+        return PayrollRecord(
+            employee=user_profile.user,
+            admin=user_profile.admin,
+            organization=user_profile.organization,
+            payroll_month=self.month,
+            payroll_year=self.year,
+            payroll_date=self.payroll_date,
+            total_days=attendance_data.get('total_days', 0),
+            present_days=attendance_data.get('present_days', 0),
+            absent_days=attendance_data.get('absent_days', 0),
+            leave_days=attendance_data.get('leave_days', 0),
+            working_days=attendance_data.get('working_days', 0),
+            overtime_hours=attendance_data.get('overtime_hours', 0),
+            basic_salary=earnings.get('BASIC', {}).get('amount', 0),
+            hra=earnings.get('HRA', {}).get('amount', 0),
+            special_allowance=earnings.get('SPECIAL_ALLOWANCE', {}).get('amount', 0),
+            overtime_amount=earnings.get('OVERTIME', {}).get('amount', 0),
+            gross_salary=payroll_data['gross_salary'],
+            pf_employee=deductions.get('PF_EMPLOYEE', {}).get('amount', 0),
+            esi_employee=deductions.get('ESI_EMPLOYEE', {}).get('amount', 0),
+            professional_tax=deductions.get('PROFESSIONAL_TAX', {}).get('amount', 0),
+            tds=deductions.get('TDS', {}).get('amount', 0),
+            advance_deduction=deductions.get('ADVANCE', {}).get('amount', 0),
+            loan_deduction=deductions.get('LOAN', {}).get('amount', 0),
+            total_deductions=payroll_data['total_deductions'],
+            net_salary=payroll_data['net_salary'],
+            earnings_breakdown=json_safe({
+                **earnings,
+                'calculation_summary': payroll_data.get('calculation_summary', {})
+            }),
+            deductions_breakdown=json_safe({
+                **deductions,
+                'attendance_details': {
+                    'leave_days': attendance_data.get('leave_days', 0),
+                    'lop_days': attendance_data.get('lop_days', 0),
+                    'half_day_leaves': attendance_data.get('half_day_leaves', 0),
+                    'week_off_days': attendance_data.get('week_off_days', 0),
+                    'holiday_days': attendance_data.get('holiday_days', 0),
+                    'sandwich_absent_days': attendance_data.get('sandwich_absent_days', 0),
+                    'payable_days': attendance_data.get('payable_days', 0),
+                    'late_days': attendance_data.get('late_days', 0),
+                    'early_exit_days': attendance_data.get('early_exit_days', 0),
+                    'total_late_minutes': attendance_data.get('total_late_minutes', 0),
+                    'total_early_exit_minutes': attendance_data.get('total_early_exit_minutes', 0)
+                }
+            }),
+            status='processed',
+            created_by=self.created_by
+        )
+
+    def build_entries(self, payroll_record, payroll_data):
+        """Unsaved component entries for the codes that exist as SalaryComponents of the organization"""
+        entries = []
+        for breakdown, is_earning in ((payroll_data['earnings'], True), (payroll_data['deductions'], False)):
+            for code, comp_data in breakdown.items():
+                component = self.components_by_code.get(code)
+                if component:
+                    entries.append(PayrollComponentEntry(
+                        payroll=payroll_record,
+                        component=component,
+                        amount=comp_data['amount'],
+                        is_earning=is_earning
+                    ))
+        return entries
+
+    def is_unchanged(self, payroll_record, user_profile, payroll_data):
+        """True if recalculating would store the same figures and breakdowns as the saved record"""
+        recalculated = self.build_record(user_profile, payroll_data)
+        return all(
+            getattr(recalculated, field) == getattr(payroll_record, field)
+            for field in self.UPSERT_FIELDS
+            if field not in ('admin', 'payroll_date', 'is_stale', 'updated_at')
+        )
+
+    def add(self, user_profile, payroll_data):
+        """Queue one employee's record and entries for the next flush(); returns the unsaved record"""
+        payroll_record = self.build_record(user_profile, payroll_data)
+        existing_id = self.existing_record_ids.get(user_profile.user_id)
+        if self.upsert and existing_id:
+            payroll_record.id = existing_id
+        self._pending.append((user_profile, payroll_record, self.build_entries(payroll_record, payroll_data)))
+        return payroll_record
+
+    def _write(self, records, entries):
+        if self.upsert:
+            PayrollComponentEntry.objects.filter(payroll_id__in=[record.id for record in records]).delete()
+            PayrollRecord.objects.bulk_create(
+                records, batch_size=self.batch_size, update_conflicts=True,
+                unique_fields=['employee', 'payroll_month', 'payroll_year'], update_fields=self.UPSERT_FIELDS
+            )
+            # A record created since existing_employee_ids() was read keeps its own id on conflict
+            stored_ids = dict(
+                PayrollRecord.objects.filter(
+                    employee_id__in=[record.employee_id for record in records],
+                    payroll_month=self.month,
+                    payroll_year=self.year
+                ).values_list('employee_id', 'id')
+            )
+            for record in records:
+                if stored_ids.get(record.employee_id, record.id) != record.id:
+                    record.id = stored_ids[record.employee_id]
+                    PayrollComponentEntry.objects.filter(payroll_id=record.id).delete()
+            for entry in entries:
+                entry.payroll_id = entry.payroll.id
+        else:
+            PayrollRecord.objects.bulk_create(records, batch_size=self.batch_size)
+        PayrollComponentEntry.objects.bulk_create(entries, batch_size=self.batch_size)
+
+    def flush(self):
+        """
+        Write every queued record. Returns (written, failed): the written [(user_profile, record)]
+        and [(user_profile, error)]. If the bulk write fails, the batch is retried row by row
+        under savepoints so one bad row does not lose the others.
+        """
+        pending, self._pending = self._pending, []
+        if not pending:
+            return [], []
+
+        try:
+            with transaction.atomic():
+                self._write(
+                    [record for _, record, _ in pending],
+                    [entry for _, _, entries in pending for entry in entries]
+                )
+            return [(user_profile, record) for user_profile, record, _ in pending], []
+        except Exception:
+            pass
+
+        written, failed = [], []
+        for user_profile, record, entries in pending:
+            try:
+                with transaction.atomic():
+                    self._write([record], entries)
+                written.append((user_profile, record))
+            except Exception as e:
+                failed.append((user_profile, e))
+        return written, failed
+
+    def save(self, user_profile, payroll_data):
+        """Write one employee's record and entries right away; raises if the write fails"""
+        self.add(user_profile, payroll_data)
+        written, failed = self.flush()
+        if failed:
+            raise failed[0][1]
+        return written[0][1]
@@ -0,0 +1,217 @@
+"""
+Background payroll generation (PayrollRun).
+
+Employees are walked in (user_name, id) order, PAYROLL_RUN_CHUNK_SIZE at a
+time. Each chunk is calculated with a PayrollBatch, written, and committed
+together with the run's counters and checkpoint, so a worker that dies loses
+at most the chunk in flight and a retry resumes right after the checkpoint.
+Employees that already have a record for the month are skipped (or, for a
+regenerate run, recalculated and upserted), which keeps re-processing a chunk
+harmless. With PAYROLL_PARALLEL_WORKERS > 1, each
+chunk's calculation is sharded over a process pool kept for the whole run.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import PayrollRun
+from .payroll_batch import PayrollBatch
+from .payroll_record_writer import PayrollRecordWriter
+
+logger = logging.getLogger(__name__)
+
+
+class PayrollRunService:
+
+    ACTIVE_STATUSES = ('pending', 'running')
+    MAX_STORED_ERRORS = 200
+
+    @staticmethod
+    def employees(run):
+        """UserProfile queryset of the run's employees"""
+        return PayrollBatch(
+            run.organization, run.payroll_month, run.payroll_year,
+            admin=run.admin, employee_ids=run.employee_ids
+        ).employees()
+
+    @staticmethod
+    def active_run(organization, month, year, admin=None):
+        """Pending or running run for the same organization, admin and month, if any"""
+        return PayrollRun.objects.filter(
+            organization=organization,
+            admin=admin,
+            payroll_month=month,
+            payroll_year=year,
+            status__in=PayrollRunService.ACTIVE_STATUSES
+        ).first()
+
+    @staticmethod
+    def create(organization, month, year, admin=None, employee_ids=None, created_by=None, regenerate=False):
+        """
+        Pending run for the month. Raises IntegrityError when the organization (or admin) already
+        has an active run for it (the uniq_active_payroll_run_* constraints).
+        """
+        run = PayrollRun(
+            organization=organization,
+            admin=admin,
+            employee_ids=[str(employee_id) for employee_id in employee_ids or []],
+            regenerate=regenerate,
+            payroll_month=month,
+            payroll_year=year,
+            created_by=created_by
+        )
+        run.total_employees = PayrollRunService.employees(run).count()
+        with transaction.atomic():
+            run.save()
+        return run
+
+    @staticmethod
+    def claim(run_id):
+        """
+        Mark the run as running for this worker. A pending or failed run can be claimed,
+        and so can a running one whose heartbeat is older than PAYROLL_RUN_STALE_MINUTES
+        (its worker died). Returns the run, or None if another worker owns it or it is done.
+        """
+        now = timezone.now()
+        stale_before = now - timedelta(minutes=getattr(settings, 'PAYROLL_RUN_STALE_MINUTES', 15))
+        try:
+            with transaction.atomic():
+                claimed = PayrollRun.objects.filter(id=run_id).filter(
+                    Q(status__in=['pending', 'failed']) |
+                    Q(status='running', heartbeat_at__lt=stale_before) |
+                    Q(status='running', heartbeat_at__isnull=True, started_at__lt=stale_before)
+                ).update(status='running', heartbeat_at=now, error=None)
+        except IntegrityError:
+            # A failed run being resumed while a newer run of the same month is active
+            logger.warning(f"Payroll run {run_id} not resumed: another run of its month is active")
+            return None
+        if not claimed:
+            return None
+
+        run = PayrollRun.objects.select_related('organization', 'admin', 'created_by').get(id=run_id)
+        if run.started_at is None:
+            run.started_at = now
+            run.save(update_fields=['started_at'])
+        return run
+
+    @staticmethod
+    def _next_chunk(employees, checkpoint, size):
+        """[(user_id, user_name, profile id)] after the checkpoint"""
+        if checkpoint:
+            user_name, profile_id = checkpoint
+            employees = employees.filter(Q(user_name__gt=user_name) | Q(user_name=user_name, id__gt=profile_id))
+        return list(employees.order_by('user_name', 'id').values_list('user_id', 'user_name', 'id')[:size])
+
+    @staticmethod
+    def _process_chunk(run, writer, chunk, pool=None):
+        user_ids = [user_id for user_id, _, _ in chunk]
+        generated = skipped = failed = 0
+        errors = []
+
+        with transaction.atomic():
+            batch = PayrollBatch(
+                run.organization, run.payroll_month, run.payroll_year,
+                admin=run.admin, employee_ids=user_ids
+            )
+            existing_employee_ids = writer.existing_employee_ids(user_ids)
+            if not run.regenerate:
+                # Skipped without being calculated
+                batch.exclude(existing_employee_ids)
+                skipped = len(existing_employee_ids)
+            batch.load()
+
+            for user_profile, payroll_data, error in batch.run(pool=pool):
+                employee = user_profile.user
+                if error is not None:
+                    failed += 1
+                    errors.append(f"Error for {employee.email}: {str(error)}")
+                    continue
+                writer.add(user_profile, payroll_data)
+
+            written, write_failures = writer.flush()
+            generated += len(written)
+            failed += len(write_failures)
+            errors.extend(f"Error for {user_profile.user.email}: {str(error)}" for user_profile, error in write_failures)
+
+            _, last_user_name, last_profile_id = chunk[-1]
+            run.processed_count += len(chunk)
+            run.generated_count += generated
+            run.skipped_count += skipped
+            run.failed_count += failed
+            run.errors = (run.errors + errors)[:PayrollRunService.MAX_STORED_ERRORS]
+            run.checkpoint = [last_user_name, str(last_profile_id)]
+            run.heartbeat_at = timezone.now()
+            run.save(update_fields=[
+                'processed_count', 'generated_count', 'skipped_count', 'failed_count',
+                'errors', 'checkpoint', 'heartbeat_at'
+            ])
+
+    @staticmethod
+    def process(run_id, chunk_size=None):
+        """Process a run from its checkpoint to the end. Returns the run, or None if it could not be claimed."""
+        run = PayrollRunService.claim(run_id)
+        if run is None:
+            return None
+
+        chunk_size = chunk_size or getattr(settings, 'PAYROLL_RUN_CHUNK_SIZE', 200)
+        pool = PayrollBatch.process_pool()
+        try:
+            writer = PayrollRecordWriter(
+                run.organization, run.payroll_month, run.payroll_year,
+                created_by=run.created_by, upsert=run.regenerate
+            )
+            employees = PayrollRunService.employees(run)
+            while True:
+                chunk = PayrollRunService._next_chunk(employees, run.checkpoint, chunk_size)
+                if not chunk:
+                    break
+                PayrollRunService._process_chunk(run, writer, chunk, pool)
+
+            run.status = 'completed'
+            run.completed_at = timezone.now()
+            # Employees added while the run was going are counted as they are processed
+            run.total_employees = max(run.total_employees, run.processed_count)
+            run.save(update_fields=['status', 'completed_at', 'total_employees'])
+        except Exception as e:
+            logger.error(f"Payroll run {run_id} stopped at checkpoint {run.checkpoint}: {str(e)}")
+            run.status = 'failed'
+            run.error = str(e)
+            run.save(update_fields=['status', 'error'])
+        finally:
+            if pool:
+                pool.shutdown()
+        return run
+
+    @staticmethod
+    def progress(run):
+        """Progress payload for the polling endpoint, with a throughput-based ETA"""
+        percent = round(run.processed_count * 100 / run.total_employees, 1) if run.total_employees else 0.0
+        eta_seconds = None
+        if run.status == 'running' and run.started_at and run.processed_count:
+            elapsed = (timezone.now() - run.started_at).total_seconds()
+            remaining = max(run.total_employees - run.processed_count, 0)
+            eta_seconds = int(elapsed / run.processed_count * remaining)
+
+        return {
+            "run_id": str(run.id),
+            "status": run.status,
+            "month": run.payroll_month,
+            "year": run.payroll_year,
+            "admin_id": str(run.admin_id) if run.admin_id else None,
+            "total_employees": run.total_employees,
+            "processed_count": run.processed_count,
+            "generated_count": run.generated_count,
+            "skipped_count": run.skipped_count,
+            "failed_count": run.failed_count,
+            "percent_complete": min(percent, 100.0),
+            "eta_seconds": eta_seconds,
+            "errors": run.errors,
+            "error": run.error,
+            "created_at": run.created_at,
+            "started_at": run.started_at,
+            "completed_at": run.completed_at
+        }
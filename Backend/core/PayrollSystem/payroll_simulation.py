@@ -0,0 +1,370 @@
+"""
+What-if payroll simulation.
+
+Answers questions like "what does a lower PF ceiling or a new HRA percentage
+cost across the organization?" without touching PayrollRecords. A
+PayrollSnapshot loads a month's inputs once (a PayrollBatch plus every salary
+structure and component of the organization), counts each employee's
+attendance once and calculates the baseline payroll. A scenario then only
+swaps copies of the overridden settings, components and structure lines into
+a variant of the batch and recalculates, so repeated scenarios on the same
+month reuse everything that did not change. Nothing is written to the
+database.
+
+Snapshots live in a small process-local LRU (PAYROLL_SIMULATION_SNAPSHOTS)
+and are rebuilt after PAYROLL_SIMULATION_SNAPSHOT_TTL_SECONDS or on request
+(refresh), so a simulation may lag edits made since the snapshot was built.
+
+A scenario is a dict of:
+    settings     {field: value} on the month's PayrollSettings
+    components   {component code: {field: value}} on SalaryComponents
+    structures   {structure id: {component code: amount or None}}; a new code
+                 adds the component to the structure, None removes it
+    assignments  {employee id: structure id} moves employees to other structures
+
+An employee whose payroll fails on one side only (e.g. no salary structure
+before an assignment) counts as paying nothing on that side.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from .models import PayrollSettings, SalaryComponent, SalaryStructure, StructureComponent
+from .payroll_batch import BatchAttendanceCalculation, BatchPayrollCalculator, PayrollBatch
+
+TOTAL_FIELDS = ('gross_salary', 'total_deductions', 'net_salary')
+EMPTY_PAYROLL = {'earnings': {}, 'deductions': {}, **{field: Decimal('0.00') for field in TOTAL_FIELDS}}
+
+
+class ScenarioError(ValueError):
+    """A scenario refers to unknown fields, components, structures or employees, or has invalid values"""
+
+
+class _SnapshotAttendance:
+    """Stands in for the attendance service with an employee's counters from the snapshot"""
+
+    def __init__(self, detailed_attendance=None, error=None):
+        self.detailed_attendance = detailed_attendance
+        self.error = error
+
+    def calculate_detailed_attendance(self):
+        if self.error is not None:
+            raise self.error
+        return self.detailed_attendance
+
+
+class SimulationPayrollCalculator(BatchPayrollCalculator):
+    """BatchPayrollCalculator reusing the attendance counted when the snapshot was built"""
+
+    def __init__(self, snapshot, batch, profile):
+        self.snapshot = snapshot
+        super().__init__(batch, profile)
+
+    def _get_attendance_service(self):
+        return self.snapshot.attendance[self.profile.user_id]
+
+
+class PayrollSnapshot:
+    """
+    Immutable inputs and baseline payroll of an organization (or one admin's
+    employees) for a month. Scenarios never modify it: overridden objects are copies.
+    """
+
+    def __init__(self, organization, month, year, admin=None):
+        self.organization = organization
+        self.month = month
+        self.year = year
+        self.admin = admin
+        self.built_at = timezone.now()
+
+        self.batch = PayrollBatch(organization, month, year, admin=admin).load()
+
+        # Every structure and component of the organization, so scenarios can also
+        # move employees to structures nobody is on yet and add components to structures
+        self.structures_by_id = {
+            structure.id: structure for structure in SalaryStructure.objects.filter(organization=organization)
+        }
+        self.components_by_code = {
+            component.code: component for component in SalaryComponent.objects.filter(organization=organization)
+        }
+        structure_components = defaultdict(list)
+        for comp in StructureComponent.objects.filter(
+            structure_id__in=list(self.structures_by_id),
+            is_active=True
+        ).select_related('component').order_by('component__priority'):
+            structure_components[comp.structure_id].append(comp)
+        self.structure_components = dict(structure_components)
+
+        self.attendance = {}
+        for profile in self.batch.profiles:
+            try:
+                detailed = BatchAttendanceCalculation(self.batch, profile).calculate_detailed_attendance()
+                self.attendance[profile.user_id] = _SnapshotAttendance(detailed)
+            except Exception as e:
+                self.attendance[profile.user_id] = _SnapshotAttendance(error=e)
+
+        self.baseline = self.calculate(self.batch)
+
+    def calculate(self, batch):
+        """{user_id: (payroll_data, error message)} of every employee, calculated from `batch`"""
+        results = {}
+        for profile in batch.profiles:
+            try:
+                results[profile.user_id] = (SimulationPayrollCalculator(self, batch, profile).calculate_payroll(), None)
+            except Exception as e:
+                results[profile.user_id] = (None, str(e))
+        return results
+
+    def scenario_batch(self, scenario):
+        """Variant of the snapshot's batch with the scenario's overrides applied to copies"""
+        scenario = self._object(scenario, "scenario")
+        unknown = set(scenario) - {'settings', 'components', 'structures', 'assignments'}
+        if unknown:
+            raise ScenarioError(f"Unknown scenario keys: {', '.join(sorted(unknown))}")
+
+        component_changes = self._object(scenario.get('components'), "components")
+        components = {
+            code: PayrollSimulation.overridden(component, component_changes[code], PayrollSimulation.COMPONENT_FIELDS, f"component {code}")
+            for code, component in self._components(component_changes).items()
+        }
+        line_changes = self._line_changes(self._object(scenario.get('structures'), "structures"))
+
+        structure_components = dict(self.structure_components)
+        for structure_id, lines in self.structure_components.items():
+            if structure_id in line_changes or any(comp.component.code in components for comp in lines):
+                structure_components[structure_id] = self._lines(structure_id, lines, components, line_changes.get(structure_id, {}))
+        for structure_id, changes in line_changes.items():
+            if structure_id not in self.structure_components:
+                structure_components[structure_id] = self._lines(structure_id, [], components, changes)
+
+        return self.batch.variant(
+            settings=self._settings(scenario.get('settings')),
+            structures=self._structures(self._object(scenario.get('assignments'), "assignments")),
+            structure_components=structure_components
+        )
+
+    @staticmethod
+    def _object(value, label):
+        """`value` as a dict ({} when empty); anything else is an invalid scenario"""
+        if not value:
+            return {}
+        if not isinstance(value, dict):
+            raise ScenarioError(f"{label}: expected an object")
+        return value
+
+    def _settings(self, changes):
+        if not changes:
+            return self.batch.settings
+        base = self.batch.settings or PayrollSettings(organization=self.organization, admin=self.admin)
+        return PayrollSimulation.overridden(base, changes, PayrollSimulation.settings_fields(), "settings")
+
+    def _components(self, changes):
+        missing = [code for code in changes if code not in self.components_by_code]
+        if missing:
+            raise ScenarioError(f"Unknown salary components: {', '.join(missing)}")
+        return {code: self.components_by_code[code] for code in changes}
+
+    def _line_changes(self, structures):
+        """{structure id: {component code: Decimal amount or None}}"""
+        amount_field = StructureComponent._meta.get_field('amount')
+        line_changes = {}
+        for structure_id, lines in structures.items():
+            try:
+                structure_id = int(structure_id)
+            except (TypeError, ValueError):
+                raise ScenarioError(f"Invalid structure id: {structure_id}")
+            if structure_id not in self.structures_by_id:
+                raise ScenarioError(f"Unknown salary structure: {structure_id}")
+            lines = self._object(lines, f"structure {structure_id}")
+            self._components(lines)
+            line_changes[structure_id] = {
+                code: None if amount is None else PayrollSimulation.clean(amount_field, amount, f"structure {structure_id} {code}")
+                for code, amount in lines.items()
+            }
+        return line_changes
+
+    def _lines(self, structure_id, lines, components, changes):
+        """Copies of a structure's component lines with overridden components and amounts"""
+        result = []
+        for comp in lines:
+            code = comp.component.code
+            if code in changes and changes[code] is None:
+                continue
+            if code in components or code in changes:
+                comp = copy.copy(comp)
+                comp.component = components.get(code, comp.component)
+                if code in changes:
+                    comp.amount = changes[code]
+            result.append(comp)
+
+        present = {comp.component.code for comp in lines}
+        for code, amount in changes.items():
+            if amount is not None and code not in present:
+                result.append(StructureComponent(
+                    structure_id=structure_id,
+                    component=components.get(code, self.components_by_code[code]),
+                    amount=amount
+                ))
+        # Same order as the calculation's query: component priority
+        return sorted(result, key=lambda comp: comp.component.priority)
+
+    def _structures(self, assignments):
+        if not assignments:
+            return self.batch.structures
+        user_ids = {str(profile.user_id): profile.user_id for profile in self.batch.profiles}
+        structures = dict(self.batch.structures)
+        for employee_id, structure_id in assignments.items():
+            if str(employee_id) not in user_ids:
+                raise ScenarioError(f"Employee {employee_id} is not part of this payroll")
+            try:
+                structures[user_ids[str(employee_id)]] = self.structures_by_id[int(structure_id)]
+            except (KeyError, TypeError, ValueError):
+                raise ScenarioError(f"Unknown salary structure: {structure_id}")
+        return structures
+
+
+class PayrollSimulation:
+
+    COMPONENT_FIELDS = (
+        'name', 'component_type', 'calculation_type', 'calculation_value',
+        'is_taxable', 'is_pf_applicable', 'is_esi_applicable', 'priority'
+    )
+
+    _snapshots = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def settings_fields():
+        """PayrollSettings fields a scenario may override (everything but keys and timestamps)"""
+        return tuple(
+            field.name for field in PayrollSettings._meta.concrete_fields
+            if not field.is_relation and not field.primary_key and field.name not in ('created_at', 'updated_at')
+        )
+
+    @staticmethod
+    def clean(field, value, label):
+        try:
+            return field.clean(value, None)
+        except ValidationError as e:
+            raise ScenarioError(f"{label}: {'; '.join(e.messages)}")
+
+    @staticmethod
+    def overridden(instance, changes, allowed_fields, label):
+        """Unsaved copy of a model instance with `changes` applied"""
+        if not isinstance(changes, dict):
+            raise ScenarioError(f"{label}: expected an object of field values")
+        unknown = set(changes) - set(allowed_fields)
+        if unknown:
+            raise ScenarioError(f"{label}: cannot override {', '.join(sorted(unknown))}")
+        instance = copy.copy(instance)
+        for name, value in changes.items():
+            field = instance._meta.get_field(name)
+            setattr(instance, name, PayrollSimulation.clean(field, value, f"{label} {name}"))
+        return instance
+
+    @staticmethod
+    def snapshot(organization, month, year, admin=None, refresh=False):
+        """Cached PayrollSnapshot of the month, built when missing, expired or `refresh` is set"""
+        key = (organization.id, admin.id if admin else None, month, year)
+        ttl = getattr(settings, 'PAYROLL_SIMULATION_SNAPSHOT_TTL_SECONDS', 600)
+        with PayrollSimulation._lock:
+            cached = PayrollSimulation._snapshots.get(key)
+            if cached is not None and not refresh and time.monotonic() - cached[0] < ttl:
+                PayrollSimulation._snapshots.move_to_end(key)
+                return cached[1], True
+
+        snapshot = PayrollSnapshot(organization, month, year, admin)
+        with PayrollSimulation._lock:
+            PayrollSimulation._snapshots[key] = (time.monotonic(), snapshot)
+            PayrollSimulation._snapshots.move_to_end(key)
+            while len(PayrollSimulation._snapshots) > getattr(settings, 'PAYROLL_SIMULATION_SNAPSHOTS', 4):
+                PayrollSimulation._snapshots.popitem(last=False)
+        return snapshot, False
+
+    @staticmethod
+    def simulate(snapshot, scenario, include_unchanged=False):
+        """
+        Aggregate and per-employee differences between the snapshot's baseline and the scenario.
+        Raises ScenarioError for an invalid scenario.
+        """
+        results = snapshot.calculate(snapshot.scenario_batch(scenario))
+
+        totals = {field: [Decimal('0.00'), Decimal('0.00')] for field in TOTAL_FIELDS}
+        component_totals = defaultdict(lambda: [Decimal('0.00'), Decimal('0.00')])
+        employees = []
+        changed = failed = 0
+
+        for profile in snapshot.batch.profiles:
+            baseline, baseline_error = snapshot.baseline[profile.user_id]
+            scenario_data, scenario_error = results[profile.user_id]
+            employee = {
+                "employee_id": str(profile.user_id),
+                "employee_name": profile.user_name,
+                "employee_email": profile.user.email
+            }
+            if baseline_error and scenario_error:
+                failed += 1
+                employee["error"] = scenario_error
+                employees.append(employee)
+                continue
+            # Failing on one side only (e.g. a scenario assigns a structure to someone without one)
+            # counts that side as no payroll
+            if baseline_error:
+                employee["baseline_error"] = baseline_error
+                baseline = EMPTY_PAYROLL
+            if scenario_error:
+                employee["scenario_error"] = scenario_error
+                scenario_data = EMPTY_PAYROLL
+
+            for field in TOTAL_FIELDS:
+                totals[field][0] += baseline[field]
+                totals[field][1] += scenario_data[field]
+            baseline_amounts = PayrollSimulation._amounts(baseline)
+            scenario_amounts = PayrollSimulation._amounts(scenario_data)
+            components = {}
+            for code in baseline_amounts.keys() | scenario_amounts.keys():
+                before = baseline_amounts.get(code, Decimal('0.00'))
+                after = scenario_amounts.get(code, Decimal('0.00'))
+                component_totals[code][0] += before
+                component_totals[code][1] += after
+                if before != after:
+                    components[code] = PayrollSimulation._delta(before, after)
+
+            is_changed = bool(baseline_error or scenario_error or components) or any(baseline[field] != scenario_data[field] for field in TOTAL_FIELDS)
+            changed += is_changed
+            if is_changed or include_unchanged:
+                employee.update({field: PayrollSimulation._delta(baseline[field], scenario_data[field]) for field in TOTAL_FIELDS})
+                employee["components"] = dict(sorted(components.items()))
+                employees.append(employee)
+
+        return {
+            "summary": {
+                "employees": len(snapshot.batch.profiles),
+                "changed": changed,
+                "failed": failed,
+                **{field: PayrollSimulation._delta(*totals[field]) for field in TOTAL_FIELDS},
+                "components": {
+                    code: PayrollSimulation._delta(*component_totals[code])
+                    for code in sorted(component_totals)
+                    if component_totals[code][0] != component_totals[code][1]
+                }
+            },
+            "employees": employees
+        }
+
+    @staticmethod
+    def _amounts(payroll_data):
+        """{code: amount} of an employee's earnings and deductions (deductions keyed by their own codes)"""
+        amounts = {code: item['amount'] for code, item in payroll_data['earnings'].items()}
+        amounts.update({code: item['amount'] for code, item in payroll_data['deductions'].items()})
+        return amounts
+
+    @staticmethod
+    def _delta(baseline, scenario):
+        return {"baseline": baseline, "scenario": scenario, "delta": scenario - baseline}
@@ -0,0 +1,186 @@
+"""
+Payslip PDF layout.
+
+Turns the plain payslip content built by PayslipService.payslip_content()
+into an A4 PDF using only the standard Helvetica fonts, so no PDF library is
+needed. It has no Django dependency and is a pure function of its input
+(identical content gives identical bytes), which lets process-pool workers
+render payslips and lets the output be cached by a hash of the content.
+
+Limitation: the standard fonts only cover the WinAnsi (cp1252) character
+set. Most accented Latin letters outside it are printed without accents,
+and text in other scripts (e.g. Devanagari employee or organization names)
+is printed as '?'. Showing such names needs an embedded Unicode font and
+text shaping, which this layout does not do.
+"""
+import unicodedata
+import zlib
+
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+MARGIN = 40
+ROW_HEIGHT = 16
+
+# Helvetica advance widths (1/1000 em) of the characters amounts are made of
+_AMOUNT_WIDTHS = {',': 278, '.': 278, '-': 333, ' ': 278}
+
+
+def _text_width(text, size):
+    """Width of an amount in points (right alignment is only used for amounts)"""
+    return sum(_AMOUNT_WIDTHS.get(char, 556) for char in text) * size / 1000
+
+
+def _winansi(text):
+    """text in the WinAnsi encoding of the Type1 standard fonts (see the module's limitation)"""
+    try:
+        return text.encode('cp1252')
+    except UnicodeEncodeError:
+        pass
+    data = b''
+    for char in text:
+        try:
+            data += char.encode('cp1252')
+        except UnicodeEncodeError:
+            # A letter cp1252 lacks is printed without its accents; anything else as '?'
+            base = ''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
+            data += base.encode('cp1252', 'replace') if base else b'?'
+    return data
+
+
+def _escape(text):
+    data = _winansi(str(text))
+    return data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+class _Document:
+    """Pages of PDF drawing operators"""
+
+    def __init__(self):
+        self.pages = []
+        self.new_page()
+
+    def new_page(self):
+        self.ops = []
+        self.pages.append(self.ops)
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def text(self, x, y, text, size=9, bold=False, align='left'):
+        if align == 'right':
+            x -= _text_width(str(text), size)
+        self.ops.append(b"BT /%s %d Tf %.2f %.2f Td (%s) Tj ET" % (
+            b'F2' if bold else b'F1', size, x, y, _escape(text)
+        ))
+
+    def line(self, x1, y1, x2, y2):
+        self.ops.append(b"%.2f %.2f m %.2f %.2f l S" % (x1, y1, x2, y2))
+
+    def shade(self, x, y, width, height):
+        self.ops.append(b"0.92 g %.2f %.2f %.2f %.2f re f 0 g" % (x, y, width, height))
+
+    def ensure_room(self, height):
+        if self.y - height < MARGIN:
+            self.new_page()
+
+    def to_pdf(self):
+        fonts = b"<< /Font << /F1 %d 0 R /F2 %d 0 R >> >>"
+        page_count = len(self.pages)
+        first_page = 3
+        font_object = first_page + 2 * page_count
+        objects = [
+            b"<< /Type /Catalog /Pages 2 0 R >>",
+            b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+                b" ".join(b"%d 0 R" % (first_page + 2 * index) for index in range(page_count)), page_count
+            ),
+        ]
+        for index, ops in enumerate(self.pages):
+            stream = zlib.compress(b"\n".join(ops), 6)
+            objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources %s /Contents %d 0 R >>" % (
+                PAGE_WIDTH, PAGE_HEIGHT, fonts % (font_object, font_object + 1), first_page + 2 * index + 1
+            ))
+            objects.append(b"<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+        objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold /Encoding /WinAnsiEncoding >>")
+
+        output = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(len(output))
+            output += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+        xref = len(output)
+        output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+        output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+        output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+        return bytes(output)
+
+
+def _label_values(document, title, pairs):
+    """Two label/value pairs per row under a shaded section title"""
+    document.ensure_room(ROW_HEIGHT * 2)
+    document.shade(MARGIN, document.y - 4, PAGE_WIDTH - 2 * MARGIN, ROW_HEIGHT)
+    document.text(MARGIN + 6, document.y, title, size=10, bold=True)
+    document.y -= ROW_HEIGHT + 2
+    half = (PAGE_WIDTH - 2 * MARGIN) / 2
+    for start in range(0, len(pairs), 2):
+        document.ensure_room(ROW_HEIGHT)
+        for column, (label, value) in enumerate(pairs[start:start + 2]):
+            x = MARGIN + 6 + column * half
+            document.text(x, document.y, label)
+            document.text(x + 110, document.y, value, bold=True)
+        document.y -= ROW_HEIGHT
+    document.y -= 6
+
+
+def _amount_table(document, earnings, deductions):
+    """Earnings and deductions side by side"""
+    half = (PAGE_WIDTH - 2 * MARGIN) / 2
+    columns = ((MARGIN, 'Earnings', earnings), (MARGIN + half, 'Deductions', deductions))
+
+    def header():
+        document.shade(MARGIN, document.y - 4, PAGE_WIDTH - 2 * MARGIN, ROW_HEIGHT)
+        for x, title, _ in columns:
+            document.text(x + 6, document.y, title, size=10, bold=True)
+            document.text(x + half - 50, document.y, 'Amount', size=10, bold=True)
+        document.y -= ROW_HEIGHT + 2
+
+    document.ensure_room(ROW_HEIGHT * 2)
+    header()
+    for index in range(max(len(earnings), len(deductions))):
+        if document.y - ROW_HEIGHT < MARGIN:
+            document.new_page()
+            header()
+        for x, _, rows in columns:
+            if index < len(rows):
+                name, amount = rows[index]
+                document.text(x + 6, document.y, name)
+                document.text(x + half - 6, document.y, amount, align='right')
+        document.y -= ROW_HEIGHT
+    document.line(MARGIN, document.y + ROW_HEIGHT - 4, PAGE_WIDTH - MARGIN, document.y + ROW_HEIGHT - 4)
+
+
+def render_payslip(content):
+    """PDF bytes of one payslip"""
+    document = _Document()
+    document.text(MARGIN, document.y, content['organization'], size=16, bold=True)
+    document.y -= 18
+    document.text(MARGIN, document.y, content['title'], size=11, bold=True)
+    document.y -= 10
+    document.line(MARGIN, document.y, PAGE_WIDTH - MARGIN, document.y)
+    document.y -= ROW_HEIGHT + 4
+
+    _label_values(document, 'Employee Details', content['employee'])
+    _label_values(document, 'Attendance', content['attendance'])
+    _amount_table(document, content['earnings'], content['deductions'])
+
+    document.ensure_room(ROW_HEIGHT * 3)
+    half = (PAGE_WIDTH - 2 * MARGIN) / 2
+    document.text(MARGIN + 6, document.y, 'Gross Earnings', bold=True)
+    document.text(MARGIN + half - 6, document.y, content['gross_salary'], bold=True, align='right')
+    document.text(MARGIN + half + 6, document.y, 'Total Deductions', bold=True)
+    document.text(PAGE_WIDTH - MARGIN - 6, document.y, content['total_deductions'], bold=True, align='right')
+    document.y -= ROW_HEIGHT + 8
+    document.shade(MARGIN, document.y - 6, PAGE_WIDTH - 2 * MARGIN, ROW_HEIGHT + 4)
+    document.text(MARGIN + 6, document.y, 'Net Pay', size=11, bold=True)
+    document.text(PAGE_WIDTH - MARGIN - 6, document.y, content['net_salary'], size=11, bold=True, align='right')
+    document.y -= ROW_HEIGHT * 2
+    document.text(MARGIN, document.y, 'This is a computer-generated payslip and does not require a signature.', size=8)
+    return document.to_pdf()
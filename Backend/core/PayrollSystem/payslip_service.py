@@ -0,0 +1,207 @@
+"""
+Server-side payslip PDFs with a content-addressed file cache.
+
+A payslip's content (employee details, attendance, component lines and
+totals, all as display strings) is built from the PayrollRecord and its
+PayrollComponentEntry rows; its SHA-256 names the PDF file under
+PAYSLIP_PDF_FOLDER (inside MEDIA_ROOT). A payslip is only rendered when no
+file of that hash exists, so re-downloads are free and editing a record
+re-renders just that record. The record's payslip_pdf_path and
+payslip_generated point at the current file. Superseded files are left in
+place: a request that loaded the record before it changed may still be
+about to open its old file.
+
+Misses are rendered by payslip_pdf.render_payslip, on a process pool when
+PAYSLIP_RENDER_WORKERS > 1. team_zip() streams an admin's payslips for a
+month as a ZIP, rendering PAYSLIP_RENDER_CHUNK_SIZE records at a time so
+the download starts before the whole team is rendered.
+"""
+import calendar
+import hashlib
+import json
+import logging
+import os
+import re
+import zipfile
+
+from django.conf import settings
+from django.db.models import Prefetch
+
+from .models import PayrollComponentEntry, PayrollRecord
+from .payroll_batch import PayrollBatch
+from .payslip_pdf import render_payslip
+
+logger = logging.getLogger(__name__)
+
+# Part of every content hash: bump when the layout changes so cached PDFs are re-rendered
+PAYSLIP_LAYOUT_VERSION = 1
+
+
+class _ZipStream:
+    """Write-only file object collecting what zipfile writes until the next take()"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+class PayslipService:
+
+    @staticmethod
+    def records(**filters):
+        """PayrollRecords with everything payslip_content() reads"""
+        return PayrollRecord.objects.filter(**filters).select_related(
+            'employee__own_user_profile', 'organization__own_organization_profile'
+        ).prefetch_related(
+            Prefetch('component_entries', queryset=PayrollComponentEntry.objects.select_related('component'))
+        )
+
+    @staticmethod
+    def _money(value):
+        return f"{float(value or 0):,.2f}"
+
+    @staticmethod
+    def payslip_content(record):
+        """Everything printed on the payslip, as strings (the input of render_payslip and of the hash)"""
+        employee = record.employee
+        profile = getattr(employee, 'own_user_profile', None)
+        organization = getattr(record.organization, 'own_organization_profile', None)
+        attendance = (record.deductions_breakdown or {}).get('attendance_details', {})
+
+        # Component entries first (they carry manual edits), then calculated lines without a component
+        lines = {True: [], False: []}
+        seen = set()
+        for entry in sorted(record.component_entries.all(), key=lambda entry: (entry.component.priority, entry.component.code)):
+            lines[entry.is_earning].append([entry.component.name, PayslipService._money(entry.amount)])
+            seen.add(entry.component.code)
+        for breakdown, is_earning in ((record.earnings_breakdown, True), (record.deductions_breakdown, False)):
+            for code, item in (breakdown or {}).items():
+                if code not in seen and isinstance(item, dict) and 'amount' in item:
+                    lines[is_earning].append([item.get('name') or code, PayslipService._money(item['amount'])])
+
+        return {
+            "layout": PAYSLIP_LAYOUT_VERSION,
+            "organization": organization.organization_name if organization else record.organization.username,
+            "title": f"Payslip for {calendar.month_name[record.payroll_month]} {record.payroll_year}",
+            "employee": [
+                ["Employee Name", profile.user_name if profile else employee.username],
+                ["Employee ID", profile.custom_employee_id if profile else ""],
+                ["Designation", (profile.designation or profile.job_title) if profile else ""],
+                ["Email", employee.email],
+                ["Date of Joining", str(profile.date_of_joining) if profile and profile.date_of_joining else ""],
+                ["PAN", profile.pan_number if profile else ""],
+            ],
+            "attendance": [
+                ["Working Days", str(record.working_days)],
+                ["Payable Days", str(attendance.get('payable_days', ''))],
+                ["Present Days", str(record.present_days)],
+                ["Absent Days", str(record.absent_days)],
+                ["Leave Days", str(record.leave_days)],
+                ["LOP Days", str(attendance.get('lop_days', ''))],
+                ["Overtime Hours", str(record.overtime_hours)],
+                ["Status", record.get_status_display()],
+            ],
+            "earnings": lines[True],
+            "deductions": lines[False],
+            "gross_salary": PayslipService._money(record.gross_salary),
+            "total_deductions": PayslipService._money(record.total_deductions),
+            "net_salary": PayslipService._money(record.net_salary),
+        }
+
+    @staticmethod
+    def content_hash(content):
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def relative_path(digest):
+        folder = getattr(settings, 'PAYSLIP_PDF_FOLDER', 'payslips')
+        return os.path.join(folder, digest[:2], f"{digest}.pdf")
+
+    @staticmethod
+    def ensure_pdfs(records, pool=None):
+        """
+        {record id: relative path} of up-to-date PDFs for `records` (loaded with records()),
+        rendering only those whose content has no cached file yet.
+        """
+        paths = {}
+        missing = {}  # {relative path: content}
+        for record in records:
+            content = PayslipService.payslip_content(record)
+            path = PayslipService.relative_path(PayslipService.content_hash(content))
+            paths[record.id] = path
+            if path not in missing and not os.path.exists(os.path.join(settings.MEDIA_ROOT, path)):
+                missing[path] = content
+
+        if missing:
+            contents = list(missing.values())
+            if pool is not None:
+                pdfs = pool.map(render_payslip, contents, chunksize=max(1, len(contents) // 16))
+            else:
+                pdfs = map(render_payslip, contents)
+            for path, pdf in zip(missing, pdfs):
+                final_path = os.path.join(settings.MEDIA_ROOT, path)
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                partial_path = f"{final_path}.{os.getpid()}.part"
+                with open(partial_path, 'wb') as f:
+                    f.write(pdf)
+                # Readers only ever see a complete file
+                os.replace(partial_path, final_path)
+
+        changed = []
+        for record in records:
+            if record.payslip_pdf_path != paths[record.id] or not record.payslip_generated:
+                record.payslip_pdf_path = paths[record.id]
+                record.payslip_generated = True
+                changed.append(record)
+        if changed:
+            PayrollRecord.objects.bulk_update(changed, ['payslip_pdf_path', 'payslip_generated'])
+        return paths
+
+    @staticmethod
+    def pdf_path(record):
+        """Absolute path of one record's up-to-date payslip PDF"""
+        return os.path.join(settings.MEDIA_ROOT, PayslipService.ensure_pdfs([record])[record.id])
+
+    @staticmethod
+    def file_name(record):
+        profile = getattr(record.employee, 'own_user_profile', None)
+        name = f"{profile.custom_employee_id}_{profile.user_name}" if profile else record.employee.username
+        name = re.sub(r'[^A-Za-z0-9._-]+', '_', name).strip('_')
+        return f"{name}_payslip_{record.payroll_year}_{record.payroll_month:02d}.pdf"
+
+    @staticmethod
+    def team_zip(admin, month, year):
+        """Generator of ZIP bytes holding the payslip of every employee of the admin with a record for the month"""
+        record_ids = list(
+            PayrollRecord.objects.filter(admin=admin, payroll_month=month, payroll_year=year).order_by(
+                'employee__own_user_profile__user_name', 'id'
+            ).values_list('id', flat=True)
+        )
+        chunk_size = getattr(settings, 'PAYSLIP_RENDER_CHUNK_SIZE', 200)
+        pool = PayrollBatch.process_pool(getattr(settings, 'PAYSLIP_RENDER_WORKERS', 0))
+        stream = _ZipStream()
+        try:
+            # PDFs are already compressed, so they are stored as they are
+            with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+                for start in range(0, len(record_ids), chunk_size):
+                    position = {record_id: index for index, record_id in enumerate(record_ids[start:start + chunk_size])}
+                    records = sorted(PayslipService.records(id__in=list(position)), key=lambda record: position[record.id])
+                    paths = PayslipService.ensure_pdfs(records, pool)
+                    for record in records:
+                        archive.write(os.path.join(settings.MEDIA_ROOT, paths[record.id]), PayslipService.file_name(record))
+                        yield stream.take()
+            yield stream.take()
+        finally:
+            if pool is not None:
+                pool.shutdown()
@@ -0,0 +1,87 @@
+"""
+Stale-payroll marking.
+
+Changes to an employee's leaves, salary structure or component overrides
+and advances flag the PayrollRecords they affect as stale (see
+payroll_change_tracker). Attendance is marked through
+DailyAttendanceSummaryService.mark_dirty().
+
+TDS and professional-tax slab edits invalidate the compiled slab tables
+(TaxSlabRegistry) in every process.
+"""
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from LeaveControl.models import LeaveApplication
+from .models import (
+    EmployeeSalaryStructure, EmployeeSalaryComponent, EmployeeAdvance, ProfessionalTaxSlab, TDSSlab
+)
+from .payroll_change_tracker import PayrollChangeTracker
+from .tax_slab_registry import TaxSlabRegistry
+
+
+# Date fields of the models whose rows cover a date range
+RANGE_FIELDS = {
+    LeaveApplication: ('user_id', 'from_date', 'to_date'),
+    EmployeeSalaryStructure: ('employee_id', 'effective_from', 'effective_to'),
+    EmployeeSalaryComponent: ('employee_id', 'effective_from', 'effective_to'),
+}
+
+
+def _range(sender, instance):
+    return tuple(getattr(instance, field) for field in RANGE_FIELDS[sender])
+
+
+@receiver(pre_save, sender=LeaveApplication)
+@receiver(pre_save, sender=EmployeeSalaryStructure)
+@receiver(pre_save, sender=EmployeeSalaryComponent)
+def remember_previous_range(sender, instance, raw=False, update_fields=None, **kwargs):
+    """Keep the stored range of a row about to be saved, so moving it also marks the months it leaves"""
+    instance._payroll_previous_range = None
+    if raw or instance._state.adding or instance.pk is None:
+        return
+    fields = RANGE_FIELDS[sender]
+    if update_fields is not None and not {field.removesuffix('_id') for field in fields[1:]} & set(update_fields):
+        return
+    instance._payroll_previous_range = sender.objects.filter(pk=instance.pk).values_list(*fields).first()
+
+
+def _mark_ranges(sender, instance, reason):
+    ranges = [_range(sender, instance)]
+    previous = getattr(instance, '_payroll_previous_range', None)
+    if previous and tuple(previous) != ranges[0]:
+        ranges.append(tuple(previous))
+    PayrollChangeTracker.mark_dirty(ranges, reason)
+
+
+@receiver(post_save, sender=LeaveApplication)
+@receiver(post_delete, sender=LeaveApplication)
+def mark_payroll_on_leave_change(sender, instance, **kwargs):
+    _mark_ranges(sender, instance, 'leave')
+
+
+@receiver(post_save, sender=EmployeeSalaryStructure)
+@receiver(post_delete, sender=EmployeeSalaryStructure)
+def mark_payroll_on_structure_assignment_change(sender, instance, **kwargs):
+    _mark_ranges(sender, instance, 'salary_structure')
+
+
+@receiver(post_save, sender=EmployeeSalaryComponent)
+@receiver(post_delete, sender=EmployeeSalaryComponent)
+def mark_payroll_on_component_override_change(sender, instance, **kwargs):
+    _mark_ranges(sender, instance, 'salary_component')
+
+
+@receiver(post_save, sender=EmployeeAdvance)
+@receiver(post_delete, sender=EmployeeAdvance)
+def mark_payroll_on_advance_change(sender, instance, **kwargs):
+    # Outstanding advances are deducted in every month that is calculated
+    PayrollChangeTracker.mark_dirty([(instance.employee_id, None, None)], 'advance')
+
+
+@receiver(post_save, sender=TDSSlab)
+@receiver(post_delete, sender=TDSSlab)
+@receiver(post_save, sender=ProfessionalTaxSlab)
+@receiver(post_delete, sender=ProfessionalTaxSlab)
+def invalidate_tax_slab_tables(sender, instance, **kwargs):
+    TaxSlabRegistry.invalidate()
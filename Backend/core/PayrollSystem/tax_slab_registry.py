@@ -0,0 +1,168 @@
+"""
+Compiled TDS and professional-tax slab tables with an in-process LRU.
+
+Slabs change about once a year, but every payroll calculation used to query
+and scan them. Each (financial year, age group) TDS slab set is compiled once
+into sorted breakpoints with the tax due below each breakpoint, so a tax
+lookup is a bisect plus one multiply; a state's PT slabs are compiled into
+sorted lower bounds the same way. TDSTable.tax_for() and
+ProfessionalTaxTable.amounts_for() price a list of incomes at once.
+
+Tables live in a process-local LRU (PAYROLL_TAX_SLAB_REGISTRY_SIZE entries).
+Saving or deleting a slab (PayrollSystem/signals.py) clears it in the
+saving process and bumps a version in the Django cache; other processes
+compare that version at most every PAYROLL_TAX_SLAB_VERSION_CHECK_SECONDS
+and drop their tables when it moved.
+"""
+import logging
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from decimal import Decimal
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import ProfessionalTaxSlab, TDSSlab
+
+logger = logging.getLogger(__name__)
+
+TAX_SLAB_VERSION_KEY = 'payroll_tax_slab_registry_version'
+
+
+class TDSTable:
+    """Progressive income-tax table of one financial year and age group"""
+
+    def __init__(self, slabs):
+        slabs = sorted(slabs, key=lambda slab: slab.income_from)
+        self.starts = [slab.income_from for slab in slabs]
+        self.ends = [slab.income_to for slab in slabs]
+        self.rates = [slab.tax_rate for slab in slabs]
+        # Tax on everything below each slab's start (the earlier slabs taken in full)
+        self.tax_below = []
+        total = Decimal('0.00')
+        for slab in slabs:
+            self.tax_below.append(total)
+            if slab.income_to is not None:
+                total += (slab.income_to - slab.income_from + 1) * slab.tax_rate / 100
+
+    def tax(self, income):
+        """Annual tax on `income`; each slab taxes (min(income, income_to) - income_from + 1) at its rate"""
+        index = bisect_right(self.starts, income) - 1
+        if index < 0 or income <= 0:
+            return Decimal('0.00')
+        end = self.ends[index]
+        top = income if end is None or income < end else end
+        return self.tax_below[index] + (top - self.starts[index] + 1) * self.rates[index] / 100
+
+    def tax_for(self, incomes):
+        """tax() of every income in a list"""
+        return [self.tax(income) for income in incomes]
+
+
+class ProfessionalTaxTable:
+    """Monthly professional tax of one state"""
+
+    def __init__(self, slabs):
+        self.slabs = sorted(slabs, key=lambda slab: slab.salary_from)
+        self.starts = [slab.salary_from for slab in self.slabs]
+
+    def amount(self, gross_salary):
+        """Tax amount of the highest slab whose range contains the gross salary, else 0"""
+        index = bisect_right(self.starts, gross_salary)
+        while index > 0:
+            index -= 1
+            slab = self.slabs[index]
+            if slab.salary_to is None or slab.salary_to >= gross_salary:
+                return slab.tax_amount
+        return Decimal('0.00')
+
+    def amounts_for(self, gross_salaries):
+        """amount() of every gross salary in a list"""
+        return [self.amount(gross_salary) for gross_salary in gross_salaries]
+
+
+class TaxSlabRegistry:
+
+    _tables = OrderedDict()
+    _lock = threading.Lock()
+    _version = None
+    _version_checked_at = 0.0
+
+    @staticmethod
+    def tds_table(financial_year, age_group):
+        return TaxSlabRegistry.tds_tables(financial_year).get(age_group) or TDSTable([])
+
+    @staticmethod
+    def tds_tables(financial_year):
+        """{age_group: TDSTable} of a financial year's active slabs (one query when not cached)"""
+        def build():
+            by_age_group = defaultdict(list)
+            for slab in TDSSlab.objects.filter(financial_year=financial_year, is_active=True):
+                by_age_group[slab.age_group].append(slab)
+            return {age_group: TDSTable(slabs) for age_group, slabs in by_age_group.items()}
+        return TaxSlabRegistry._get(('tds', financial_year), build)
+
+    @staticmethod
+    def pt_table(state):
+        """ProfessionalTaxTable of a state's active slabs (one query when not cached)"""
+        return TaxSlabRegistry._get(
+            ('pt', state),
+            lambda: ProfessionalTaxTable(ProfessionalTaxSlab.objects.filter(state=state, is_active=True))
+        )
+
+    @staticmethod
+    def tax_for(financial_year, age_group, annual_incomes):
+        """Annual TDS for a list of incomes of one age group"""
+        return TaxSlabRegistry.tds_table(financial_year, age_group).tax_for(annual_incomes)
+
+    @staticmethod
+    def _get(key, build):
+        TaxSlabRegistry._check_version()
+        with TaxSlabRegistry._lock:
+            table = TaxSlabRegistry._tables.get(key)
+            if table is not None:
+                TaxSlabRegistry._tables.move_to_end(key)
+                return table
+
+        table = build()
+        with TaxSlabRegistry._lock:
+            TaxSlabRegistry._tables[key] = table
+            while len(TaxSlabRegistry._tables) > getattr(settings, 'PAYROLL_TAX_SLAB_REGISTRY_SIZE', 64):
+                TaxSlabRegistry._tables.popitem(last=False)
+        return table
+
+    @staticmethod
+    def _check_version():
+        """Drop the local tables if another process changed slabs since the last check"""
+        now = time.monotonic()
+        if now - TaxSlabRegistry._version_checked_at < getattr(settings, 'PAYROLL_TAX_SLAB_VERSION_CHECK_SECONDS', 30):
+            return
+        TaxSlabRegistry._version_checked_at = now
+        try:
+            version = cache.get(TAX_SLAB_VERSION_KEY)
+        except Exception as e:
+            logger.warning(f"Could not read the tax slab registry version: {str(e)}")
+            return
+        if version != TaxSlabRegistry._version:
+            with TaxSlabRegistry._lock:
+                TaxSlabRegistry._tables.clear()
+                TaxSlabRegistry._version = version
+
+    @staticmethod
+    def invalidate():
+        """Forget every compiled table here and, through the cache version, in other processes"""
+        def clear():
+            version = uuid4().hex
+            with TaxSlabRegistry._lock:
+                TaxSlabRegistry._tables.clear()
+                TaxSlabRegistry._version = version
+            try:
+                cache.set(TAX_SLAB_VERSION_KEY, version, None)
+            except Exception as e:
+                logger.error(f"Could not publish the tax slab registry version: {str(e)}")
+        # After commit, so no process can rebuild a table from the uncommitted rows' old values
+        transaction.on_commit(clear)
@@ -15,7 +15,10 @@ from .views import (
     PayrollMonthlyReport,
     PayrollComponentsAPIView,
     PayrollSettingsAPIView,
-    GeneratePayrollAPIView
+    GeneratePayrollAPIView,
+    PayrollRunAPIView,
+    RecomputePayrollAPIView,
+    PayrollSimulationAPIView
 )
 from .additional_views import (
     UpdatePayrollReportView,
@@ -27,7 +30,9 @@ from .additional_views import (
     DownloadEarningSampleExcel,
     UploadEarningExcel,
     GenerateCustomPayableSheet,
-    EmployeePayslipAPI
+    EmployeePayslipAPI,
+    EmployeePayslipPDFAPI,
+    EmployeePayslipZipAPI
 )
 from .additional_utility_views import (
     PayrollDashboardAPIView,
@@ -68,6 +73,10 @@ urlpatterns = [
     
     # PAYROLL GENERATION
     path('generate-payroll/<str:org_id>', GeneratePayrollAPIView.as_view(), name='generate-payroll'),
+    path('payroll-runs/<str:org_id>', PayrollRunAPIView.as_view(), name='payroll-runs'),
+    path('payroll-runs/<str:org_id>/<uuid:run_id>', PayrollRunAPIView.as_view(), name='payroll-run-detail'),
+    path('recompute-payroll/<str:org_id>', RecomputePayrollAPIView.as_view(), name='recompute-payroll'),
+    path('simulate-payroll/<str:org_id>', PayrollSimulationAPIView.as_view(), name='simulate-payroll'),
     
     # PAYROLL-MONTHLY-REPORT
     path('payroll-monthly-report/<str:org_id>/<int:month>/<int:year>', PayrollMonthlyReport.as_view(), name='payroll-monthly-report'),
@@ -107,6 +116,8 @@ urlpatterns = [
     # EMPLOYEE-PAYSLIPS
     path('employee-payslips/<str:admin_id>/<int:month>/<int:year>', EmployeePayslipAPI.as_view(), name='employee-payslips-by-admin'),
     path('employee-payslips/<str:admin_id>/<str:uniqueID>/<int:month>/<int:year>', EmployeePayslipAPI.as_view(), name='employee-payslips-by-admin-and-uid'),
+    path('employee-payslip-pdf/<str:admin_id>/<str:uniqueID>/<int:month>/<int:year>', EmployeePayslipPDFAPI.as_view(), name='employee-payslip-pdf'),
+    path('employee-payslips-zip/<str:admin_id>/<int:month>/<int:year>', EmployeePayslipZipAPI.as_view(), name='employee-payslips-zip'),
     
     # ADDITIONAL UTILITY APIS
     path('dashboard/<str:org_id>', PayrollDashboardAPIView.as_view(), name='payroll-dashboard'),
@@ -7,8 +7,9 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
 from django.shortcuts import get_object_or_404
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.db.models import Q, Sum, Count
 from django.utils import timezone
 from datetime import datetime, date
@@ -19,7 +20,7 @@ from .models import (
     SalaryComponent, SalaryStructure, StructureComponent,
     EmployeeSalaryStructure, EmployeeSalaryComponent,
     EmployeeBankInfo, PayrollSettings, EmployeeAdvance,
-    PayrollRecord, PayrollComponentEntry,
+    PayrollRecord, PayrollComponentEntry, PayrollRun,
     ProfessionalTaxSlab, TDSSlab
 )
 from .serializers import (
@@ -30,7 +31,11 @@ from .serializers import (
     PayrollRecordSerializer, ProfessionalTaxSlabSerializer,
     TDSSlabSerializer
 )
-from .payroll_calculator import PayrollCalculator
+from .payroll_batch import PayrollBatch
+from .payroll_change_tracker import PayrollChangeTracker
+from .payroll_record_writer import PayrollRecordWriter
+from .payroll_run_service import PayrollRunService
+from .payroll_simulation import PayrollSimulation, ScenarioError
 from .payroll_excel_service import PayrollExcelService
 from .additional_views import (
     UpdatePayrollReportView, BIPayrollReportView, PayrollDownloadInfo,
@@ -455,10 +460,14 @@ class EmployeeBankInfoAPIView(APIView):
 # ==================== PAYROLL GENERATION ====================
 
 class GeneratePayrollAPIView(APIView):
-    """Generate payroll for employees"""
+    """
+    Generate payroll for employees. Up to PAYROLL_SYNC_MAX_EMPLOYEES are generated
+    inline; larger runs (or "run_async": true) are queued as a PayrollRun whose
+    progress is polled through PayrollRunAPIView. With "regenerate": true, records
+    that already exist for the month are recalculated in place.
+    """
     permission_classes = [IsAuthenticated]
     
-    @transaction.atomic
     def post(self, request, org_id):
         """Generate payroll for month/year"""
         try:
@@ -472,141 +481,49 @@ class GeneratePayrollAPIView(APIView):
             if admin_id:
                 admin = get_object_or_404(BaseUserModel, id=admin_id, role='admin')
             
-            payroll_date = date(year, month, 1)
+            batch = PayrollBatch(organization, month, year, admin=admin, employee_ids=employee_ids)
+            # Recalculate employees that already have a record instead of reporting them
+            regenerate = str(request.data.get('regenerate', '')).lower() == 'true'
+            run_async = str(request.data.get('run_async', '')).lower() == 'true'
+            if run_async or batch.employees().count() > getattr(settings, 'PAYROLL_SYNC_MAX_EMPLOYEES', 200):
+                return self._queue_run(request, organization, month, year, admin, employee_ids, regenerate)
             
-            # Get employees
-            if employee_ids:
-                employees = BaseUserModel.objects.filter(
-                    id__in=employee_ids,
-                    role='user'
-                )
-            elif admin:
-                user_profiles = UserProfile.objects.filter(admin=admin)
-                employees = [profile.user for profile in user_profiles]
-            else:
-                user_profiles = UserProfile.objects.filter(
-                    organization=organization
-                )
-                employees = [profile.user for profile in user_profiles]
-            
-            generated_payrolls = []
-            errors = []
-            
-            for employee in employees:
-                try:
-                    # Check if payroll already exists
-                    existing = PayrollRecord.objects.filter(
-                        employee=employee,
-                        payroll_month=month,
-                        payroll_year=year
-                    ).first()
-                    
-                    if existing:
-                        errors.append(f"Payroll already exists for {employee.email}")
-                        continue
-                    
-                    # Calculate payroll
-                    calculator = PayrollCalculator(employee, month, year, admin, organization)
-                    payroll_data = calculator.calculate_payroll()
-                    
-                    # Get employee's admin and organization
-                    user_profile = employee.own_user_profile
-                    emp_admin = user_profile.admin
-                    emp_org = user_profile.organization
-                    
-                    # Create payroll record with enhanced attendance data
-                    attendance_data = payroll_data['attendance_data']
-                    payroll_record = PayrollRecord.objects.create(
-                        employee=employee,
-                        admin=emp_admin,
-                        organization=emp_org,
-                        payroll_month=month,
-                        payroll_year=year,
-                        payroll_date=payroll_date,
-                        total_days=attendance_data.get('total_days', 0),
-                        present_days=attendance_data.get('present_days', 0),
-                        absent_days=attendance_data.get('absent_days', 0),
-                        leave_days=attendance_data.get('leave_days', 0),
-                        working_days=attendance_data.get('working_days', 0),
-                        overtime_hours=attendance_data.get('overtime_hours', 0),
-                        basic_salary=payroll_data['earnings'].get('BASIC', {}).get('amount', 0),
-                        hra=payroll_data['earnings'].get('HRA', {}).get('amount', 0),
-                        special_allowance=payroll_data['earnings'].get('SPECIAL_ALLOWANCE', {}).get('amount', 0),
-                        overtime_amount=payroll_data['earnings'].get('OVERTIME', {}).get('amount', 0),
-                        gross_salary=payroll_data['gross_salary'],
-                        pf_employee=payroll_data['deductions'].get('PF_EMPLOYEE', {}).get('amount', 0),
-                        esi_employee=payroll_data['deductions'].get('ESI_EMPLOYEE', {}).get('amount', 0),
-                        professional_tax=payroll_data['deductions'].get('PROFESSIONAL_TAX', {}).get('amount', 0),
-                        tds=payroll_data['deductions'].get('TDS', {}).get('amount', 0),
-                        advance_deduction=payroll_data['deductions'].get('ADVANCE', {}).get('amount', 0),
-                        loan_deduction=payroll_data['deductions'].get('LOAN', {}).get('amount', 0),
-                        total_deductions=payroll_data['total_deductions'],
-                        net_salary=payroll_data['net_salary'],
-                        earnings_breakdown={
-                            **payroll_data['earnings'],
-                            'calculation_summary': payroll_data.get('calculation_summary', {})
-                        },
-                        deductions_breakdown={
-                            **payroll_data['deductions'],
-                            'attendance_details': {
-                                'leave_days': attendance_data.get('leave_days', 0),
-                                'lop_days': attendance_data.get('lop_days', 0),
-                                'half_day_leaves': attendance_data.get('half_day_leaves', 0),
-                                'week_off_days': attendance_data.get('week_off_days', 0),
-                                'holiday_days': attendance_data.get('holiday_days', 0),
-                                'sandwich_absent_days': attendance_data.get('sandwich_absent_days', 0),
-                                'payable_days': attendance_data.get('payable_days', 0),
-                                'late_days': attendance_data.get('late_days', 0),
-                                'early_exit_days': attendance_data.get('early_exit_days', 0),
-                                'total_late_minutes': attendance_data.get('total_late_minutes', 0),
-                                'total_early_exit_minutes': attendance_data.get('total_early_exit_minutes', 0)
-                            }
-                        },
-                        status='processed',
-                        created_by=request.user
+            with transaction.atomic():
+                writer = PayrollRecordWriter(organization, month, year, created_by=request.user, upsert=regenerate)
+                existing_employee_ids = writer.existing_employee_ids(batch.employees().values('user_id'))
+                
+                errors = []
+                if existing_employee_ids and not regenerate:
+                    # Reported, not calculated
+                    errors.extend(
+                        f"Payroll already exists for {email}"
+                        for email in batch.employees().filter(user_id__in=existing_employee_ids).order_by(
+                            'user_name', 'id'
+                        ).values_list('user__email', flat=True)
                     )
-                    
-                    # Create component entries
-                    for code, comp_data in payroll_data['earnings'].items():
-                        try:
-                            component = SalaryComponent.objects.get(
-                                code=code,
-                                organization=organization
-                            )
-                            PayrollComponentEntry.objects.create(
-                                payroll=payroll_record,
-                                component=component,
-                                amount=comp_data['amount'],
-                                is_earning=True
-                            )
-                        except SalaryComponent.DoesNotExist:
-                            pass
-                    
-                    for code, comp_data in payroll_data['deductions'].items():
-                        try:
-                            component = SalaryComponent.objects.get(
-                                code=code,
-                                organization=organization
-                            )
-                            PayrollComponentEntry.objects.create(
-                                payroll=payroll_record,
-                                component=component,
-                                amount=comp_data['amount'],
-                                is_earning=False
-                            )
-                        except SalaryComponent.DoesNotExist:
-                            pass
-                    
-                    generated_payrolls.append(payroll_record)
-                    
-                except Exception as e:
-                    errors.append(f"Error for {employee.email}: {str(e)}")
-                    continue
-            
+                    batch.exclude(existing_employee_ids)
+                
+                # Reference data for every employee is loaded up front in a fixed number of queries
+                batch.load()
+                for user_profile, payroll_data, error in batch.run():
+                    employee = user_profile.user
+                    if error is not None:
+                        errors.append(f"Error for {employee.email}: {str(error)}")
+                        continue
+                    writer.add(user_profile, payroll_data)
+                
+                written, write_failures = writer.flush()
+                errors.extend(f"Error for {user_profile.user.email}: {str(e)}" for user_profile, e in write_failures)
+            
+            generated_payrolls = PayrollRecord.objects.filter(
+                id__in=[record.id for _, record in written]
+            ).select_related(
+                'employee__own_user_profile', 'admin', 'organization'
+            ).prefetch_related('component_entries__component').order_by('employee__own_user_profile__user_name')
             serializer = PayrollRecordSerializer(generated_payrolls, many=True)
             return Response({
                 "status": status.HTTP_200_OK,
-                "message": f"Payroll generated for {len(generated_payrolls)} employees",
+                "message": f"Payroll generated for {len(written)} employees",
                 "data": serializer.data,
                 "errors": errors if errors else None
             })
@@ -618,6 +535,220 @@ class GeneratePayrollAPIView(APIView):
                 "line_number": traceback.extract_tb(e.__traceback__)[-1].lineno if e.__traceback__ else None,
                 "data": []
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    def _queue_run(self, request, organization, month, year, admin, employee_ids, regenerate=False):
+        from core.tasks import process_payroll_run_task
+        
+        try:
+            # The uniq_active_payroll_run_* constraints reject a second active run of the month
+            run = PayrollRunService.create(
+                organization, month, year, admin=admin,
+                employee_ids=employee_ids, created_by=request.user, regenerate=regenerate
+            )
+        except IntegrityError:
+            active = PayrollRunService.active_run(organization, month, year, admin)
+            return Response({
+                "status": status.HTTP_409_CONFLICT,
+                "message": "A payroll run for this month is already in progress",
+                "data": PayrollRunService.progress(active) if active else []
+            }, status=status.HTTP_409_CONFLICT)
+        
+        try:
+            process_payroll_run_task.delay(str(run.id))
+        except Exception as e:
+            run.status = 'failed'
+            run.error = str(e)
+            run.save(update_fields=['status', 'error'])
+            return Response({
+                "status": status.HTTP_503_SERVICE_UNAVAILABLE,
+                "message": "Could not queue the payroll run, please try again",
+                "data": []
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        
+        return Response({
+            "status": status.HTTP_202_ACCEPTED,
+            "message": "Payroll run queued. Poll the payroll run for progress.",
+            "data": PayrollRunService.progress(run)
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class PayrollRunAPIView(APIView):
+    """Progress of background payroll runs; POST re-queues a failed or stalled run from its checkpoint"""
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, org_id, run_id=None):
+        if run_id:
+            run = PayrollRun.objects.filter(id=run_id, organization_id=org_id).first()
+            if not run:
+                return Response({
+                    "status": status.HTTP_404_NOT_FOUND,
+                    "message": "Payroll run not found",
+                    "data": []
+                }, status=status.HTTP_404_NOT_FOUND)
+            return Response({
+                "status": status.HTTP_200_OK,
+                "message": "Payroll run fetched successfully",
+                "data": PayrollRunService.progress(run)
+            }, status=status.HTTP_200_OK)
+        
+        runs = PayrollRun.objects.filter(organization_id=org_id)
+        month = request.query_params.get('month')
+        year = request.query_params.get('year')
+        if month and year:
+            runs = runs.filter(payroll_month=int(month), payroll_year=int(year))
+        return Response({
+            "status": status.HTTP_200_OK,
+            "message": "Payroll runs fetched successfully",
+            "data": [PayrollRunService.progress(run) for run in runs[:50]]
+        }, status=status.HTTP_200_OK)
+    
+    def post(self, request, org_id, run_id=None):
+        from core.tasks import process_payroll_run_task
+        
+        run = PayrollRun.objects.filter(id=run_id, organization_id=org_id).first() if run_id else None
+        if not run:
+            return Response({
+                "status": status.HTTP_404_NOT_FOUND,
+                "message": "Payroll run not found",
+                "data": []
+            }, status=status.HTTP_404_NOT_FOUND)
+        if run.status == 'completed':
+            return Response({
+                "status": status.HTTP_409_CONFLICT,
+                "message": "Payroll run is already completed",
+                "data": PayrollRunService.progress(run)
+            }, status=status.HTTP_409_CONFLICT)
+        
+        try:
+            process_payroll_run_task.delay(str(run.id))
+        except Exception as e:
+            return Response({
+                "status": status.HTTP_503_SERVICE_UNAVAILABLE,
+                "message": "Could not queue the payroll run, please try again",
+                "data": []
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        
+        return Response({
+            "status": status.HTTP_202_ACCEPTED,
+            "message": "Payroll run re-queued. It resumes from its last checkpoint.",
+            "data": PayrollRunService.progress(run)
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class RecomputePayrollAPIView(APIView):
+    """
+    Stale payroll of a month (records whose attendance, leaves, salary assignments or
+    advances changed after they were calculated). POST recalculates only those records.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def get(self, request, org_id):
+        try:
+            organization = get_object_or_404(BaseUserModel, id=org_id, role='organization')
+            month = int(request.query_params.get('month'))
+            year = int(request.query_params.get('year'))
+            admin_id = request.query_params.get('admin_id')
+            admin = get_object_or_404(BaseUserModel, id=admin_id, role='admin') if admin_id else None
+            
+            records = PayrollChangeTracker.stale_records(organization, month, year, admin).select_related(
+                'employee__own_user_profile'
+            ).order_by('employee__own_user_profile__user_name')
+            data = [{
+                "payroll_id": str(record.id),
+                "employee_id": str(record.employee_id),
+                "employee_email": record.employee.email,
+                "employee_name": record.employee.own_user_profile.user_name,
+                "status": record.status,
+                "stale_reason": record.stale_reason,
+                "stale_since": record.stale_since
+            } for record in records]
+            
+            return Response({
+                "status": status.HTTP_200_OK,
+                "message": f"{len(data)} stale payroll records",
+                "data": data
+            }, status=status.HTTP_200_OK)
+            
+        except Exception as e:
+            return Response({
+                "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                "message": str(e),
+                "data": []
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    
+    def post(self, request, org_id):
+        try:
+            organization = get_object_or_404(BaseUserModel, id=org_id, role='organization')
+            month = int(request.data.get('month'))
+            year = int(request.data.get('year'))
+            admin_id = request.data.get('admin_id')
+            admin = get_object_or_404(BaseUserModel, id=admin_id, role='admin') if admin_id else None
+            
+            result = PayrollChangeTracker.recompute(organization, month, year, admin)
+            return Response({
+                "status": status.HTTP_200_OK,
+                "message": f"Payroll recomputed for {result['recomputed']} employees, {result['unchanged']} unchanged",
+                "data": result
+            }, status=status.HTTP_200_OK)
+            
+        except Exception as e:
+            return Response({
+                "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                "message": str(e),
+                "data": []
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class PayrollSimulationAPIView(APIView):
+    """
+    What-if payroll: recalculates a month with overridden settings, salary components,
+    structure lines or structure assignments and returns the differences from the
+    current calculation. Nothing is saved. See PayrollSystem/payroll_simulation.py.
+    """
+    permission_classes = [IsAuthenticated]
+    
+    def post(self, request, org_id):
+        try:
+            organization = get_object_or_404(BaseUserModel, id=org_id, role='organization')
+            month = int(request.data.get('month'))
+            year = int(request.data.get('year'))
+            admin_id = request.data.get('admin_id')
+            admin = get_object_or_404(BaseUserModel, id=admin_id, role='admin') if admin_id else None
+            scenario = request.data.get('scenario') or {}
+            if not isinstance(scenario, dict):
+                raise ScenarioError("scenario must be an object")
+            
+            refresh = str(request.data.get('refresh', '')).lower() == 'true'
+            include_unchanged = str(request.data.get('include_unchanged', '')).lower() == 'true'
+            
+            started = timezone.now()
+            snapshot, reused = PayrollSimulation.snapshot(organization, month, year, admin, refresh=refresh)
+            result = PayrollSimulation.simulate(snapshot, scenario, include_unchanged=include_unchanged)
+            result["snapshot"] = {
+                "built_at": snapshot.built_at,
+                "reused": reused,
+                "seconds": round((timezone.now() - started).total_seconds(), 3)
+            }
+            
+            summary = result["summary"]
+            return Response({
+                "status": status.HTTP_200_OK,
+                "message": f"Simulated payroll for {summary['employees']} employees, {summary['changed']} affected",
+                "data": result
+            }, status=status.HTTP_200_OK)
+            
+        except ScenarioError as e:
+            return Response({
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": str(e),
+                "data": []
+            }, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({
+                "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                "message": str(e),
+                "data": []
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
 # ==================== PAYROLL MONTHLY REPORT ====================
@@ -10,13 +10,15 @@ from django.shortcuts import get_object_or_404
 from django.db import transaction
 from django.db.models import Q, Count, Sum, Avg
 from django.utils import timezone
+from django.http import StreamingHttpResponse
 from datetime import datetime, date, timedelta
 
-from .models import Attendance
+from .models import Attendance, DailyAttendanceSummary
 from AuthN.models import BaseUserModel, UserProfile
 from .serializers import AttendanceSerializer
 from AuthN.serializers import UserProfileReadSerializer
 from utils.pagination_utils import CustomPagination
+from utils.Attendance.employee_daily_info_service import EmployeeDailyInfoService
 
 
 class AttendanceDashboardAPIView(APIView):
@@ -29,35 +31,31 @@ class AttendanceDashboardAPIView(APIView):
             
             today = date.today()
             
-            # Today's Statistics
-            today_attendance = Attendance.objects.filter(
+            # Today's Statistics (one rollup row per employee-day)
+            present = DailyAttendanceSummary.objects.filter(
                 user__own_user_profile__organization=organization,
-                attendance_date=today
-            )
-            
-            present = today_attendance.filter(check_in_time__isnull=False).count()
+                attendance_date=today,
+                first_check_in__isnull=False
+            ).count()
             absent = UserProfile.objects.filter(
                 organization=organization,
                 user__is_active=True
             ).count() - present
             
-            # This Month Statistics
+            # This Month Statistics: averages are per employee-day
             month_start = date(today.year, today.month, 1)
-            month_attendance = Attendance.objects.filter(
+            month_totals = DailyAttendanceSummary.objects.filter(
                 user__own_user_profile__organization=organization,
                 attendance_date__gte=month_start,
                 attendance_date__lte=today
+            ).aggregate(
+                total=Sum('total_working_minutes'),
+                avg=Avg('total_working_minutes'),
+                records=Count('id')
             )
             
-            total_working_hours = month_attendance.aggregate(
-                total=Sum('total_working_minutes')
-            )['total'] or 0
-            total_working_hours = total_working_hours / 60  # Convert to hours
-            
-            avg_working_hours = month_attendance.aggregate(
-                avg=Avg('total_working_minutes')
-            )['avg'] or 0
-            avg_working_hours = avg_working_hours / 60
+            total_working_hours = (month_totals['total'] or 0) / 60  # Convert to hours
+            avg_working_hours = (month_totals['avg'] or 0) / 60
             
             return Response({
                 "status": status.HTTP_200_OK,
@@ -71,7 +69,7 @@ class AttendanceDashboardAPIView(APIView):
                     "this_month": {
                         "total_working_hours": round(total_working_hours, 2),
                         "average_working_hours": round(avg_working_hours, 2),
-                        "total_records": month_attendance.count()
+                        "total_records": month_totals['records']
                     }
                 }
             })
@@ -197,78 +195,21 @@ class EmployeeDailyInfoAPIView(APIView):
             employee_id = request.query_params.get('employee_id')
             status_filter = request.query_params.get('status')  # present/absent
             
-            # Get all employees under admin
-            employees_queryset = UserProfile.objects.filter(
-                admin=admin,
-                user__is_active=True
-            ).select_related('user')
-            
-            # Filter by specific employee
-            if employee_id:
-                employees_queryset = employees_queryset.filter(user_id=employee_id)
+            # Employees under admin (optionally one employee)
+            employees_queryset = EmployeeDailyInfoService.employees(admin, employee_id)
             
-            employees_data = []
-            
-            for profile in employees_queryset:
-                # Get attendance for the target date
-                try:
-                    attendance = Attendance.objects.get(
-                        user=profile.user,
-                        attendance_date=target_date
-                    )
-                    attendance_data = {
-                        "id": str(attendance.id),
-                        "check_in_time": attendance.check_in_time.strftime('%H:%M:%S') if attendance.check_in_time else None,
-                        "check_out_time": attendance.check_out_time.strftime('%H:%M:%S') if attendance.check_out_time else None,
-                        "working_hours": float(attendance.working_hours) if attendance.working_hours else 0.0,
-                        "status": "present",
-                        "check_in_location": attendance.check_in_location,
-                        "check_out_location": attendance.check_out_location,
-                        "check_in_image": attendance.check_in_image.url if attendance.check_in_image else None,
-                    }
-                    is_present = True
-                except Attendance.DoesNotExist:
-                    attendance_data = {
-                        "id": None,
-                        "check_in_time": None,
-                        "check_out_time": None,
-                        "working_hours": 0.0,
-                        "status": "absent",
-                        "check_in_location": None,
-                        "check_out_location": None,
-                        "check_in_image": None,
-                    }
-                    is_present = False
-                
-                # Apply status filter
-                if status_filter:
-                    if status_filter == 'present' and not is_present:
-                        continue
-                    elif status_filter == 'absent' and is_present:
-                        continue
-                
-                # Build employee data
-                employee_info = {
-                    "employee_id": str(profile.user.id),
-                    "user_name": profile.user_name,
-                    "email": profile.user.email,
-                    "custom_employee_id": profile.custom_employee_id,
-                    "designation": profile.designation,
-                    "job_title": profile.job_title,
-                    "profile_photo": profile.profile_photo.url if profile.profile_photo else None,
-                    "phone_number": profile.user.phone_number,
-                    "date": target_date.strftime('%Y-%m-%d'),
-                    "attendance": attendance_data
-                }
-                
-                employees_data.append(employee_info)
+            # One query for the whole day's attendance, multi-punch days aggregated
+            attendance_map = EmployeeDailyInfoService.attendance_map(employees_queryset, target_date)
             
             # Summary
-            total_employees = len(employees_queryset)
-            present_count = sum(1 for emp in employees_data if emp['attendance']['status'] == 'present')
+            total_employees = employees_queryset.count()
+            present_count = len(attendance_map)
             absent_count = total_employees - present_count
             
-            return Response({
+            # Apply status filter
+            employees_queryset = EmployeeDailyInfoService.filter_status(employees_queryset, target_date, status_filter)
+            
+            envelope = {
                 "status": status.HTTP_200_OK,
                 "message": "Employee daily info fetched successfully",
                 "date": target_date.strftime('%Y-%m-%d'),
@@ -276,9 +217,14 @@ class EmployeeDailyInfoAPIView(APIView):
                     "total_employees": total_employees,
                     "present": present_count,
                     "absent": absent_count
-                },
-                "data": employees_data
-            })
+                }
+            }
+            
+            # Stream the employee list instead of building it in memory
+            return StreamingHttpResponse(
+                EmployeeDailyInfoService.stream(employees_queryset, target_date, attendance_map, envelope),
+                content_type="application/json"
+            )
             
         except BaseUserModel.DoesNotExist:
             return Response({
@@ -0,0 +1,43 @@
+from datetime import date, datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+
+from WorkLog.models import Attendance
+from utils.Attendance.daily_summary_service import DailyAttendanceSummaryService
+
+
+class Command(BaseCommand):
+    help = 'Backfills/rebuilds DailyAttendanceSummary rows from Attendance sessions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='from_date', help='First date (YYYY-MM-DD), default: earliest attendance')
+        parser.add_argument('--to', dest='to_date', help='Last date (YYYY-MM-DD), default: today')
+        parser.add_argument('--user', dest='user_ids', action='append', help='Only this user id (repeatable)')
+        parser.add_argument('--batch-days', type=int, default=7, help='Days recomputed per transaction (default: 7)')
+
+    def handle(self, *args, **options):
+        try:
+            from_date = self._parse_date(options['from_date'])
+            to_date = self._parse_date(options['to_date']) or date.today()
+        except ValueError:
+            raise CommandError('Dates must be in YYYY-MM-DD format')
+
+        if from_date is None:
+            from_date = Attendance.objects.aggregate(first=Min('attendance_date'))['first']
+            if from_date is None:
+                self.stdout.write(self.style.WARNING('No attendance records, nothing to rebuild'))
+                return
+
+        if from_date > to_date:
+            raise CommandError('--from must be on or before --to')
+
+        self.stdout.write(f'Rebuilding daily attendance summaries from {from_date} to {to_date}...')
+        written = DailyAttendanceSummaryService.rebuild(
+            from_date, to_date, user_ids=options['user_ids'], batch_days=max(options['batch_days'], 1)
+        )
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {written} daily attendance summaries'))
+
+    @staticmethod
+    def _parse_date(value):
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
@@ -40,6 +40,9 @@ class Attendance(models.Model):
     early_exit_minutes = models.IntegerField(default=0)
     remarks = models.TextField(null=True, blank=True)
     attachments = models.JSONField(null=True, blank=True)
+    # Idempotency keys of the queued punches that opened/closed this record (write-behind ingest)
+    check_in_punch_key = models.CharField(max_length=64, null=True, blank=True, unique=True)
+    check_out_punch_key = models.CharField(max_length=64, null=True, blank=True, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -49,5 +52,74 @@ class Attendance(models.Model):
             models.Index(fields=['user', 'attendance_date', 'check_out_time'], name='idx_user_date_checkout'),
             models.Index(fields=['user', 'attendance_date'], name='idx_user_date'),
             models.Index(fields=['attendance_date', 'attendance_status'], name='idx_date_status'),
+            # Open sessions only: drives the set-based auto-checkout UPDATE
+            models.Index(
+                fields=['attendance_date', 'assign_shift'],
+                name='idx_open_date_shift',
+                condition=models.Q(check_out_time__isnull=True)
+            ),
+        ]
+        ordering = ['-attendance_date', '-check_in_time']
+
+class AttendanceExportJob(models.Model):
+    """Background attendance report export for date ranges too large to stream inline"""
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    FORMAT_CHOICES = [('xlsx', 'XLSX'), ('csv', 'CSV')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    admin = models.ForeignKey(BaseUserModel, on_delete=models.CASCADE, related_name='attendance_export_jobs')
+    user = models.ForeignKey(BaseUserModel, on_delete=models.CASCADE, null=True, blank=True, related_name='+')  # Single-employee export
+    from_date = models.DateField()
+    to_date = models.DateField()
+    status_filter = models.CharField(max_length=20, null=True, blank=True)
+    file_format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default='xlsx')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    file_path = models.CharField(max_length=500, null=True, blank=True)  # Relative to MEDIA_ROOT
+    row_count = models.IntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'WorkLog_attendance_export_job'
+        ordering = ['-created_at']
+
+
+class DailyAttendanceSummary(models.Model):
+    """
+    One row per employee-day, rolled up from that day's Attendance sessions.
+    Maintained by DailyAttendanceSummaryService on punch, edit and auto-checkout;
+    rebuild with `python manage.py rebuild_daily_attendance_summary`.
+    """
+    id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(BaseUserModel, on_delete=models.CASCADE, related_name='daily_attendance_summaries')
+    attendance_date = models.DateField()
+    assign_shift = models.ForeignKey(ServiceShift, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')  # Shift of the first check-in
+    attendance_status = models.CharField(max_length=50)  # 'present' if any session is present
+    first_check_in = models.DateTimeField(null=True, blank=True)
+    last_check_out = models.DateTimeField(null=True, blank=True)
+    total_working_minutes = models.IntegerField(default=0)
+    total_break_minutes = models.IntegerField(default=0)
+    is_late = models.BooleanField(default=False)
+    late_minutes = models.IntegerField(default=0)
+    is_early_exit = models.BooleanField(default=False)
+    early_exit_minutes = models.IntegerField(default=0)
+    overtime_minutes = models.IntegerField(default=0)
+    session_count = models.IntegerField(default=0)
+    has_open_session = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'WorkLog_daily_attendance_summary'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'attendance_date'], name='uniq_daily_summary_user_date'),
+        ]
+        indexes = [
+            models.Index(fields=['attendance_date', 'attendance_status'], name='idx_summary_date_status'),
+            models.Index(fields=['updated_at'], name='idx_summary_updated_at'),  # Payroll attendance sweep
         ]
-        ordering = ['-attendance_date', '-check_in_time']
\ No newline at end of file
@@ -69,6 +69,15 @@ class AttendanceSerializer(serializers.ModelSerializer):
         return attendance
 
 
+class AttendanceCheckInSerializer(AttendanceSerializer):
+    """Check-in serializer: user and shift come from the punch context, so validation needs no FK lookups"""
+
+    class Meta:
+        model = Attendance
+        exclude = ['user', 'assign_shift']
+        read_only_fields = AttendanceSerializer.Meta.read_only_fields
+
+
 class AttendanceOutputSerializer(serializers.Serializer):
     id = serializers.IntegerField(allow_null=True)
     user_id = serializers.CharField(allow_null=True)  # Add user_id UUID
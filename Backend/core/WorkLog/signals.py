@@ -0,0 +1,77 @@
+"""
+Punch-context cache invalidation and daily summary maintenance.
+
+The check-in/check-out API reads shifts, week-offs and organization settings
+from PunchContextService. These receivers drop the cached context whenever one
+of its inputs changes (AssignShiftToUserAPIView, AssignWeekOffToUserAPIView,
+OrganizationSettingsAPIView, profile edits and shift/week-off policy edits).
+
+Attendance saves/deletes mark the employee-day dirty in DailyAttendanceSummary.
+"""
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+
+from AuthN.models import UserProfile, OrganizationSettings
+from ServiceShift.models import ServiceShift
+from ServiceWeekOff.models import WeekOffPolicy
+from utils.Attendance.punch_context import PunchContextService
+from utils.Attendance.daily_summary_service import DailyAttendanceSummaryService
+from .models import Attendance
+
+
+def _invalidate_m2m(instance, action, reverse, pk_set, reverse_accessor):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if not reverse:
+        # UserProfile.shifts / UserProfile.week_offs changed
+        PunchContextService.invalidate_users([instance.user_id])
+    elif pk_set:
+        # ServiceShift.users_shifts / WeekOffPolicy.users_week_off changed
+        PunchContextService.invalidate_users(
+            UserProfile.objects.filter(pk__in=pk_set).values_list('user_id', flat=True)
+        )
+    else:
+        PunchContextService.invalidate_users(
+            getattr(instance, reverse_accessor).values_list('user_id', flat=True)
+        )
+
+
+@receiver(m2m_changed, sender=UserProfile.shifts.through)
+def invalidate_on_shift_assignment(sender, instance, action, reverse, pk_set, **kwargs):
+    _invalidate_m2m(instance, action, reverse, pk_set, 'users_shifts')
+
+
+@receiver(m2m_changed, sender=UserProfile.week_offs.through)
+def invalidate_on_week_off_assignment(sender, instance, action, reverse, pk_set, **kwargs):
+    _invalidate_m2m(instance, action, reverse, pk_set, 'users_week_off')
+
+
+@receiver(post_save, sender=ServiceShift)
+@receiver(pre_delete, sender=ServiceShift)
+def invalidate_on_shift_change(sender, instance, **kwargs):
+    # pre_delete: the assignment rows are gone by post_delete; invalidation repeats after commit
+    PunchContextService.invalidate_users(list(instance.users_shifts.values_list('user_id', flat=True)))
+
+
+@receiver(post_save, sender=WeekOffPolicy)
+@receiver(pre_delete, sender=WeekOffPolicy)
+def invalidate_on_week_off_change(sender, instance, **kwargs):
+    PunchContextService.invalidate_users(list(instance.users_week_off.values_list('user_id', flat=True)))
+
+
+@receiver(post_save, sender=UserProfile)
+@receiver(post_delete, sender=UserProfile)
+def invalidate_on_profile_change(sender, instance, **kwargs):
+    PunchContextService.invalidate_users([instance.user_id])
+
+
+@receiver(post_save, sender=OrganizationSettings)
+def invalidate_on_organization_settings_change(sender, instance, **kwargs):
+    PunchContextService.invalidate_organization(instance.organization_id)
+
+
+@receiver(post_save, sender=Attendance)
+@receiver(post_delete, sender=Attendance)
+def refresh_daily_summary_on_attendance_change(sender, instance, **kwargs):
+    DailyAttendanceSummaryService.mark_dirty([(instance.user_id, instance.attendance_date)])
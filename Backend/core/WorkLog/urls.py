@@ -27,7 +27,7 @@ urlpatterns = [
     # ==================== Employee Attendance Fetching ====================
     
     # GET: Fetch attendance for all employees under an admin for a specific date
-    # Query params: date (required), status (optional), export (optional), page, page_size
+    # Query params: date (required), status (optional), export (optional), export_format (xlsx/csv), to_date, cursor, page, page_size
     path(
         'employee-attendance/<uuid:admin_id>',
         FetchEmployeeAttendanceAPIView.as_view(),
@@ -35,13 +35,21 @@ urlpatterns = [
     ),
     
     # GET: Fetch attendance for a specific employee under an admin for a specific date
-    # Query params: date (required), status (optional), export (optional), page, page_size
+    # Query params: date (required), status (optional), export (optional), export_format (xlsx/csv), to_date, cursor, page, page_size
     path(
         'employee-attendance/<uuid:admin_id>/<uuid:user_id>',
         FetchEmployeeAttendanceAPIView.as_view(),
         name='fetch-employee-attendance-by-user'
     ),
     
+    # GET: Status of a background attendance export (export=true with a to_date range
+    # longer than ATTENDANCE_EXPORT_SYNC_MAX_DAYS); ?download=true returns the file
+    path(
+        'attendance-export-job/<uuid:admin_id>/<uuid:job_id>',
+        AttendanceExportJobAPIView.as_view(),
+        name='attendance-export-job'
+    ),
+    
     # GET: Fetch monthly present/absent count for a specific employee
     # Returns: present_days and absent_days count for the given month and year
     path(
@@ -4,111 +4,91 @@ from rest_framework.response import Response
 from rest_framework import status
 from datetime import datetime, date, timedelta
 from calendar import monthrange
-from .models import Attendance
+from .models import Attendance, AttendanceExportJob, DailyAttendanceSummary
 from AuthN.models import BaseUserModel, UserProfile, AdminProfile
 from .serializers import *
 from django.shortcuts import get_object_or_404
 from django.db.models import Q, Count, Case, When, IntegerField
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse
 from django.core.cache import cache
 from django.db import transaction
 from utils.Attendance.attendance_utils import *
 from utils.pagination_utils import CustomPagination
-from utils.helpers.image_utils import save_multiple_base64_images, save_base64_image
+from utils.helpers.image_utils import save_multiple_base64_images
 import openpyxl
 from openpyxl.styles import Font, Alignment, PatternFill
 from io import BytesIO
 from utils.Attendance.attendance_excel_export_service import ExcelExportService
 from utils.Attendance.attendance_edit_service import AttendanceEditService
+from utils.Attendance.punch_ingest_service import PunchIngestService
+from utils.Attendance.attendance_image_service import AttendanceImageService
+from utils.Attendance.punch_context import PunchContextService
+from utils.Attendance.attendance_roster_service import AttendanceRosterService
+from utils.Attendance.daily_summary_service import DailyAttendanceSummaryService
+from django.conf import settings
 import traceback
+import logging
+import os
+
+logger = logging.getLogger(__name__)
 
 
 
 class AttendanceCheckInOutAPIView(APIView):
     """
     Optimized Check-In/Check-Out API for high traffic (100k+ calls/day)
-    - Uses select_related to avoid N+1 queries
-    - Caches user profile data
+    - Reads profile, shifts and org settings from the cached punch context
+      (invalidated by signals, not per punch): one attendance read + one write
     - Uses update() for faster database writes
     - Optimized shift lookup
     """
 
     @transaction.atomic
     def post(self, request, userid):
+        # Write-behind mode: acknowledge the punch and let the worker apply it in batches
+        if getattr(settings, 'ATTENDANCE_PUNCH_INGEST_MODE', 'sync') == 'queued':
+            return self._enqueue_punch(request, userid)
+
         try:
             today = date.today()
             check_time = datetime.now()
             
-            # Optimized: Fetch user with related profile in single query
-            user = BaseUserModel.objects.select_related(
-                'own_user_profile',
-                'own_user_profile__admin',
-                'own_user_profile__organization'
-            ).only(
-                'id',
-                'own_user_profile__admin_id',
-                'own_user_profile__organization_id',
-                'own_user_profile__profile_photo'
-            ).get(id=userid)
-            
-            user_profile = user.own_user_profile
+            # Cached punch context (profile ids, shifts, week-offs, org settings); invalidated by signals
+            punch_context = PunchContextService.get(userid)
 
             # 🟦 CHECKOUT FLOW - Optimized query with select_related
+            # A night shift started yesterday is still open after midnight
             open_attendance = Attendance.objects.select_related(
                 'assign_shift'
             ).only(
-                'id', 'check_in_time', 'assign_shift__end_time', 
-                'assign_shift__duration_minutes'
+                'id', 'attendance_date', 'check_in_time', 'attachments', 'assign_shift__start_time',
+                'assign_shift__end_time', 'assign_shift__duration_minutes'
             ).filter(
+                Q(attendance_date=today) |
+                Q(attendance_date=today - timedelta(days=1), assign_shift__is_night_shift=True),
                 user_id=userid,
-                attendance_date=today,
                 check_out_time__isnull=True
-            ).first()
+            ).order_by('-attendance_date').first()
 
             if open_attendance:
-                # 1️⃣ Total working minutes
-                total_minutes = calculate_total_working_minutes(
+                # Working, early exit and overtime minutes against the assigned shift window
+                update_data = calculate_checkout_metrics(
                     open_attendance.check_in_time,
-                    check_time
+                    check_time,
+                    open_attendance.assign_shift,
+                    open_attendance.attendance_date
                 )
                 # Check if time is at least 10 seconds
-                if total_minutes is None:
-                    # Calculate seconds to check minimum requirement
+                if update_data is None:
                     total_seconds = (check_time - open_attendance.check_in_time).total_seconds()
-                    if total_seconds < 10:
-                        remaining_seconds = int(10 - total_seconds)
-                        return Response({
-                            "status": status.HTTP_400_BAD_REQUEST,
-                            "message": f"Working time too short. Please wait {remaining_seconds} more second(s). Minimum 10 seconds required.",
-                            "remaining_seconds": remaining_seconds,
-                            "elapsed_seconds": int(total_seconds),
-                            "data": []
-                        }, status=status.HTTP_400_BAD_REQUEST)
-                    # If >= 10 seconds but < 1 minute, set to 0 minutes (will be stored as 0)
-                    total_minutes = 0
-
-                # 2️⃣ Early exit minutes
-                early_exit = 0
-                if open_attendance.assign_shift and open_attendance.assign_shift.end_time:
-                    early_exit = calculate_early_exit_minutes(
-                        check_time,
-                        open_attendance.assign_shift.end_time
-                    )
-
-                # 3️⃣ Overtime minutes
-                expected_hours = 8
-                if open_attendance.assign_shift and open_attendance.assign_shift.duration_minutes:
-                    expected_hours = open_attendance.assign_shift.duration_minutes / 60
-                overtime = calculate_overtime_minutes(total_minutes, expected_hours=expected_hours)
-
-                # Prepare update data
-                update_data = {
-                    'check_out_time': check_time,
-                    'total_working_minutes': total_minutes,
-                    'early_exit_minutes': early_exit,
-                    'overtime_minutes': overtime,
-                    'is_early_exit': True if (early_exit and early_exit > 0) else False
-                }
+                    remaining_seconds = int(10 - total_seconds)
+                    return Response({
+                        "status": status.HTTP_400_BAD_REQUEST,
+                        "message": f"Working time too short. Please wait {remaining_seconds} more second(s). Minimum 10 seconds required.",
+                        "remaining_seconds": remaining_seconds,
+                        "elapsed_seconds": int(total_seconds),
+                        "data": []
+                    }, status=status.HTTP_400_BAD_REQUEST)
                 
                 # Add location data if provided
                 if request.data.get("check_out_latitude") and request.data.get("check_out_longitude"):
@@ -119,31 +99,22 @@ class AttendanceCheckInOutAPIView(APIView):
                 if request.data.get("check_out_location"):
                     update_data['check_out_location'] = request.data.get("check_out_location")
                 
-                # Update profile photo from selfie if provided (update on every checkout)
-                base64_images = request.data.get("base64_images")
-                if base64_images:
-                    # Normalize to list if single string
-                    if isinstance(base64_images, str):
-                        base64_images = [base64_images]
-                    
-                    # Update profile photo on every checkout
-                    if base64_images and len(base64_images) > 0:
-                        try:
-                            saved_image = save_base64_image(
-                                base64_images[0],
-                                folder_name='profile_photos',
-                                attendance_type='profile',
-                                captured_at=check_time
-                            )
-                            # Update user profile photo
-                            user_profile.profile_photo = saved_image.get('file_path', '')
-                            user_profile.save(update_fields=['profile_photo'])
-                        except Exception as e:
-                            # Log error but don't fail checkout
-                            print(f"Error updating profile photo: {str(e)}")
+                # Selfie: spool raw bytes now, decode/compress/profile photo update happen in the worker
+                base64_image = AttendanceImageService.first_image(request.data.get("base64_images"))
+                attachment = None
+                if base64_image:
+                    try:
+                        attachment = AttendanceImageService.spool_attachment(base64_image, 'check_out', check_time)
+                        update_data['attachments'] = (open_attendance.attachments or []) + [attachment]
+                    except ValueError as e:
+                        # Invalid image: drop the selfie but don't fail checkout
+                        logger.warning("Selfie not spooled for checkout of user %s: invalid image (%s)", userid, e)
                 
                 # Optimized: Use update() instead of save() for better performance
                 Attendance.objects.filter(id=open_attendance.id).update(**update_data)
+                DailyAttendanceSummaryService.mark_dirty([(userid, open_attendance.attendance_date)])
+                if attachment:
+                    AttendanceImageService.dispatch(open_attendance.id, attachment["id"])
 
                 return Response({
                     "status": status.HTTP_200_OK,
@@ -152,29 +123,15 @@ class AttendanceCheckInOutAPIView(APIView):
                 }, status=status.HTTP_200_OK)
 
             # 🟩 CHECK-IN FLOW
-            # Optimized: Cache shifts lookup per user (5 min cache)
-            cache_key = f"user_shifts_{userid}"
-            shifts = cache.get(cache_key)
-            
-            if shifts is None:
-                shifts = list(user_profile.shifts.all().only('id', 'start_time', 'end_time', 'duration_minutes'))
-                cache.set(cache_key, shifts, 300)  # Cache for 5 minutes
-            
-            nearest_shift, late_minutes = get_nearest_shift_with_late_minutes(
-                check_time,
-                shifts
-            )
+            # Nearest shift start decides the shift and the attendance date (night shifts)
+            nearest_shift, late_minutes, attendance_date = punch_context["shift_timeline"].resolve(check_time)
 
             # Prepare payload with minimal data
             payload = {
-                "user": str(user.id),
-                "admin": str(user_profile.admin_id),
-                "organization": str(user_profile.organization_id),
-                "attendance_date": today,
+                "attendance_date": attendance_date,
                 "check_in_time": check_time,
                 "attendance_status": "present",
                 "marked_by": request.data.get("marked_by", "mobile"),
-                "assign_shift": str(nearest_shift.id) if nearest_shift else None,
                 "late_minutes": late_minutes or 0,
                 "is_late": True if (late_minutes and late_minutes > 0) else False
             }
@@ -188,39 +145,23 @@ class AttendanceCheckInOutAPIView(APIView):
             if request.data.get("check_in_location"):
                 payload["check_in_location"] = request.data.get("check_in_location")
             
-            serializer = AttendanceSerializer(data=payload)
+            # Selfie: spool raw bytes now, decode/compress/profile photo update happen in the worker
+            base64_image = AttendanceImageService.first_image(request.data.get("base64_images"))
+            attachment = None
+            if base64_image:
+                try:
+                    attachment = AttendanceImageService.spool_attachment(base64_image, 'check_in', check_time)
+                    payload["attachments"] = [attachment]
+                except ValueError as e:
+                    # Invalid image: drop the selfie but don't fail check-in
+                    logger.warning("Selfie not spooled for check-in of user %s: invalid image (%s)", userid, e)
+            
+            serializer = AttendanceCheckInSerializer(data=payload)
             if serializer.is_valid():
-                serializer.save()
+                attendance = serializer.save(user_id=punch_context["user_id"], assign_shift=nearest_shift)
+                if attachment:
+                    AttendanceImageService.dispatch(attendance.id, attachment["id"])
                 
-                # Update profile photo from selfie if provided (update on every check-in)
-                base64_images = request.data.get("base64_images")
-                if base64_images:
-                    # Normalize to list if single string
-                    if isinstance(base64_images, list) and len(base64_images) > 0:
-                        base64_image = base64_images[0]
-                    elif isinstance(base64_images, str):
-                        base64_image = base64_images
-                    else:
-                        base64_image = None
-                    
-                    # Update profile photo on every check-in
-                    if base64_image:
-                        try:
-                            saved_image = save_base64_image(
-                                base64_image,
-                                folder_name='profile_photos',
-                                attendance_type='profile',
-                                captured_at=check_time
-                            )
-                            # Update user profile photo
-                            user_profile.profile_photo = saved_image.get('file_path', '')
-                            user_profile.save(update_fields=['profile_photo'])
-                        except Exception as e:
-                            # Log error but don't fail check-in
-                            print(f"Error updating profile photo: {str(e)}")
-                
-                # Invalidate cache after check-in
-                cache.delete(cache_key)
                 return Response({
                     "status": status.HTTP_201_CREATED,
                     "message": "Checked in successfully.",
@@ -247,6 +188,42 @@ class AttendanceCheckInOutAPIView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+    def _enqueue_punch(self, request, userid):
+        """Validate and append the punch to the ingest queue (202 Accepted)"""
+        try:
+            idempotency_key = request.headers.get("Idempotency-Key") or request.data.get("punch_id")
+            punch, duplicate = PunchIngestService.accept(userid, request.data, idempotency_key)
+
+            return Response({
+                "status": status.HTTP_202_ACCEPTED,
+                "message": "Punch already received." if duplicate else "Punch received.",
+                "data": {
+                    "punch_id": punch["punch_id"],
+                    "punched_at": punch["punched_at"],
+                    "duplicate": duplicate
+                }
+            }, status=status.HTTP_202_ACCEPTED)
+
+        except BaseUserModel.DoesNotExist:
+            return Response({
+                "status": status.HTTP_404_NOT_FOUND,
+                "message": "User not found.",
+                "data": []
+            }, status=status.HTTP_404_NOT_FOUND)
+        except ValueError as e:
+            return Response({
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": str(e),
+                "data": []
+            }, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response({
+                "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+                "message": str(e),
+                "data": []
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 class FetchEmployeeAttendanceAPIView(APIView):
     pagination_class = CustomPagination
 
@@ -265,89 +242,57 @@ class FetchEmployeeAttendanceAPIView(APIView):
 
             attendance_date = datetime.strptime(q_date, "%Y-%m-%d").date()
 
-            # If user_id is provided in URL path, filter by single employee
-            if user_id:
-                try:
-                    # Verify employee belongs to the admin
-                    employee = UserProfile.objects.select_related("user").get(
-                        user_id=user_id,
-                        admin_id=admin_id
-                    )
-                    employees = [employee]
-                except UserProfile.DoesNotExist:
-                    return Response({
-                        "status": status.HTTP_404_NOT_FOUND,
-                        "message": "Employee not found or does not belong to this admin",
-                        "data": []
-                    }, status=status.HTTP_404_NOT_FOUND)
-            else:
-                # Filter by admin_id (all employees under admin)
-                if not admin_id:
-                    return Response({
-                        "status": status.HTTP_400_BAD_REQUEST,
-                        "message": "admin_id is required",
-                        "data": []
-                    }, status=status.HTTP_400_BAD_REQUEST)
-                
-                employees = UserProfile.objects.filter(
-                    admin_id=admin_id
-                ).select_related("user", "user__own_user_profile")
+            if not admin_id:
+                return Response({
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "message": "admin_id is required",
+                    "data": []
+                }, status=status.HTTP_400_BAD_REQUEST)
 
-            data = AttendanceService.build_employee_structure(employees, attendance_date)
+            # Roster annotated in SQL; user_id in the URL path narrows it to one employee
+            employees = AttendanceRosterService.employees(admin_id, attendance_date, user_id=user_id)
+            filtered, status_q = AttendanceRosterService.filter_status(employees, status_param)
 
-            records = Attendance.objects.filter(
-                user_id__in=list(data.keys()),
-                attendance_date=attendance_date
-            ).select_related("user", "assign_shift", "user__own_user_profile").order_by('-id')
+            # ------------------- Summary (one conditional aggregate) -------------------
+            summary, total_objects = AttendanceRosterService.summary(employees, status_q)
+            summary["attendance_date"] = attendance_date.strftime("%Y-%m-%d")
 
-            
-            data = AttendanceService.aggregate_records(records, data)
-            print(data, "--------------")
-            final_data = AttendanceService.finalize_status(data)
-
-            # Filter by status_param if provided
-            if status_param:
-                status_param = status_param.lower()
-                if status_param == "late":
-                    final_data = [x for x in final_data if x.get("is_late")]
-                elif status_param == "present":
-                    final_data = [x for x in final_data if x.get("attendance_status") == "present"]
-                elif status_param == "absent":
-                    final_data = [x for x in final_data if x.get("attendance_status") == "absent"]
-                print(final_data, "--------------")
+            if user_id and not summary["total_employees"]:
+                return Response({
+                    "status": status.HTTP_404_NOT_FOUND,
+                    "message": "Employee not found or does not belong to this admin",
+                    "data": []
+                }, status=status.HTTP_404_NOT_FOUND)
 
             if export:
-                return ExcelExportService.generate(final_data, attendance_date)
+                return self._export(request, admin_id, user_id, attendance_date, status_param)
 
-            # Paginate
+            # Paginate: keyset via `cursor`, `page` kept as an offset fallback
             page = int(request.query_params.get("page", 1))
             page_size = int(request.query_params.get("page_size", 20))
-            start = (page - 1) * page_size
+            cursor = request.query_params.get("cursor")
 
+            try:
+                profiles, next_cursor = AttendanceRosterService.page(filtered, page_size, cursor=cursor, page=page)
+            except ValueError as e:
+                return Response({
+                    "status": status.HTTP_400_BAD_REQUEST,
+                    "message": str(e),
+                    "data": []
+                }, status=status.HTTP_400_BAD_REQUEST)
 
-            serializer = AttendanceOutputSerializer(final_data[start:start + page_size], many=True)
-
-            # ------------------- Summary -------------------
-            total_emp = len(employees) if user_id else employees.count()
-            present = records.filter(attendance_status="present").values("user_id").distinct().count()
-            late = records.filter(is_late=True).values("user_id").distinct().count()
-            absent = total_emp - records.values("user_id").distinct().count()
-
-            summary = {
-                "total_employees": total_emp,
-                "present": present,
-                "late_login": late,
-                "absent": absent,
-                "attendance_date": attendance_date.strftime("%Y-%m-%d")
-            }
+            serializer = AttendanceOutputSerializer(
+                AttendanceRosterService.build_rows(profiles, attendance_date), many=True
+            )
 
             return Response({
                 "status": status.HTTP_200_OK,
                 "message": "Attendance fetched successfully",
                 "data": serializer.data,
                 "summary": summary,
-                "total_objects": len(final_data),
-                "current_page_number": page
+                "total_objects": total_objects,
+                "current_page_number": page,
+                "next_cursor": next_cursor
             }, status=status.HTTP_200_OK)
 
         except Exception as e:
@@ -362,6 +307,119 @@ class FetchEmployeeAttendanceAPIView(APIView):
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+    def _export(self, request, admin_id, user_id, from_date, status_param):
+        """
+        Streams the report for `date`..`to_date`; ranges longer than
+        ATTENDANCE_EXPORT_SYNC_MAX_DAYS become an AttendanceExportJob (202).
+        """
+        file_format = request.query_params.get("export_format", "xlsx").lower()
+        if file_format not in ExcelExportService.CONTENT_TYPES:
+            return Response({
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": "export_format must be 'xlsx' or 'csv'",
+                "data": []
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        q_to_date = request.query_params.get("to_date")
+        to_date = datetime.strptime(q_to_date, "%Y-%m-%d").date() if q_to_date else from_date
+        days = (to_date - from_date).days + 1
+        if days < 1 or days > getattr(settings, 'ATTENDANCE_EXPORT_MAX_DAYS', 366):
+            return Response({
+                "status": status.HTTP_400_BAD_REQUEST,
+                "message": "to_date must be on or after date and within the maximum export range",
+                "data": []
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        if days <= getattr(settings, 'ATTENDANCE_EXPORT_SYNC_MAX_DAYS', 7):
+            rows = AttendanceRosterService.iter_range_rows(admin_id, from_date, to_date, status_param, user_id=user_id)
+            label = from_date if days == 1 else f"{from_date}_to_{to_date}"
+            return ExcelExportService.generate(rows, label, file_format)
+
+        from core.tasks import export_attendance_report_task
+
+        job = AttendanceExportJob.objects.create(
+            admin_id=admin_id,
+            user_id=user_id,
+            from_date=from_date,
+            to_date=to_date,
+            status_filter=status_param,
+            file_format=file_format
+        )
+        try:
+            export_attendance_report_task.delay(str(job.id))
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            job.save(update_fields=['status', 'error'])
+            return Response({
+                "status": status.HTTP_503_SERVICE_UNAVAILABLE,
+                "message": "Could not queue the export, please try again",
+                "data": []
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        return Response({
+            "status": status.HTTP_202_ACCEPTED,
+            "message": "Export queued. Poll the export job for the download.",
+            "data": {"job_id": str(job.id), "status": job.status}
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class AttendanceExportJobAPIView(APIView):
+    """Status of a background attendance export; ?download=true returns the file once completed"""
+
+    def get(self, request, admin_id, job_id):
+        try:
+            job = AttendanceExportJob.objects.get(id=job_id, admin_id=admin_id)
+        except AttendanceExportJob.DoesNotExist:
+            return Response({
+                "status": status.HTTP_404_NOT_FOUND,
+                "message": "Export job not found",
+                "data": []
+            }, status=status.HTTP_404_NOT_FOUND)
+
+        if request.query_params.get("download") == "true":
+            if job.status != 'completed':
+                return Response({
+                    "status": status.HTTP_409_CONFLICT,
+                    "message": f"Export is {job.status}",
+                    "data": []
+                }, status=status.HTTP_409_CONFLICT)
+            try:
+                export_file = open(os.path.join(settings.MEDIA_ROOT, job.file_path), 'rb') if job.file_path else None
+            except FileNotFoundError:
+                export_file = None
+            if export_file is None:
+                # Completed, but the file was never recorded or has been cleaned up since
+                return Response({
+                    "status": status.HTTP_410_GONE,
+                    "message": "Export file is no longer available. Please export again.",
+                    "data": []
+                }, status=status.HTTP_410_GONE)
+            return FileResponse(
+                export_file,
+                as_attachment=True,
+                filename=f"attendance_{job.from_date}_to_{job.to_date}.{job.file_format}",
+                content_type=ExcelExportService.CONTENT_TYPES[job.file_format]
+            )
+
+        return Response({
+            "status": status.HTTP_200_OK,
+            "message": "Export job fetched successfully",
+            "data": {
+                "job_id": str(job.id),
+                "status": job.status,
+                "from_date": job.from_date,
+                "to_date": job.to_date,
+                "file_format": job.file_format,
+                "row_count": job.row_count,
+                "file_url": f"{settings.MEDIA_URL}{job.file_path}" if job.file_path else None,
+                "error": job.error,
+                "created_at": job.created_at,
+                "completed_at": job.completed_at
+            }
+        }, status=status.HTTP_200_OK)
+
+
 class FetchEmployeeMonthlyAttendanceAPIView(APIView):
     """
     Optimized API to fetch monthly present/absent count for employee
@@ -403,14 +461,14 @@ class FetchEmployeeMonthlyAttendanceAPIView(APIView):
             last_day = date(year, month, monthrange(year, month)[1])
             total_days = (last_day - first_day).days + 1
 
-            # Get all present dates (distinct dates where attendance_status is "present")
+            # Present dates from the daily rollup (one row per employee-day, "present" if any session is)
             present_dates_list = list(
-                Attendance.objects.filter(
+                DailyAttendanceSummary.objects.filter(
                     user_id=user_id,
                     attendance_date__gte=first_day,
                     attendance_date__lte=last_day,
                     attendance_status="present"
-                ).values_list('attendance_date', flat=True).distinct().order_by('attendance_date')
+                ).values_list('attendance_date', flat=True).order_by('attendance_date')
             )
             
             # Convert dates to string format (YYYY-MM-DD)
@@ -171,8 +171,62 @@ ATTENDANCE_IMAGE_MAX_SIZE_MB = 3  # Maximum size per image in MB (default: 3MB)
 ATTENDANCE_IMAGE_MAX_COUNT = 2  # Maximum number of images per check-in/check-out
 ATTENDANCE_IMAGE_ALLOWED_FORMATS = ['jpg', 'jpeg', 'png', 'webp']  # Allowed image formats
 ATTENDANCE_IMAGE_QUALITY = 85  # JPEG quality (1-100, lower = smaller file)
+ATTENDANCE_IMAGE_MIN_QUALITY = 20  # Lowest quality the adaptive compressor may search down to
 ATTENDANCE_IMAGE_MAX_WIDTH = 1920  # Maximum image width in pixels (will be resized if larger)
 ATTENDANCE_IMAGE_MAX_HEIGHT = 1080  # Maximum image height in pixels (will be resized if larger)
+ATTENDANCE_IMAGE_SPOOL_FOLDER = 'spool/attendance_images'  # Raw selfies awaiting process_attendance_image_task (inside MEDIA_ROOT)
+
+# Attendance Punch Ingest Settings (write-behind check-in/check-out)
+ATTENDANCE_PUNCH_INGEST_MODE = 'sync'  # 'sync' = write inline, 'queued' = ack + apply in batches via apply_attendance_punches_task
+ATTENDANCE_PUNCH_QUEUE_BACKEND = 'spool'  # 'redis' = Redis stream, 'spool' = local durable spool directory
+ATTENDANCE_PUNCH_QUEUE_URL = 'redis://localhost:6379/2'  # Used when backend is 'redis'
+ATTENDANCE_PUNCH_SPOOL_DIR = os.path.join(BASE_DIR, 'spool', 'punches')  # Used when backend is 'spool'
+ATTENDANCE_PUNCH_BATCH_SIZE = 500  # Punches applied per bulk_create/bulk_update batch
+ATTENDANCE_PUNCH_IDEMPOTENCY_TTL = 86400  # Seconds a punch_id is remembered for duplicate detection
+ATTENDANCE_PUNCH_CONTEXT_TTL = 86400  # Punch context cache lifetime; entries are invalidated by signals on change
+
+# Attendance Report Export Settings
+ATTENDANCE_EXPORT_SYNC_MAX_DAYS = 7  # Longer export ranges are produced by export_attendance_report_task
+ATTENDANCE_EXPORT_MAX_DAYS = 366  # Largest date range accepted for one export
+ATTENDANCE_EXPORT_FOLDER = 'exports/attendance'  # Background export files (inside MEDIA_ROOT)
+
+# Auto-Checkout Settings
+ATTENDANCE_AUTO_CHECKOUT_OVERLAP_MINUTES = 10  # Each run re-checks this much before its watermark (late-applied punches)
+ATTENDANCE_AUTO_CHECKOUT_INITIAL_LOOKBACK_HOURS = 36  # Window used when no watermark is stored yet
+
+# Payroll Run Settings
+PAYROLL_SYNC_MAX_EMPLOYEES = 200  # Larger generate-payroll requests are queued as a PayrollRun
+PAYROLL_RUN_CHUNK_SIZE = 200  # Employees calculated and committed per checkpoint
+PAYROLL_RUN_STALE_MINUTES = 15  # A running run without a heartbeat for this long can be taken over by a retry
+PAYROLL_PARALLEL_WORKERS = 0  # Processes calculating each run chunk in parallel (0/1 = in-process); chunks should then be larger
+PAYROLL_PARALLEL_SHARD_SIZE = 250  # Employees sent to a worker at a time
+PAYROLL_ATTENDANCE_MATRIX = True  # Payroll batches count attendance with NumPy arrays (needs numpy); False = per-day walk
+PAYROLL_WRITE_BATCH_SIZE = 500  # Rows per INSERT when payroll records and component entries are bulk-written
+PAYROLL_TAX_SLAB_REGISTRY_SIZE = 64  # Compiled TDS/PT slab tables kept per process (LRU)
+PAYROLL_TAX_SLAB_VERSION_CHECK_SECONDS = 30  # How often a process checks the cache for slab edits made elsewhere
+PAYROLL_EXPORT_CHUNK_SIZE = 2000  # Payroll register rows fetched per database round trip when exporting
+PAYROLL_SIMULATION_SNAPSHOTS = 4  # What-if payroll snapshots (month inputs + baseline) kept per process (LRU)
+PAYROLL_SIMULATION_SNAPSHOT_TTL_SECONDS = 600  # A snapshot older than this is rebuilt before simulating
+PAYROLL_ATTENDANCE_SWEEP_OVERLAP_MINUTES = 10  # Each attendance sweep re-checks this much before its watermark
+PAYROLL_ATTENDANCE_SWEEP_INITIAL_LOOKBACK_HOURS = 36  # Window swept when no watermark is stored yet
+
+# Leave Accrual Settings
+LEAVE_ACCRUAL_CHUNK_SIZE = 2000  # Employees accrued and committed per transaction
+LEAVE_ACCRUAL_WRITE_BATCH_SIZE = 500  # Rows per statement when balances and accrual logs are bulk-written
+LEAVE_ROLLOVER_CHUNK_SIZE = 2000  # Balances closed and committed per transaction at year end
+LEAVE_ROLLOVER_WRITE_BATCH_SIZE = 500  # Rows per statement when closing and next-year balances are bulk-written
+LEAVE_LEDGER_RECONCILE_CHUNK_SIZE = 5000  # Balances compared with their ledger sums per query
+LEAVE_APPLICATION_PAGE_SIZE = 100  # Leave applications per page of a year listing (cursor paginated)
+LEAVE_APPLICATION_MAX_PAGE_SIZE = 1000  # Largest page_size a year listing accepts
+
+# Work Calendar Settings
+WORK_CALENDAR_CACHE_SIZE = 256  # Compiled holiday/week-off calendars (one per admin or organization and year) kept per process (LRU)
+WORK_CALENDAR_VERSION_CHECK_SECONDS = 10  # How often a process checks the cache for holiday/week-off edits made elsewhere
+
+# Payslip PDF Settings
+PAYSLIP_PDF_FOLDER = 'payslips'  # Rendered payslips, named by a hash of their content (inside MEDIA_ROOT)
+PAYSLIP_RENDER_WORKERS = 0  # Processes rendering payslip PDFs for team downloads (0/1 = in-process)
+PAYSLIP_RENDER_CHUNK_SIZE = 200  # Payslips rendered per step of a streaming team ZIP
 
 
 # Static files (CSS, JavaScript, Images)
@@ -232,6 +286,18 @@ CELERY_BEAT_SCHEDULE = {
         'schedule': crontab(minute='*/5'),  # Every 5 minutes
     },
     
+    # Punch ingest worker - Applies queued punches (only does work in 'queued' ingest mode)
+    'apply-attendance-punches-every-5-seconds': {
+        'task': 'apply_attendance_punches_task',
+        'schedule': timedelta(seconds=5),  # Every 5 seconds
+    },
+    
+    # Payroll - Flags calculated payroll whose attendance changed since the last sweep
+    'mark-payroll-attendance-every-5-minutes': {
+        'task': 'mark_payroll_attendance_task',
+        'schedule': crontab(minute='*/5'),  # Every 5 minutes
+    },
+    
     # Notification tasks - Run every minute
     'send-scheduled-notifications-every-minute': {
         'task': 'send_scheduled_notifications_task',
@@ -279,11 +345,15 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'data_backup_task',
         'schedule': crontab(hour=2, minute=0),  # Every day at 2 AM
     },
+    'reconcile-leave-ledger-daily': {
+        'task': 'reconcile_leave_ledger_task',
+        'schedule': crontab(hour=1, minute=30),  # Every day at 1:30 AM
+    },
     
     # Monthly tasks - Additional
-    'leave-carry-forward-yearly': {
+    'leave-carry-forward-monthly': {
         'task': 'leave_carry_forward_task',
-        'schedule': crontab(hour=5, minute=0, day_of_month=1),  # 1st of every month at 5 AM
+        'schedule': crontab(hour=5, minute=0, day_of_month=1),  # 1st of every month at 5 AM; closes leave years that just ended
     },
     
     # Organization tasks - Run daily
@@ -5,7 +5,7 @@ Celery Tasks for Core Application
 from celery import shared_task
 from django.utils import timezone
 from datetime import datetime, timedelta, date, time
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from decimal import Decimal
 import logging
@@ -17,52 +17,19 @@ logger = logging.getLogger(__name__)
 def general_auto_checkout_task():
     """
     Handles general auto-checkout for organizations.
-    This checks out all pending users at a fixed time defined by the organization.
+    Checks out open attendances at the fixed time defined by each organization.
+    One set-based UPDATE per run covers every organization whose checkout time
+    passed since the previous run (see AutoCheckoutService).
     This task should be run periodically (e.g., every 5-10 minutes) by a scheduler.
     """
-    from AuthN.models import OrganizationSettings
-    from WorkLog.models import Attendance
+    from utils.Attendance.auto_checkout_service import AutoCheckoutService
     
-    now = timezone.now()
-    current_date = now.date()
-    logger.info(f"--- Running General Auto-Checkout Task at {now} ---")
+    logger.info(f"--- Running General Auto-Checkout Task at {timezone.now()} ---")
     
     try:
-        # Get organizations with general auto-checkout enabled (and shift-wise disabled to avoid conflict).
-        general_settings = OrganizationSettings.objects.filter(
-            auto_checkout_enabled=True,
-            auto_shiftwise_checkout_enabled=False,  # Ensure shift-wise is off to prevent conflicts.
-            auto_checkout_time__isnull=False,
-        )
-        
-        for setting in general_settings:
-            # Proceed only if the current time is past the organization's auto-checkout time.
-            if now.time() >= setting.auto_checkout_time:
-                attendances_to_checkout = Attendance.objects.filter(
-                    user__organization=setting.organization,
-                    attendance_date=current_date,
-                    check_in_time__isnull=False,
-                    check_out_time__isnull=True
-                )
-                
-                checkout_datetime = datetime.combine(current_date, setting.auto_checkout_time)
-                checkout_datetime_aware = timezone.make_aware(checkout_datetime, timezone.get_current_timezone())
-                
-                updates_to_perform = []
-                for attendance in attendances_to_checkout:
-                    attendance.check_out_time = checkout_datetime_aware
-                    attendance.remarks = (attendance.remarks or "") + "\nAuto checked-out by system (General)."
-                    if attendance.check_in_time:
-                        total_seconds = (attendance.check_out_time - attendance.check_in_time).total_seconds()
-                        attendance.total_working_minutes = int(total_seconds // 60)
-                    updates_to_perform.append(attendance)
-                
-                if updates_to_perform:
-                    Attendance.objects.bulk_update(updates_to_perform, ['check_out_time', 'remarks', 'total_working_minutes'])
-                    logger.info(f"[General] Auto-checked out {len(updates_to_perform)} users for organization: {setting.organization.email}")
-        
-        logger.info("--- General Auto-Checkout Task Finished ---")
-        return {"status": "success", "message": "General auto-checkout completed"}
+        closed = AutoCheckoutService.run_general()
+        logger.info(f"--- General Auto-Checkout Task Finished: {closed} attendances closed ---")
+        return {"status": "success", "message": f"General auto-checkout completed, {closed} attendances closed"}
     except Exception as e:
         logger.error(f"Error in general_auto_checkout_task: {str(e)}")
         return {"status": "error", "message": str(e)}
@@ -72,193 +39,224 @@ def general_auto_checkout_task():
 def shiftwise_auto_checkout_task():
     """
     Handles shift-wise auto-checkout for organizations.
-    This checks out users based on their assigned shift's end time plus a grace period.
+    Checks out users at their assigned shift's end time once the grace period has passed
+    (night shifts end the next day). One set-based UPDATE per run covers every shift
+    whose end + grace passed since the previous run (see AutoCheckoutService).
     This task should be run periodically (e.g., every 5-10 minutes) by a scheduler.
     """
-    from AuthN.models import OrganizationSettings
-    from WorkLog.models import Attendance
+    from utils.Attendance.auto_checkout_service import AutoCheckoutService
     
-    now = timezone.now()
-    current_date = now.date()
-    logger.info(f"--- Running Shift-Wise Auto-Checkout Task at {now} ---")
+    logger.info(f"--- Running Shift-Wise Auto-Checkout Task at {timezone.now()} ---")
     
     try:
-        shiftwise_settings = OrganizationSettings.objects.filter(
-            auto_shiftwise_checkout_enabled=True
-        )
-        
-        for setting in shiftwise_settings:
-            # Find pending checkouts from today AND yesterday to handle night shifts.
-            # A shift starting late yesterday might end today.
-            yesterday = current_date - timedelta(days=1)
-            
-            pending_attendances = Attendance.objects.filter(
-                user__organization=setting.organization,
-                attendance_date__in=[current_date, yesterday],
-                check_in_time__isnull=False,
-                check_out_time__isnull=True,
-                assign_shift__isnull=False,
-                assign_shift__end_time__isnull=False,
-                assign_shift__start_time__isnull=False,
-            ).select_related('assign_shift')  # Use select_related for performance
-            
-            updates_to_perform = []
-            
-            for attendance in pending_attendances:
-                shift_end_time = attendance.assign_shift.end_time
-                grace_period_minutes = setting.auto_shiftwise_checkout_in_minutes or 30  # Use configured grace period or default 30 minutes
-                
-                # Determine if it's a night shift (ends on the next day)
-                is_night_shift = attendance.assign_shift.end_time < attendance.assign_shift.start_time
-                
-                # The checkout date is the next day if it's a night shift
-                checkout_date = attendance.attendance_date
-                if is_night_shift:
-                    checkout_date += timedelta(days=1)
-                
-                # Create a timedelta object for the grace period.
-                grace_delta = timedelta(minutes=grace_period_minutes)
-                
-                # Calculate the exact time when auto-checkout should be triggered.
-                # This is based on the calculated checkout_date.
-                trigger_datetime = datetime.combine(checkout_date, shift_end_time) + grace_delta
-                trigger_datetime_aware = timezone.make_aware(trigger_datetime, timezone.get_current_timezone())
-                
-                # Check if the current time has passed the trigger time.
-                if now >= trigger_datetime_aware:
-                    # As requested, the checkout time should be the shift's end time.
-                    checkout_datetime = datetime.combine(checkout_date, shift_end_time)
-                    checkout_datetime_aware = timezone.make_aware(checkout_datetime, timezone.get_current_timezone())
-                    
-                    attendance.check_out_time = checkout_datetime_aware
-                    attendance.remarks = (attendance.remarks or "") + "\nAuto checked-out by system (Shift-wise)."
-                    if attendance.check_in_time:
-                        total_seconds = (attendance.check_out_time - attendance.check_in_time).total_seconds()
-                        attendance.total_working_minutes = int(total_seconds // 60)
-                    
-                    updates_to_perform.append(attendance)
-            
-            if updates_to_perform:
-                Attendance.objects.bulk_update(updates_to_perform, ['check_out_time', 'remarks', 'total_working_minutes'])
-                logger.info(f"[Shift-Wise] Auto-checked out {len(updates_to_perform)} users for organization: {setting.organization.email}")
-        
-        logger.info("--- Shift-Wise Auto-Checkout Task Finished ---")
-        return {"status": "success", "message": "Shift-wise auto-checkout completed"}
+        closed = AutoCheckoutService.run_shiftwise()
+        logger.info(f"--- Shift-Wise Auto-Checkout Task Finished: {closed} attendances closed ---")
+        return {"status": "success", "message": f"Shift-wise auto-checkout completed, {closed} attendances closed"}
     except Exception as e:
         logger.error(f"Error in shiftwise_auto_checkout_task: {str(e)}")
         return {"status": "error", "message": str(e)}
 
 
+@shared_task(name='apply_attendance_punches_task')
+def apply_attendance_punches_task(max_batches=20):
+    """
+    Applies queued check-in/check-out punches (write-behind ingest mode) to Attendance.
+    Drains up to `max_batches` batches per run; scheduled every few seconds.
+    """
+    from utils.Attendance.punch_ingest_service import PunchIngestService
+    
+    try:
+        applied_count = 0
+        for _ in range(max_batches):
+            applied = PunchIngestService.drain()
+            if not applied:
+                break
+            applied_count += applied
+        
+        if applied_count:
+            logger.info(f"[Punch Ingest] Applied {applied_count} queued punches")
+        return {"status": "success", "message": f"{applied_count} punches applied"}
+    except Exception as e:
+        logger.error(f"Error in apply_attendance_punches_task: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+
+@shared_task(name='process_attendance_image_task')
+def process_attendance_image_task(attendance_id, attachment_id):
+    """
+    Turns a spooled check-in/check-out selfie into the final image (decode, EXIF strip,
+    resize, compress), marks the attendance attachment processed/failed and updates
+    the employee's profile photo. Queued on commit by AttendanceImageService.dispatch.
+    """
+    from utils.Attendance.attendance_image_service import AttendanceImageService
+    
+    try:
+        attachment = AttendanceImageService.process(attendance_id, attachment_id)
+        return {"status": "success", "message": f"Image {attachment_id} {(attachment or {}).get('status', 'not found')}"}
+    except Exception as e:
+        logger.error(f"Error in process_attendance_image_task: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+
+@shared_task(name='export_attendance_report_task')
+def export_attendance_report_task(job_id):
+    """
+    Builds the file for an AttendanceExportJob (date ranges too large to stream
+    inside a request). Rows are generated day by day and written straight to
+    disk, so worker memory does not grow with the range or the roster.
+    """
+    from WorkLog.models import AttendanceExportJob
+    from utils.Attendance.attendance_excel_export_service import ExcelExportService
+
+    try:
+        job = AttendanceExportJob.objects.get(id=job_id)
+        if job.status == 'completed':
+            return {"status": "success", "message": f"Export {job_id} already completed"}
+
+        job.status = 'running'
+        job.save(update_fields=['status'])
+
+        ExcelExportService.run_export_job(job)
+        return {"status": "success", "message": f"Exported {job.row_count} rows to {job.file_path}"}
+    except Exception as e:
+        logger.error(f"Error in export_attendance_report_task: {str(e)}")
+        AttendanceExportJob.objects.filter(id=job_id).update(status='failed', error=str(e))
+        return {"status": "error", "message": str(e)}
+
+
+@shared_task(name='process_payroll_run_task')
+def process_payroll_run_task(run_id):
+    """
+    Generates payroll for a PayrollRun in checkpointed chunks. Safe to re-queue:
+    a failed or stalled run resumes after its last committed chunk, and a run
+    already owned by a live worker is left alone.
+    """
+    from PayrollSystem.payroll_run_service import PayrollRunService
+
+    try:
+        run = PayrollRunService.process(run_id)
+        if run is None:
+            return {"status": "success", "message": f"Payroll run {run_id} is already completed or in progress"}
+        if run.status != 'completed':
+            return {"status": "error", "message": run.error}
+        return {
+            "status": "success",
+            "message": f"Payroll generated for {run.generated_count} employees ({run.skipped_count} skipped, {run.failed_count} failed)"
+        }
+    except Exception as e:
+        logger.error(f"Error in process_payroll_run_task: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+
 @shared_task(name='process_monthly_payroll_task')
 def process_monthly_payroll_task(org_id, month, year):
     """
     Process monthly payroll for an organization.
     This task should be run at the end of each month.
     """
-    from PayrollSystem.payroll_calculator import PayrollCalculator
+    from PayrollSystem.payroll_run_service import PayrollRunService
     from AuthN.models import BaseUserModel
     
     logger.info(f"--- Processing Monthly Payroll for Org: {org_id}, Month: {month}, Year: {year} ---")
     
     try:
         organization = BaseUserModel.objects.get(id=org_id, role='organization')
-        calculator = PayrollCalculator(organization, month, year)
-        
-        # Get all active employees
-        employees = BaseUserModel.objects.filter(
-            role='user',
-            organization=organization,
-            is_active=True
-        )
-        
-        processed_count = 0
-        for employee in employees:
+        # Reuse an unfinished run for the month so a re-scheduled task resumes it
+        run = PayrollRunService.active_run(organization, month, year)
+        if run is None:
             try:
-                calculator.calculate_payroll(employee)
-                processed_count += 1
-            except Exception as e:
-                logger.error(f"Error processing payroll for employee {employee.id}: {str(e)}")
-        
-        logger.info(f"--- Payroll Processing Completed: {processed_count} employees processed ---")
-        return {"status": "success", "message": f"Payroll processed for {processed_count} employees"}
+                run = PayrollRunService.create(organization, month, year)
+            except IntegrityError:
+                # Created concurrently by another request or task
+                run = PayrollRunService.active_run(organization, month, year)
+                if run is None:
+                    raise
+        
+        run = PayrollRunService.process(run.id)
+        if run is None:
+            return {"status": "success", "message": "Payroll run for this month is already in progress"}
+        if run.status != 'completed':
+            return {"status": "error", "message": run.error}
+        
+        logger.info(f"--- Payroll Processing Completed: {run.generated_count} employees processed ---")
+        return {"status": "success", "message": f"Payroll processed for {run.generated_count} employees"}
     except Exception as e:
         logger.error(f"Error in process_monthly_payroll_task: {str(e)}")
         return {"status": "error", "message": str(e)}
 
 
+@shared_task(name='mark_payroll_attendance_task')
+def mark_payroll_attendance_task():
+    """Flag calculated payroll of the employee-months whose attendance changed since the previous sweep"""
+    from PayrollSystem.payroll_change_tracker import PayrollChangeTracker
+    
+    try:
+        swept = PayrollChangeTracker.mark_attendance_changes()
+        return {"status": "success", "message": f"Attendance changes swept for {swept} employee-months"}
+    except Exception as e:
+        logger.error(f"Error in mark_payroll_attendance_task: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+
 @shared_task(name='process_leave_accrual_task')
-def process_leave_accrual_task(org_id=None):
+def process_leave_accrual_task(org_id=None, accrual_date=None):
     """
     Process leave accrual for employees.
     This task should be run monthly or as per organization policy.
+    accrual_date (YYYY-MM-DD, default today) selects the period; a period is only accrued once.
     """
-    from LeaveControl.leave_calculator import LeaveCalculator
+    from LeaveControl.leave_accrual_engine import LeaveAccrualEngine
     from AuthN.models import BaseUserModel
     
     logger.info(f"--- Processing Leave Accrual ---")
     
     try:
+        accrual_date = date.fromisoformat(accrual_date) if accrual_date else date.today()
         if org_id:
             organizations = [BaseUserModel.objects.get(id=org_id, role='organization')]
         else:
             organizations = BaseUserModel.objects.filter(role='organization', is_active=True)
         
         total_accrued = 0
+        failed = 0
         for organization in organizations:
-            calculator = LeaveCalculator(organization)
-            employees = BaseUserModel.objects.filter(
-                role='user',
-                organization=organization,
-                is_active=True
-            )
-            
-            for employee in employees:
-                try:
-                    from LeaveControl.models import LeaveType, EmployeeLeaveBalance
-                    from LeaveControl.leave_calculator import LeaveCalculator
-                    
-                    # Get all active leave types with accrual enabled
-                    leave_types = LeaveType.objects.filter(
-                        admin=organization.own_organization_profile_setting.organization,
-                        accrual_enabled=True,
-                        is_active=True
-                    )
-                    
-                    for leave_type in leave_types:
-                        try:
-                            # Get or create leave balance
-                            balance, created = EmployeeLeaveBalance.objects.get_or_create(
-                                user=employee,
-                                leave_type=leave_type,
-                                defaults={
-                                    'accrued': Decimal('0.00'),
-                                    'assigned': Decimal('0.00'),
-                                    'used': Decimal('0.00'),
-                                    'pending': Decimal('0.00'),
-                                    'carried_forward': Decimal('0.00')
-                                }
-                            )
-                            
-                            # Create calculator and process accrual
-                            calculator = LeaveCalculator(employee, leave_type, date.today().year)
-                            accrual_log = calculator.process_leave_accrual(date.today())
-                            
-                            if accrual_log:
-                                total_accrued += 1
-                                logger.info(f"Accrued {accrual_log.days_accrued} days of {leave_type.code} for {employee.email}")
-                        except Exception as e:
-                            logger.error(f"Error processing leave accrual for {employee.id} - {leave_type.code}: {str(e)}")
-                            
-                except Exception as e:
-                    logger.error(f"Error processing leave accrual for employee {employee.id}: {str(e)}")
+            try:
+                stats = LeaveAccrualEngine.run(organization, accrual_date)
+                total_accrued += stats["accrued"]
+                logger.info(f"Leave accrual for org {organization.id}: {stats}")
+            except Exception as e:
+                failed += 1
+                logger.error(f"Error processing leave accrual for org {organization.id}: {str(e)}")
         
-        logger.info(f"--- Leave Accrual Processing Completed: {total_accrued} employees processed ---")
-        return {"status": "success", "message": f"Leave accrual processed for {total_accrued} employees"}
+        logger.info(f"--- Leave Accrual Processing Completed: {total_accrued} balances accrued, {failed} organizations failed ---")
+        return {"status": "success", "message": f"Leave accrued on {total_accrued} balances ({failed} organizations failed)"}
     except Exception as e:
         logger.error(f"Error in process_leave_accrual_task: {str(e)}")
         return {"status": "error", "message": str(e)}
 
 
+@shared_task(name='reconcile_leave_ledger_task')
+def reconcile_leave_ledger_task(org_id=None, repair=False):
+    """
+    Compare every leave balance with the sum of its ledger entries and report drift.
+    With repair, drifted balances are reset to their ledger and balances without entries get an opening entry.
+    """
+    from LeaveControl.leave_ledger import LeaveLedger
+    from AuthN.models import BaseUserModel
+    
+    logger.info("--- Reconciling Leave Ledger ---")
+    try:
+        organization = BaseUserModel.objects.get(id=org_id, role='organization') if org_id else None
+        stats = LeaveLedger.reconcile(organization, repair=repair)
+        
+        logger.info(f"--- Leave Ledger Reconciled: {stats['checked']} balances checked, {stats['drifted']} drifted, "
+                    f"{stats['unledgered']} without ledger, {stats['repaired']} repaired ---")
+        return {"status": "success", "message": f"{stats['checked']} balances checked, {stats['drifted']} drifted"}
+    except Exception as e:
+        logger.error(f"Error in reconcile_leave_ledger_task: {str(e)}")
+        return {"status": "error", "message": str(e)}
+
+
 @shared_task(name='send_scheduled_notifications_task')
 def send_scheduled_notifications_task():
     """
@@ -616,51 +614,42 @@ def data_backup_task():
 # ==================== MONTHLY TASKS ====================
 
 @shared_task(name='leave_carry_forward_task')
-def leave_carry_forward_task():
-    """Process leave carry-forward at year end"""
-    from LeaveControl.models import LeavePolicy, EmployeeLeaveBalance
-    from LeaveControl.leave_calculator import LeaveCalculator
+def leave_carry_forward_task(org_id=None, from_year=None):
+    """
+    Close a leave year: carry forward unused balances (up to max_carry_forward) and lapse the rest.
+    Without from_year each organization's last ended leave year (LeaveYear) is closed, so a
+    financial-year organization closes in April and a calendar-year one in January. Safe to re-run:
+    balances already rolled over are skipped, so an interrupted run continues where it stopped.
+    """
+    from LeaveControl.leave_rollover_engine import LeaveRolloverEngine
+    from LeaveControl.leave_year import LeaveYear
     from AuthN.models import BaseUserModel
     
     logger.info("--- Running Leave Carry-Forward Task ---")
     try:
         today = date.today()
-        
-        # Run only at year end (December 31st or January 1st)
-        if today.month != 12 and today.month != 1:
-            return {"status": "skipped", "message": "Not year end"}
-        
-        organizations = BaseUserModel.objects.filter(role='organization', is_active=True)
+        if org_id:
+            organizations = [BaseUserModel.objects.get(id=org_id, role='organization')]
+        else:
+            organizations = BaseUserModel.objects.filter(role='organization', is_active=True)
         processed_count = 0
+        failed = 0
         
         for org in organizations:
             try:
-                calculator = LeaveCalculator(org.id)
-                policies = LeavePolicy.objects.filter(organization=org, is_active=True)
-                
-                for policy in policies:
-                    if policy.carry_forward_enabled:
-                        # Process carry-forward for all employees
-                        balances = EmployeeLeaveBalance.objects.filter(
-                            leave_type=policy.leave_type,
-                            year=today.year - 1 if today.month == 1 else today.year,
-                            is_active=True
-                        )
-                        
-                        for balance in balances:
-                            calculator.carry_forward_leaves(
-                                user_id=balance.user_id,
-                                leave_type_id=policy.leave_type.id,
-                                from_year=balance.year,
-                                to_year=today.year
-                            )
-                            processed_count += 1
-                            
+                closing_year = from_year
+                if closing_year is None:
+                    closing_year = LeaveYear.of(today, LeaveYear.start_month(org.id)) - 1
+                stats = LeaveRolloverEngine.run(closing_year, organization=org)
+                processed_count += stats["balances"]
+                if stats["balances"]:
+                    logger.info(f"Leave carry-forward {closing_year} for org {org.id}: {stats}")
             except Exception as e:
+                failed += 1
                 logger.error(f"Error processing carry-forward for org {org.id}: {str(e)}")
         
-        logger.info(f"--- Leave Carry-Forward Completed: {processed_count} balances processed ---")
-        return {"status": "success", "message": f"{processed_count} balances processed"}
+        logger.info(f"--- Leave Carry-Forward Completed: {processed_count} balances processed, {failed} organizations failed ---")
+        return {"status": "success", "message": f"{processed_count} balances processed ({failed} organizations failed)"}
     except Exception as e:
         logger.error(f"Error in leave_carry_forward_task: {str(e)}")
         return {"status": "error", "message": str(e)}
@@ -76,10 +76,9 @@ class AttendanceEditService:
 
         shift = attendance.assign_shift
 
-        # ▼ REUSE YOUR FUNCTIONS
-        attendance.early_exit_minutes = calculate_early_exit_minutes(
-            co, shift.end_time
-        )
+        # ▼ Early exit against the shift window (night shifts end the next day)
+        _, shift_end_dt = get_shift_window(shift, attendance.attendance_date)
+        attendance.early_exit_minutes = int((shift_end_dt - co).total_seconds() // 60) if co < shift_end_dt else 0
 
         attendance.is_early_exit = attendance.early_exit_minutes > 0
 
@@ -1,94 +1,189 @@
+import csv
+import os
+import tempfile
 import openpyxl
+from itertools import chain, islice
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import PatternFill, Font, Alignment
-from io import BytesIO
-from django.http import HttpResponse
+from openpyxl.utils import get_column_letter
+from django.conf import settings
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
 import uuid
 
 
+class _Echo:
+    """File-like object whose write() hands the value back, for streaming csv.writer output"""
+
+    def write(self, value):
+        return value
+
+
 class ExcelExportService:
+    """
+    Attendance report exports that never hold the whole report in memory.
+
+    XLSX uses an openpyxl write_only workbook spooled to a temporary file and
+    served with FileResponse; CSV is generated row by row through
+    StreamingHttpResponse. Rows may be any iterable (e.g. a generator over the
+    roster), and ranges above ATTENDANCE_EXPORT_SYNC_MAX_DAYS go through
+    AttendanceExportJob + export_attendance_report_task instead.
+    """
+
+    HEADERS = [
+        "Date", "Employee Name", "Employee ID", "Email",
+        "Status", "Last Login", "Check In", "Check Out",
+        "Break (minutes)", "Late (minutes)", "Production (minutes)"
+    ]
+    CONTENT_TYPES = {
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        "csv": "text/csv",
+    }
+    # write_only sheets need column widths before the first row, so they are sized from this many rows
+    WIDTH_SAMPLE_ROWS = 500
+    MAX_COLUMN_WIDTH = 60
+
+    @staticmethod
+    def to_excel_value(val):
+        """Convert value to Excel-compatible format"""
+        if val is None:
+            return "N/A"
+        # Convert UUID to string
+        if isinstance(val, uuid.UUID):
+            return str(val)
+        # Convert datetime objects to string
+        if hasattr(val, 'strftime'):
+            return val.strftime('%Y-%m-%d %H:%M:%S')
+        # Convert any other non-serializable objects to string
+        if not isinstance(val, (str, int, float, bool)):
+            return str(val)
+        return val
 
     @staticmethod
-    def generate(attendance_list, attendance_date):
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Attendance Report"
-
-        headers = [
-            "Employee Name", "Employee ID", "Email",
-            "Status", "Last Login", "Check In", "Check Out",
-            "Break (minutes)", "Late (minutes)", "Production (minutes)"
+    def build_row(item):
+        to_excel_value = ExcelExportService.to_excel_value
+        return [
+            to_excel_value(item.get("attendance_date") or "N/A"),
+            to_excel_value(item.get("employee_name", "N/A")),
+            to_excel_value(item.get("employee_id", "N/A")),
+            to_excel_value(item.get("employee_email", "N/A")),
+            to_excel_value(item.get("attendance_status", "N/A")),
+            to_excel_value(item.get("last_login_status") or "N/A"),
+            to_excel_value(item.get("check_in") or "N/A"),
+            to_excel_value(item.get("check_out") or "N/A"),
+            item.get("total_break_minutes", 0) or 0,  # Use raw minutes instead of formatted string
+            item.get("late_minutes", 0) or 0,
+            item.get("total_working_minutes", 0) or 0,
         ]
 
+    @staticmethod
+    def write_xlsx(attendance_list, output):
+        """Write rows to `output` (path or binary file) with a write_only workbook. Returns the row count."""
+        wb = openpyxl.Workbook(write_only=True)
+        ws = wb.create_sheet("Attendance Report")
+
+        rows = (ExcelExportService.build_row(item) for item in attendance_list)
+        sample = list(islice(rows, ExcelExportService.WIDTH_SAMPLE_ROWS))
+
+        # Auto width from the header and the sampled rows
+        widths = [len(head) for head in ExcelExportService.HEADERS]
+        for row in sample:
+            for col, val in enumerate(row):
+                widths[col] = max(widths[col], len(str(val)))
+        for col, width in enumerate(widths, 1):
+            ws.column_dimensions[get_column_letter(col)].width = min(width + 2, ExcelExportService.MAX_COLUMN_WIDTH)
+
         header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
         header_font = Font(bold=True, color="FFFFFF")
 
         # Header Row
-        for col, head in enumerate(headers, 1):
-            c = ws.cell(row=1, column=col, value=head)
+        header = []
+        for head in ExcelExportService.HEADERS:
+            c = WriteOnlyCell(ws, value=head)
             c.fill = header_fill
             c.font = header_font
             c.alignment = Alignment(horizontal="center")
-
-        # Helper function to convert values to Excel-compatible format
-        def to_excel_value(val):
-            """Convert value to Excel-compatible format"""
-            if val is None:
-                return "N/A"
-            # Convert UUID to string
-            if isinstance(val, uuid.UUID):
-                return str(val)
-            # Check if it's a UUID-like object
-            if hasattr(val, '__class__') and 'UUID' in str(type(val)):
-                return str(val)
-            # Convert datetime objects to string
-            if hasattr(val, 'strftime'):
-                return val.strftime('%Y-%m-%d %H:%M:%S')
-            # Convert any other non-serializable objects to string
-            try:
-                # Try to convert to string if it's not a basic type
-                if not isinstance(val, (str, int, float, bool)):
-                    return str(val)
-            except:
-                return "N/A"
-            return val
+            header.append(c)
+        ws.append(header)
 
         # Data Rows
-        for i, item in enumerate(attendance_list, 2):
-            row = [
-                to_excel_value(item.get("employee_name", "N/A")),
-                to_excel_value(item.get("employee_id", "N/A")),
-                to_excel_value(item.get("employee_email", "N/A")),
-                to_excel_value(item.get("attendance_status", "N/A")),
-                to_excel_value(item.get("last_login_status") or "N/A"),
-                to_excel_value(item.get("check_in") or "N/A"),
-                to_excel_value(item.get("check_out") or "N/A"),
-                item.get("total_break_minutes", 0) or 0,  # Use raw minutes instead of formatted string
-                item.get("late_minutes", 0) or 0,
-                item.get("total_working_minutes", 0) or 0,  # Fixed: was production_minutes
-            ]
-            for col, val in enumerate(row, 1):
-                ws.cell(row=i, column=col).value = to_excel_value(val)
-
-        # Auto width
-        for col in ws.columns:
-            max_len = 0
-            letter = col[0].column_letter
-            for cell in col:
-                try:
-                    max_len = max(max_len, len(str(cell.value)))
-                except:
-                    pass
-            ws.column_dimensions[letter].width = max_len + 2
-
-        # Save in memory
-        output = BytesIO()
+        count = 0
+        for row in chain(sample, rows):
+            ws.append(row)
+            count += 1
+
         wb.save(output)
+        return count
+
+    @staticmethod
+    def iter_csv(attendance_list):
+        """Yield CSV lines (header first) one row at a time"""
+        writer = csv.writer(_Echo())
+        yield writer.writerow(ExcelExportService.HEADERS)
+        for item in attendance_list:
+            yield writer.writerow(ExcelExportService.build_row(item))
+
+    @staticmethod
+    def write_csv(attendance_list, output):
+        """Write rows to a text file object. Returns the row count."""
+        writer = csv.writer(output)
+        writer.writerow(ExcelExportService.HEADERS)
+        count = 0
+        for item in attendance_list:
+            writer.writerow(ExcelExportService.build_row(item))
+            count += 1
+        return count
+
+    @staticmethod
+    def generate(attendance_list, attendance_date, file_format="xlsx"):
+        """Streaming download response for an iterable of roster rows"""
+        filename = f"attendance_{attendance_date}.{file_format}"
+
+        if file_format == "csv":
+            response = StreamingHttpResponse(
+                ExcelExportService.iter_csv(attendance_list),
+                content_type=ExcelExportService.CONTENT_TYPES["csv"]
+            )
+            response["Content-Disposition"] = f'attachment; filename="{filename}"'
+            return response
+
+        # Spooled to disk, streamed back in chunks; FileResponse closes (and so deletes) the file
+        output = tempfile.TemporaryFile()
+        ExcelExportService.write_xlsx(attendance_list, output)
         output.seek(0)
 
-        response = HttpResponse(
-            output.getvalue(),
-            content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        return FileResponse(
+            output,
+            as_attachment=True,
+            filename=filename,
+            content_type=ExcelExportService.CONTENT_TYPES["xlsx"]
+        )
+
+    @staticmethod
+    def run_export_job(job):
+        """Produce the file for an AttendanceExportJob under ATTENDANCE_EXPORT_FOLDER"""
+        from .attendance_roster_service import AttendanceRosterService
+
+        folder = getattr(settings, 'ATTENDANCE_EXPORT_FOLDER', 'exports/attendance')
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, folder), exist_ok=True)
+        relative_path = os.path.join(folder, f"{job.id}.{job.file_format}")
+        final_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+        partial_path = f"{final_path}.part"
+
+        rows = AttendanceRosterService.iter_range_rows(
+            job.admin_id, job.from_date, job.to_date, job.status_filter, user_id=job.user_id
         )
-        response["Content-Disposition"] = f'attachment; filename="attendance_{attendance_date}.xlsx"'
+        if job.file_format == "csv":
+            with open(partial_path, 'w', newline='') as f:
+                row_count = ExcelExportService.write_csv(rows, f)
+        else:
+            row_count = ExcelExportService.write_xlsx(rows, partial_path)
+        # Readers only ever see a complete file
+        os.replace(partial_path, final_path)
 
-        return response
+        job.file_path = relative_path
+        job.row_count = row_count
+        job.status = 'completed'
+        job.completed_at = timezone.now()
+        job.save(update_fields=['file_path', 'row_count', 'status', 'completed_at'])
+        return job
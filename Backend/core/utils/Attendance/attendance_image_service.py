@@ -0,0 +1,121 @@
+"""
+Asynchronous selfie pipeline for check-in/check-out.
+
+The request thread only spools the decoded bytes and records a ``pending``
+attachment on ``Attendance.attachments``. After the transaction commits,
+``process_attendance_image_task`` decodes, EXIF-strips, resizes and compresses
+the image, flips the attachment status to ``processed`` (or ``failed``) and
+updates the employee's ``profile_photo``.
+"""
+import logging
+import uuid
+from datetime import datetime
+
+from django.db import transaction
+
+from AuthN.models import UserProfile
+from WorkLog.models import Attendance
+from utils.helpers.image_utils import spool_base64_image, process_spooled_image
+
+logger = logging.getLogger(__name__)
+
+
+class AttendanceImageService:
+
+    STATUS_PENDING = "pending"
+    STATUS_PROCESSED = "processed"
+    STATUS_FAILED = "failed"
+
+    @staticmethod
+    def first_image(base64_images):
+        """Normalize the `base64_images` request field (string or list) to one image"""
+        if isinstance(base64_images, list):
+            return base64_images[0] if base64_images else None
+        return base64_images or None
+
+    @staticmethod
+    def spool_attachment(base64_image, image_type, captured_at):
+        """
+        Spool the raw selfie to disk and return a pending attachment dict.
+        Append it to Attendance.attachments and call dispatch() once the row is saved.
+        """
+        spooled = spool_base64_image(base64_image)
+
+        if isinstance(captured_at, datetime):
+            captured_at = captured_at.isoformat()
+
+        return {
+            "id": uuid.uuid4().hex,
+            "image_type": image_type,
+            "status": AttendanceImageService.STATUS_PENDING,
+            "spool_path": spooled["spool_path"],
+            "file_path": None,
+            "file_type": spooled["file_type"],
+            "file_size": spooled["file_size"],
+            "captured_at": captured_at,
+        }
+
+    @staticmethod
+    def dispatch(attendance_id, attachment_id):
+        """Queue processing after the surrounding transaction commits"""
+        transaction.on_commit(
+            lambda: AttendanceImageService._enqueue(attendance_id, attachment_id)
+        )
+
+    @staticmethod
+    def _enqueue(attendance_id, attachment_id):
+        from core.tasks import process_attendance_image_task
+
+        try:
+            process_attendance_image_task.delay(attendance_id, attachment_id)
+        except Exception as e:
+            # Broker unavailable: still outside the transaction, so process here rather than lose the selfie
+            logger.error(f"Could not queue image {attachment_id} for attendance {attendance_id}: {str(e)}")
+            AttendanceImageService.process(attendance_id, attachment_id)
+
+    @staticmethod
+    def process(attendance_id, attachment_id):
+        """Worker entry point: build the final image and record the outcome"""
+        attendance = Attendance.objects.only('id', 'user_id', 'attachments').get(id=attendance_id)
+        attachment = next(
+            (a for a in (attendance.attachments or []) if a.get("id") == attachment_id),
+            None
+        )
+        if not attachment or attachment.get("status") != AttendanceImageService.STATUS_PENDING:
+            return attachment
+
+        # CPU-heavy work happens before any row lock is taken
+        try:
+            saved_image = process_spooled_image(
+                attachment["spool_path"],
+                folder_name='profile_photos',
+                file_extension=attachment.get("file_type") or 'jpg'
+            )
+            changes = {
+                "status": AttendanceImageService.STATUS_PROCESSED,
+                "file_path": saved_image["file_path"],
+                "file_type": saved_image["file_type"],
+                "file_size": saved_image["file_size"],
+                "content_hash": saved_image.get("content_hash"),
+                "spool_path": None,
+            }
+        except Exception as e:
+            logger.error(f"Error processing image {attachment_id} for attendance {attendance_id}: {str(e)}")
+            saved_image = None
+            changes = {"status": AttendanceImageService.STATUS_FAILED, "error": str(e)}
+
+        with transaction.atomic():
+            attendance = Attendance.objects.select_for_update().only('id', 'user_id', 'attachments').get(id=attendance_id)
+            attachments = attendance.attachments or []
+            for item in attachments:
+                if item.get("id") == attachment_id:
+                    item.update(changes)
+                    attachment = item
+            Attendance.objects.filter(id=attendance_id).update(attachments=attachments)
+
+            if saved_image:
+                UserProfile.objects.filter(user_id=attendance.user_id).update(
+                    profile_photo=saved_image["file_path"]
+                )
+
+        return attachment
@@ -0,0 +1,155 @@
+"""
+Daily attendance roster for an admin, computed in the database.
+
+Every employee under the admin is annotated (correlated subqueries on the
+user/date index, i.e. a LEFT JOIN per employee) with the first check-in
+record's status and late flag and whether any record of the day is present or
+late. Status filtering, ordering and keyset pagination run on those
+annotations, and the summary is one conditional-aggregate query, so only the
+requested page of employees and their attendance rows reach Python.
+
+First check-in, last check-out and summed minutes are folded from that page's
+rows by AttendanceService (build_employee_structure / aggregate_records /
+finalize_status), so the response format is unchanged.
+"""
+import base64
+import json
+from datetime import timedelta
+
+from django.db.models import BooleanField, CharField, Count, Exists, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from AuthN.models import UserProfile
+from WorkLog.models import Attendance
+from .attendance_utils import AttendanceService
+
+
+class AttendanceRosterService:
+
+    STATUS_FILTERS = {
+        "late": Q(first_is_late=True),
+        "present": Q(first_status="present"),
+        "absent": Q(first_status="absent"),
+    }
+
+    @staticmethod
+    def employees(admin_id, attendance_date, user_id=None):
+        """UserProfile queryset for the admin, annotated with the day's attendance"""
+        day_records = Attendance.objects.filter(user_id=OuterRef('user_id'), attendance_date=attendance_date)
+        # Same record aggregate_records() picks: earliest check-in, latest id on ties
+        first_record = day_records.filter(check_in_time__isnull=False).order_by('check_in_time', '-id')
+
+        employees = UserProfile.objects.filter(admin_id=admin_id)
+        if user_id:
+            employees = employees.filter(user_id=user_id)
+
+        return employees.annotate(
+            has_record=Exists(day_records),
+            first_status=Coalesce(
+                Subquery(first_record.values('attendance_status')[:1]), Value("absent"), output_field=CharField()
+            ),
+            first_is_late=Coalesce(
+                Subquery(first_record.values('is_late')[:1]), Value(False), output_field=BooleanField()
+            ),
+            # Summary flags: any record of the day, as the previous distinct counts did
+            any_present=Exists(day_records.filter(attendance_status="present")),
+            any_late=Exists(day_records.filter(is_late=True)),
+        )
+
+    @staticmethod
+    def filter_status(employees, status_param):
+        """Returns (queryset, filter Q or None); unknown statuses are ignored as before"""
+        status_q = AttendanceRosterService.STATUS_FILTERS.get((status_param or "").lower())
+        if status_q is None:
+            return employees, None
+        return employees.filter(status_q), status_q
+
+    @staticmethod
+    def summary(employees, status_q=None):
+        """One conditional aggregate: roster totals plus the filtered row count"""
+        totals = employees.aggregate(
+            total_employees=Count('id'),
+            present=Count('id', filter=Q(any_present=True)),
+            late_login=Count('id', filter=Q(any_late=True)),
+            with_records=Count('id', filter=Q(has_record=True)),
+            matching=Count('id', filter=status_q) if status_q is not None else Count('id'),
+        )
+        return {
+            "total_employees": totals["total_employees"],
+            "present": totals["present"],
+            "late_login": totals["late_login"],
+            "absent": totals["total_employees"] - totals["with_records"],
+        }, totals["matching"]
+
+    @staticmethod
+    def encode_cursor(profile):
+        raw = json.dumps([profile.user_name, str(profile.id)])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Raises ValueError for a malformed cursor"""
+        try:
+            user_name, profile_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except Exception:
+            raise ValueError("Invalid cursor")
+        return user_name, profile_id
+
+    @staticmethod
+    def page(employees, page_size, cursor=None, page=None):
+        """
+        Keyset page ordered by (user_name, id). `cursor` is the previous response's
+        next_cursor; without it, `page` falls back to an offset for older clients.
+        Returns (profiles, next_cursor).
+        """
+        employees = employees.select_related('user').order_by('user_name', 'id')
+
+        if cursor:
+            user_name, profile_id = AttendanceRosterService.decode_cursor(cursor)
+            employees = employees.filter(Q(user_name__gt=user_name) | Q(user_name=user_name, id__gt=profile_id))
+            offset = 0
+        else:
+            offset = (max(page or 1, 1) - 1) * page_size
+
+        profiles = list(employees[offset:offset + page_size + 1])
+        next_cursor = None
+        if len(profiles) > page_size:
+            profiles = profiles[:page_size]
+            next_cursor = AttendanceRosterService.encode_cursor(profiles[-1])
+        return profiles, next_cursor
+
+    @staticmethod
+    def build_rows(profiles, attendance_date):
+        """Response rows for the given profiles only (one attendance query)"""
+        for profile in profiles:
+            # build_employee_structure() reads the profile through user.own_user_profile
+            profile.user.own_user_profile = profile
+
+        data = AttendanceService.build_employee_structure(profiles, attendance_date)
+        records = Attendance.objects.filter(
+            user_id__in=list(data.keys()),
+            attendance_date=attendance_date
+        ).select_related("assign_shift").order_by('-id')
+
+        data = AttendanceService.aggregate_records(records, data)
+        return AttendanceService.finalize_status(data)
+
+    @staticmethod
+    def iter_rows(employees, attendance_date, chunk_size=1000):
+        """All rows of a (filtered) roster, built chunk by chunk in keyset order"""
+        cursor = None
+        while True:
+            profiles, cursor = AttendanceRosterService.page(employees, chunk_size, cursor=cursor)
+            yield from AttendanceRosterService.build_rows(profiles, attendance_date)
+            if not cursor:
+                break
+
+    @staticmethod
+    def iter_range_rows(admin_id, from_date, to_date, status_param=None, user_id=None):
+        """Rows for every day in [from_date, to_date], day by day"""
+        attendance_date = from_date
+        while attendance_date <= to_date:
+            employees = AttendanceRosterService.employees(admin_id, attendance_date, user_id=user_id)
+            employees, _ = AttendanceRosterService.filter_status(employees, status_param)
+            yield from AttendanceRosterService.iter_rows(employees, attendance_date)
+            attendance_date += timedelta(days=1)
@@ -1,41 +1,101 @@
-from datetime import datetime, timedelta, date
+import bisect
+from datetime import datetime, timedelta, date, time
 from ServiceShift.models import ServiceShift
 
 
-def get_nearest_shift_with_late_minutes(checkin_time, assigned_shifts_list):
+class ShiftTimeline:
     """
-    Optimized: Finds the nearest shift based on check-in time and calculates late minutes.
-    Accepts list instead of queryset for better performance.
-    Returns: (nearest_shift_object, late_minutes)
+    Precomputed shift start times for one employee, searched with bisect.
+
+    Start times are laid out in seconds relative to the punch day's midnight:
+    - yesterday's occurrence, for night shifts only (a shift still running past midnight),
+    - today's occurrence,
+    - tomorrow's occurrence, only within EARLY_WINDOW_SECONDS (early punch for a shift
+      starting right after midnight).
+    A punch is matched to the nearest start, which also decides the attendance date.
+    Build once per shift assignment (cached in the punch context), resolve in O(log shifts).
     """
-    if not assigned_shifts_list:
-        return None, 0
-
-    nearest_shift = None
-    min_diff_seconds = float('inf')
-    checkin_date = checkin_time.date()
 
-    for shift in assigned_shifts_list:
-        shift_start = datetime.combine(checkin_date, shift.start_time)
-        diff_seconds = abs((shift_start - checkin_time).total_seconds())
+    DAY_SECONDS = 24 * 60 * 60
+    EARLY_WINDOW_SECONDS = 2 * 60 * 60
+
+    def __init__(self, shifts):
+        by_start = {}
+        for shift in shifts or []:
+            offset = shift.start_time.hour * 3600 + shift.start_time.minute * 60 + shift.start_time.second
+            # Same start time: the first assigned shift wins, as in the old linear scan
+            by_start.setdefault(offset, shift)
+
+        self.starts = []
+        self.entries = []
+        for day in (-1, 0, 1):
+            for offset in sorted(by_start):
+                shift = by_start[offset]
+                if day == -1 and not is_night_shift(shift):
+                    continue
+                self.starts.append(day * self.DAY_SECONDS + offset)
+                self.entries.append((shift, day))
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    def resolve(self, punch_time):
+        """
+        Returns: (nearest_shift, late_minutes, attendance_date)
+        attendance_date is the day the matched shift started (yesterday for a running night shift).
+        """
+        if not self.starts:
+            return None, 0, punch_time.date()
+
+        seconds = (punch_time - datetime.combine(punch_time.date(), time.min)).total_seconds()
+        index = bisect.bisect_left(self.starts, seconds)
+
+        candidates = []
+        for i in (index - 1, index):
+            if not 0 <= i < len(self.starts):
+                continue
+            _, day = self.entries[i]
+            if day == 1 and self.starts[i] - seconds > self.EARLY_WINDOW_SECONDS:
+                continue
+            candidates.append(i)
+        if not candidates:
+            # Only far-away tomorrow starts are ahead: fall back to the latest start before the punch
+            candidates = [index - 1]
+
+        # Ties go to the earlier start (min keeps the first of equal keys)
+        best = min(candidates, key=lambda i: abs(self.starts[i] - seconds))
+        shift, day = self.entries[best]
+
+        late_seconds = seconds - self.starts[best]
+        late_minutes = int(late_seconds // 60) if late_seconds > 0 else 0
+
+        return shift, late_minutes, punch_time.date() + timedelta(days=day)
+
+
+def is_night_shift(shift):
+    """A shift whose end time is not after its start time runs past midnight"""
+    return shift.end_time <= shift.start_time
+
+
+def get_shift_window(shift, attendance_date):
+    """Start/end datetimes of `shift` worked on `attendance_date`; night shifts end the next day"""
+    start = datetime.combine(attendance_date, shift.start_time)
+    end = datetime.combine(attendance_date, shift.end_time)
+    if is_night_shift(shift):
+        end += timedelta(days=1)
+    return start, end
 
-        if diff_seconds < min_diff_seconds:
-            min_diff_seconds = diff_seconds
-            nearest_shift = shift
-
-    if nearest_shift:
-        shift_start = datetime.combine(checkin_date, nearest_shift.start_time)
-        if checkin_time > shift_start:
-            late_minutes = int((checkin_time - shift_start).total_seconds() // 60)
-        else:
-            late_minutes = 0
-    else:
-        late_minutes = 0
 
+def get_nearest_shift_with_late_minutes(checkin_time, assigned_shifts_list):
+    """
+    Finds the nearest shift based on check-in time and calculates late minutes.
+    Builds a one-off ShiftTimeline; hot paths should reuse a cached timeline instead.
+    Returns: (nearest_shift_object, late_minutes)
+    """
+    nearest_shift, late_minutes, _ = ShiftTimeline(assigned_shifts_list).resolve(checkin_time)
     return nearest_shift, late_minutes
 
 
-
 def calculate_total_working_minutes(check_in, check_out):
     total_seconds = (check_out - check_in).total_seconds()
     if total_seconds < 10:  # Minimum 10 seconds required
@@ -61,6 +121,39 @@ def calculate_overtime_minutes(total_minutes, expected_hours=8):
 
     return int(extra) if extra > 0 else 0
 
+
+def calculate_checkout_metrics(check_in_time, check_out_time, shift=None, attendance_date=None):
+    """
+    Compute the checkout fields for an open attendance against its shift.
+    With attendance_date, early exit is measured against the shift window, so a
+    night shift left before midnight is still an early exit.
+    Returns None when the session is shorter than the 10 second minimum.
+    """
+    total_minutes = calculate_total_working_minutes(check_in_time, check_out_time)
+    if total_minutes is None:
+        return None
+
+    early_exit = 0
+    if shift and shift.end_time:
+        if attendance_date:
+            _, shift_end = get_shift_window(shift, attendance_date)
+            early_exit = int((shift_end - check_out_time).total_seconds() // 60) if check_out_time < shift_end else 0
+        else:
+            early_exit = calculate_early_exit_minutes(check_out_time, shift.end_time)
+
+    expected_hours = 8
+    if shift and shift.duration_minutes:
+        expected_hours = shift.duration_minutes / 60
+    overtime = calculate_overtime_minutes(total_minutes, expected_hours=expected_hours)
+
+    return {
+        'check_out_time': check_out_time,
+        'total_working_minutes': total_minutes,
+        'early_exit_minutes': early_exit,
+        'overtime_minutes': overtime,
+        'is_early_exit': True if (early_exit and early_exit > 0) else False
+    }
+
 def format_datetime(dt):
     """Format datetime to 'YYYY-MM-DD HH:MM:SS' """
     if not dt:
@@ -236,14 +329,13 @@ class AttendanceService:
             d["break_duration"] = format_minutes(d["total_break_minutes"])
             d["late_minutes_display"] = format_minutes(d["late_minutes"])
 
-            # Early exit
+            # Early exit against the shift window (night shifts end the next day)
             if d["last_check_out_time"] and d["assign_shift"] and d["assign_shift"].end_time:
-                d["is_early_exit"] = d["last_check_out_time"] < datetime.combine(
-                    d["last_check_out_time"].date(), d["assign_shift"].end_time
-                )
-                d["early_exit_minutes"] = calculate_early_exit_minutes(
-                    d["last_check_out_time"],
-                    d["assign_shift"].end_time
+                _, shift_end = get_shift_window(d["assign_shift"], d["attendance_date"])
+                d["is_early_exit"] = d["last_check_out_time"] < shift_end
+                d["early_exit_minutes"] = (
+                    int((shift_end - d["last_check_out_time"]).total_seconds() // 60)
+                    if d["is_early_exit"] else 0
                 )
 
             d["attendance_date"] = format_date(d["attendance_date"])
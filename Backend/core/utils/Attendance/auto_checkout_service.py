@@ -0,0 +1,211 @@
+"""
+Set-based auto-checkout for general (fixed time) and shift-wise organizations.
+
+Instead of loading every open attendance per organization, each run:
+1. works out, from OrganizationSettings and ServiceShift alone, which
+   checkout moments passed since the previous run (the watermark, minus a small
+   overlap for late-applied punches),
+2. closes all matching open attendances of every organization with one UPDATE
+   whose check_out_time / total_working_minutes are Case/When expressions over
+   those moments; the partial index on open attendances drives the WHERE.
+
+Open rows whose checkout moment passed before the window (e.g. a check-in after
+the cut-off) are left to attendance_auto_close_task.
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, CharField, DateTimeField, F, Func, IntegerField, Q, Value, When
+from django.db.models.functions import Coalesce, Concat
+from django.utils import timezone
+
+from AuthN.models import OrganizationSettings, UserProfile
+from ServiceShift.models import ServiceShift
+from WorkLog.models import Attendance
+from .attendance_utils import get_shift_window
+from .daily_summary_service import DailyAttendanceSummaryService
+
+logger = logging.getLogger(__name__)
+
+
+class MinutesBetween(Func):
+    """Whole minutes from `start` to `end` (both datetime expressions)"""
+    output_field = IntegerField()
+    arity = 2
+
+    TEMPLATES = {
+        'postgresql': "FLOOR(EXTRACT(EPOCH FROM (%(end)s - %(start)s)) / 60)::integer",
+        'sqlite': "(CAST(ROUND((julianday(%(end)s) - julianday(%(start)s)) * 86400) AS INTEGER) / 60)",
+        'mysql': "((UNIX_TIMESTAMP(%(end)s) - UNIX_TIMESTAMP(%(start)s)) DIV 60)",
+    }
+
+    def as_sql(self, compiler, connection, **extra_context):
+        start, end = self.get_source_expressions()
+        start_sql, start_params = compiler.compile(start)
+        end_sql, end_params = compiler.compile(end)
+        # Every template references end before start, so params follow that order
+        template = self.TEMPLATES.get(connection.vendor, self.TEMPLATES['postgresql'])
+        return template % {'start': start_sql, 'end': end_sql}, (*end_params, *start_params)
+
+
+class AutoCheckoutService:
+
+    GENERAL = 'general'
+    SHIFTWISE = 'shiftwise'
+
+    @staticmethod
+    def watermark_key(mode):
+        return f"auto_checkout_watermark_{mode}"
+
+    @staticmethod
+    def _window(mode, now):
+        """(start, end] of checkout moments this run is responsible for"""
+        watermark = cache.get(AutoCheckoutService.watermark_key(mode))
+        if watermark is None:
+            hours = getattr(settings, 'ATTENDANCE_AUTO_CHECKOUT_INITIAL_LOOKBACK_HOURS', 36)
+            watermark = now - timedelta(hours=hours)
+        overlap = getattr(settings, 'ATTENDANCE_AUTO_CHECKOUT_OVERLAP_MINUTES', 10)
+        return watermark - timedelta(minutes=overlap), now
+
+    @staticmethod
+    def _advance(mode, now):
+        cache.set(AutoCheckoutService.watermark_key(mode), now, None)
+
+    @staticmethod
+    def _local_now():
+        """Naive local time; checkout moments are built from naive local dates and times"""
+        now = timezone.now()
+        return timezone.localtime(now).replace(tzinfo=None) if settings.USE_TZ else now
+
+    @staticmethod
+    def _db_datetime(value):
+        if settings.USE_TZ and timezone.is_naive(value):
+            return timezone.make_aware(value, timezone.get_current_timezone())
+        return value
+
+    @staticmethod
+    def _dates(window_start, window_end, days_before=0):
+        current = window_start.date() - timedelta(days=days_before)
+        while current <= window_end.date():
+            yield current
+            current += timedelta(days=1)
+
+    @staticmethod
+    def general_moments(window_start, window_end):
+        """{checkout datetime: [organization ids]} for fixed-time orgs whose cut-off falls in the window"""
+        moments = defaultdict(list)
+        org_times = OrganizationSettings.objects.filter(
+            auto_checkout_enabled=True,
+            auto_shiftwise_checkout_enabled=False,  # Shift-wise takes precedence, as before
+            auto_checkout_time__isnull=False,
+        ).values_list('organization_id', 'auto_checkout_time')
+
+        for organization_id, checkout_time in org_times:
+            for attendance_date in AutoCheckoutService._dates(window_start, window_end):
+                moment = datetime.combine(attendance_date, checkout_time)
+                if window_start < moment <= window_end:
+                    moments[moment].append(organization_id)
+        return moments
+
+    @staticmethod
+    def shiftwise_moments(window_start, window_end):
+        """{shift end datetime: [(attendance_date, shift_id)]} whose end + org grace falls in the window"""
+        grace_by_org = dict(
+            OrganizationSettings.objects.filter(auto_shiftwise_checkout_enabled=True).values_list(
+                'organization_id', 'auto_shiftwise_checkout_in_minutes'
+            )
+        )
+        if not grace_by_org:
+            return {}
+
+        shifts = ServiceShift.objects.filter(
+            admin__own_admin_profile__organization_id__in=list(grace_by_org)
+        ).only('id', 'start_time', 'end_time').annotate(
+            organization_id=F('admin__own_admin_profile__organization_id')
+        )
+
+        moments = defaultdict(list)
+        for shift in shifts:
+            grace = timedelta(minutes=grace_by_org.get(shift.organization_id) or 30)
+            # A night shift that started the day before can end inside the window
+            for attendance_date in AutoCheckoutService._dates(window_start, window_end, days_before=1):
+                _, shift_end = get_shift_window(shift, attendance_date)
+                if window_start < shift_end + grace <= window_end:
+                    moments[shift_end].append((attendance_date, shift.id))
+        return moments
+
+    @staticmethod
+    def _close(conditions_by_moment, remark):
+        """One UPDATE closing every open attendance matched by {checkout datetime: Q}"""
+        if not conditions_by_moment:
+            return 0
+
+        moments = {AutoCheckoutService._db_datetime(m): q for m, q in conditions_by_moment.items()}
+        # A check-in after the checkout moment is never closed at an earlier time
+        eligible = Q()
+        for moment, condition in moments.items():
+            eligible |= condition & Q(check_in_time__lt=moment)
+        checkout_time = Case(
+            *[When(condition, then=Value(moment, output_field=DateTimeField())) for moment, condition in moments.items()],
+            output_field=DateTimeField()
+        )
+
+        with transaction.atomic():
+            # Lock and remember the rows so daily summaries can be refreshed and manual check-outs are not overwritten
+            rows = list(
+                Attendance.objects.select_for_update().filter(
+                    eligible, check_in_time__isnull=False, check_out_time__isnull=True
+                ).values_list('id', 'user_id', 'attendance_date')
+            )
+            if not rows:
+                return 0
+
+            Attendance.objects.filter(id__in=[row[0] for row in rows]).update(
+                check_out_time=checkout_time,
+                total_working_minutes=MinutesBetween(F('check_in_time'), checkout_time),
+                remarks=Concat(Coalesce(F('remarks'), Value('')), Value(remark), output_field=CharField()),
+            )
+            DailyAttendanceSummaryService.mark_dirty((user_id, attendance_date) for _, user_id, attendance_date in rows)
+
+        return len(rows)
+
+    @staticmethod
+    def run_general(now=None):
+        """Close open attendances at each organization's fixed auto-checkout time. Returns rows closed."""
+        now = now or AutoCheckoutService._local_now()
+        window_start, window_end = AutoCheckoutService._window(AutoCheckoutService.GENERAL, now)
+
+        conditions = {}
+        for moment, organization_ids in AutoCheckoutService.general_moments(window_start, window_end).items():
+            conditions[moment] = Q(
+                attendance_date=moment.date(),
+                user_id__in=UserProfile.objects.filter(organization_id__in=organization_ids).values('user_id')
+            )
+
+        closed = AutoCheckoutService._close(conditions, "\nAuto checked-out by system (General).")
+        AutoCheckoutService._advance(AutoCheckoutService.GENERAL, now)
+        return closed
+
+    @staticmethod
+    def run_shiftwise(now=None):
+        """Close open attendances at their shift end once the org's grace period has passed. Returns rows closed."""
+        now = now or AutoCheckoutService._local_now()
+        window_start, window_end = AutoCheckoutService._window(AutoCheckoutService.SHIFTWISE, now)
+
+        conditions = {}
+        for moment, slots in AutoCheckoutService.shiftwise_moments(window_start, window_end).items():
+            shifts_by_date = defaultdict(list)
+            for attendance_date, shift_id in slots:
+                shifts_by_date[attendance_date].append(shift_id)
+            condition = Q()
+            for attendance_date, shift_ids in shifts_by_date.items():
+                condition |= Q(attendance_date=attendance_date, assign_shift_id__in=shift_ids)
+            conditions[moment] = condition
+
+        closed = AutoCheckoutService._close(conditions, "\nAuto checked-out by system (Shift-wise).")
+        AutoCheckoutService._advance(AutoCheckoutService.SHIFTWISE, now)
+        return closed
@@ -0,0 +1,167 @@
+"""
+Maintenance of the DailyAttendanceSummary rollup (one row per employee-day).
+
+Writers mark (user_id, attendance_date) pairs dirty; after the transaction
+commits the pairs are recomputed from that day's Attendance sessions and
+upserted in one statement. Attendance.save()/delete() are covered by the
+signals in WorkLog/signals.py; paths that write with update()/bulk_update()
+(check-out, queued ingest, auto-checkout) call mark_dirty() themselves.
+"""
+import logging
+from datetime import timedelta
+from itertools import groupby
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+
+from WorkLog.models import Attendance, DailyAttendanceSummary
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_FIELDS = [
+    'assign_shift', 'attendance_status', 'first_check_in', 'last_check_out',
+    'total_working_minutes', 'total_break_minutes', 'is_late', 'late_minutes',
+    'is_early_exit', 'early_exit_minutes', 'overtime_minutes', 'session_count',
+    'has_open_session', 'updated_at',
+]
+
+
+class DailyAttendanceSummaryService:
+
+    @staticmethod
+    def summarize(user_id, attendance_date, sessions):
+        """Build the (unsaved) summary for one employee-day from its Attendance rows"""
+        checked_in = sorted((s for s in sessions if s.check_in_time), key=lambda s: (s.check_in_time, s.id))
+        checked_out = [s for s in sessions if s.check_out_time]
+        first = checked_in[0] if checked_in else sessions[0]
+        last_out = max(checked_out, key=lambda s: s.check_out_time) if checked_out else None
+
+        worked = sum(s.total_working_minutes or 0 for s in sessions)
+        shift = first.assign_shift
+        if shift and shift.duration_minutes:
+            overtime = max(worked - shift.duration_minutes, 0)
+        else:
+            overtime = sum(s.overtime_minutes or 0 for s in sessions)
+
+        return DailyAttendanceSummary(
+            user_id=user_id,
+            attendance_date=attendance_date,
+            assign_shift=shift,
+            attendance_status="present" if any(s.attendance_status == "present" for s in sessions) else first.attendance_status,
+            first_check_in=first.check_in_time if checked_in else None,
+            last_check_out=last_out.check_out_time if last_out else None,
+            total_working_minutes=worked,
+            total_break_minutes=sum(s.break_duration_minutes or 0 for s in sessions),
+            is_late=bool(first.is_late),
+            late_minutes=first.late_minutes or 0,
+            is_early_exit=bool(last_out and last_out.is_early_exit),
+            early_exit_minutes=(last_out.early_exit_minutes or 0) if last_out else 0,
+            overtime_minutes=overtime,
+            session_count=len(sessions),
+            has_open_session=any(s.check_in_time and not s.check_out_time for s in sessions),
+        )
+
+    @staticmethod
+    def _sessions(filters):
+        return Attendance.objects.filter(filters).select_related('assign_shift').only(
+            'id', 'user_id', 'attendance_date', 'check_in_time', 'check_out_time', 'attendance_status',
+            'total_working_minutes', 'break_duration_minutes', 'overtime_minutes', 'is_late',
+            'late_minutes', 'is_early_exit', 'early_exit_minutes', 'assign_shift', 'assign_shift__duration_minutes'
+        ).order_by('user_id', 'attendance_date')
+
+    @staticmethod
+    def _upsert(summaries):
+        if summaries:
+            DailyAttendanceSummary.objects.bulk_create(
+                summaries,
+                batch_size=1000,
+                update_conflicts=True,
+                unique_fields=['user', 'attendance_date'],
+                update_fields=SUMMARY_FIELDS,
+            )
+
+    @staticmethod
+    def refresh(pairs):
+        """Recompute the summaries for (user_id, attendance_date) pairs; days without sessions are removed"""
+        pairs = {(str(user_id), attendance_date) for user_id, attendance_date in pairs}
+        if not pairs:
+            return 0
+
+        user_ids = {user_id for user_id, _ in pairs}
+        dates = {attendance_date for _, attendance_date in pairs}
+
+        summaries = []
+        for (user_id, attendance_date), sessions in groupby(
+            DailyAttendanceSummaryService._sessions(Q(user_id__in=user_ids, attendance_date__in=dates)),
+            key=lambda s: (str(s.user_id), s.attendance_date)
+        ):
+            if (user_id, attendance_date) in pairs:
+                summaries.append(DailyAttendanceSummaryService.summarize(user_id, attendance_date, list(sessions)))
+
+        with transaction.atomic():
+            DailyAttendanceSummaryService._upsert(summaries)
+
+            empty = pairs - {(str(s.user_id), s.attendance_date) for s in summaries}
+            if empty:
+                from PayrollSystem.payroll_change_tracker import PayrollChangeTracker
+
+                stale = Q()
+                for user_id, attendance_date in empty:
+                    stale |= Q(user_id=user_id, attendance_date=attendance_date)
+                if DailyAttendanceSummary.objects.filter(stale).delete()[0]:
+                    # A deleted summary leaves no updated_at for the attendance sweep to find
+                    PayrollChangeTracker.mark_dirty(
+                        [(user_id, attendance_date, attendance_date) for user_id, attendance_date in empty], 'attendance'
+                    )
+
+        return len(summaries)
+
+    @staticmethod
+    def mark_dirty(pairs):
+        """
+        Refresh the given employee-days once the surrounding transaction commits. Payroll of
+        those days is flagged stale later, from the refreshed summaries' updated_at
+        (PayrollChangeTracker.mark_attendance_changes).
+        """
+        pairs = set(pairs)
+        if pairs:
+            transaction.on_commit(lambda: DailyAttendanceSummaryService._refresh_quietly(pairs))
+
+    @staticmethod
+    def _refresh_quietly(pairs):
+        # Runs after commit: a failure here must not fail the punch; the rebuild command repairs it
+        try:
+            DailyAttendanceSummaryService.refresh(pairs)
+        except Exception as e:
+            logger.error(f"Error refreshing daily attendance summary for {len(pairs)} day(s): {str(e)}")
+
+    @staticmethod
+    def rebuild(from_date, to_date, user_ids=None, batch_days=7):
+        """Recompute every summary in [from_date, to_date], `batch_days` at a time. Returns rows written."""
+        written = 0
+        batch_start = from_date
+        while batch_start <= to_date:
+            batch_end = min(batch_start + timedelta(days=batch_days - 1), to_date)
+
+            filters = Q(attendance_date__gte=batch_start, attendance_date__lte=batch_end)
+            if user_ids:
+                filters &= Q(user_id__in=user_ids)
+
+            summaries = [
+                DailyAttendanceSummaryService.summarize(user_id, attendance_date, list(sessions))
+                for (user_id, attendance_date), sessions in groupby(
+                    DailyAttendanceSummaryService._sessions(filters).iterator(chunk_size=2000),
+                    key=lambda s: (s.user_id, s.attendance_date)
+                )
+            ]
+
+            # Upsert + delete days that no longer have sessions, so concurrent refreshes never collide
+            with transaction.atomic():
+                DailyAttendanceSummaryService._upsert(summaries)
+                DailyAttendanceSummary.objects.filter(filters).exclude(
+                    Exists(Attendance.objects.filter(user_id=OuterRef('user_id'), attendance_date=OuterRef('attendance_date')))
+                ).delete()
+
+            written += len(summaries)
+            batch_start = batch_end + timedelta(days=1)
+        return written
@@ -0,0 +1,124 @@
+"""
+Employee daily info for an admin: profile details plus that day's attendance.
+
+All of the day's attendance rows for the admin's employees are read with one
+query and folded into a per-employee map (multi-punch days aggregated); the
+employee list is then streamed as JSON, so neither the queries nor the
+response buffer grow per employee.
+"""
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Exists, OuterRef
+
+from AuthN.models import UserProfile
+from WorkLog.models import Attendance
+
+
+class EmployeeDailyInfoService:
+
+    EMPTY_ATTENDANCE = {
+        "id": None,
+        "check_in_time": None,
+        "check_out_time": None,
+        "working_hours": 0.0,
+        "status": "absent",
+        "check_in_location": None,
+        "check_out_location": None,
+        "check_in_image": None,
+        "punch_count": 0,
+    }
+
+    @staticmethod
+    def employees(admin, employee_id=None):
+        employees = UserProfile.objects.filter(admin=admin, user__is_active=True)
+        if employee_id:
+            employees = employees.filter(user_id=employee_id)
+        return employees
+
+    @staticmethod
+    def filter_status(employees, target_date, status_filter):
+        """present = any attendance row that day, absent = none"""
+        if status_filter not in ('present', 'absent'):
+            return employees
+        has_attendance = Exists(
+            Attendance.objects.filter(user_id=OuterRef('user_id'), attendance_date=target_date)
+        )
+        return employees.filter(has_attendance if status_filter == 'present' else ~has_attendance)
+
+    @staticmethod
+    def _check_in_image(attachments):
+        for attachment in attachments or []:
+            if attachment.get("image_type", "check_in") == "check_in" and attachment.get("file_path"):
+                return f"{settings.MEDIA_URL}{attachment['file_path']}"
+        return None
+
+    @staticmethod
+    def attendance_map(employees, target_date):
+        """{user_id: attendance dict} for the day, from a single query"""
+        records = Attendance.objects.filter(
+            attendance_date=target_date,
+            user_id__in=employees.values('user_id')
+        ).only(
+            'id', 'user_id', 'check_in_time', 'check_out_time', 'total_working_minutes',
+            'check_in_location', 'check_out_location', 'attachments'
+        ).order_by('user_id', 'check_in_time', 'id')
+
+        attendance = {}
+        for record in records:
+            day = attendance.get(record.user_id)
+            if day is None:
+                # First session of the day (earliest check-in)
+                day = attendance[record.user_id] = {
+                    "id": str(record.id),
+                    "check_in_time": record.check_in_time,
+                    "check_out_time": None,
+                    "working_minutes": 0,
+                    "status": "present",
+                    "check_in_location": record.check_in_location,
+                    "check_out_location": None,
+                    "check_in_image": EmployeeDailyInfoService._check_in_image(record.attachments),
+                    "punch_count": 0,
+                }
+            day["punch_count"] += 1
+            day["working_minutes"] += record.total_working_minutes or 0
+            if record.check_out_time and (not day["check_out_time"] or record.check_out_time > day["check_out_time"]):
+                day["check_out_time"] = record.check_out_time
+                day["check_out_location"] = record.check_out_location
+
+        for day in attendance.values():
+            day["check_in_time"] = day["check_in_time"].strftime('%H:%M:%S') if day["check_in_time"] else None
+            day["check_out_time"] = day["check_out_time"].strftime('%H:%M:%S') if day["check_out_time"] else None
+            day["working_hours"] = round(day.pop("working_minutes") / 60, 2)
+        return attendance
+
+    @staticmethod
+    def employee_info(profile, target_date, attendance):
+        return {
+            "employee_id": str(profile.user.id),
+            "user_name": profile.user_name,
+            "email": profile.user.email,
+            "custom_employee_id": profile.custom_employee_id,
+            "designation": profile.designation,
+            "job_title": profile.job_title,
+            "profile_photo": profile.profile_photo.url if profile.profile_photo else None,
+            "phone_number": profile.user.phone_number,
+            "date": target_date.strftime('%Y-%m-%d'),
+            "attendance": attendance.get(profile.user_id, EmployeeDailyInfoService.EMPTY_ATTENDANCE),
+        }
+
+    @staticmethod
+    def stream(employees, target_date, attendance, envelope):
+        """
+        Yield the response JSON: `envelope` keys first, then "data" one employee at a time
+        """
+        encoder = DjangoJSONEncoder()
+        head = json.dumps(envelope, cls=DjangoJSONEncoder)
+        yield head[:-1] + (', "data": [' if envelope else '"data": [')
+
+        profiles = employees.select_related('user').order_by('user_name', 'id').iterator(chunk_size=1000)
+        for index, profile in enumerate(profiles):
+            info = EmployeeDailyInfoService.employee_info(profile, target_date, attendance)
+            yield ("," if index else "") + encoder.encode(info)
+        yield "]}"
@@ -0,0 +1,114 @@
+"""
+Cached per-employee "punch context" for the check-in/check-out hot path.
+
+Everything a punch needs besides the attendance rows themselves (profile ids,
+assigned shifts, week-offs, organization attendance settings) is cached until
+it actually changes. Invalidation is driven by the signals in WorkLog/signals.py
+(shift/week-off assignment, shift/week-off policy edits, profile and
+OrganizationSettings saves), not by punches, so a typical punch costs one
+attendance read and one write.
+
+Keys carry PUNCH_CONTEXT_VERSION so a deploy that changes the context shape
+never reads entries written by the previous release.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from AuthN.models import BaseUserModel, UserProfile, OrganizationSettings
+from utils.Attendance.attendance_utils import ShiftTimeline
+
+PUNCH_CONTEXT_VERSION = 2
+
+ORG_SETTING_FIELDS = [
+    'geofencing_enabled', 'geofence_radius_in_meters',
+    'late_punch_enabled', 'late_punch_grace_minutes',
+    'early_exit_enabled', 'early_exit_grace_minutes',
+    'multiple_shift_enabled', 'face_recognition_enabled',
+    'location_tracking_enabled', 'manual_attendance_enabled',
+    'auto_shiftwise_checkout_enabled', 'auto_shiftwise_checkout_in_minutes',
+]
+
+
+class PunchContextService:
+
+    @staticmethod
+    def user_key(user_id):
+        return f"punch_ctx_v{PUNCH_CONTEXT_VERSION}_user_{user_id}"
+
+    @staticmethod
+    def org_key(organization_id):
+        return f"punch_ctx_v{PUNCH_CONTEXT_VERSION}_org_{organization_id}"
+
+    @staticmethod
+    def get(user_id):
+        """
+        Return the punch context for an employee:
+        {
+            'user_id', 'admin_id', 'organization_id', 'allow_geo_fencing', 'radius',
+            'shifts': [ServiceShift, ...], 'shift_timeline': ShiftTimeline, 'week_offs': [{'id', 'week_days', 'week_off_cycle'}],
+            'org_settings': {<ORG_SETTING_FIELDS>}
+        }
+        Raises BaseUserModel.DoesNotExist for unknown users.
+        """
+        ttl = getattr(settings, 'ATTENDANCE_PUNCH_CONTEXT_TTL', 86400)
+
+        context = cache.get(PunchContextService.user_key(user_id))
+        if context is None:
+            context = PunchContextService._build_user_context(user_id)
+            cache.set(PunchContextService.user_key(user_id), context, ttl)
+
+        org_settings = cache.get(PunchContextService.org_key(context['organization_id']))
+        if org_settings is None:
+            org_settings = PunchContextService._build_org_settings(context['organization_id'])
+            cache.set(PunchContextService.org_key(context['organization_id']), org_settings, ttl)
+
+        return {**context, 'org_settings': org_settings}
+
+    @staticmethod
+    def invalidate_users(user_ids):
+        keys = [PunchContextService.user_key(user_id) for user_id in user_ids if user_id]
+        PunchContextService._delete(keys)
+
+    @staticmethod
+    def invalidate_organization(organization_id):
+        PunchContextService._delete([PunchContextService.org_key(organization_id)])
+
+    @staticmethod
+    def _delete(keys):
+        if not keys:
+            return
+        cache.delete_many(keys)
+        # Again after commit, so a punch that rebuilt the context from pre-commit rows is not kept
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+    @staticmethod
+    def _build_user_context(user_id):
+        try:
+            profile = UserProfile.objects.only(
+                'id', 'user_id', 'admin_id', 'organization_id', 'allow_geo_fencing', 'radius'
+            ).prefetch_related('shifts', 'week_offs').get(user_id=user_id)
+        except UserProfile.DoesNotExist:
+            raise BaseUserModel.DoesNotExist
+
+        shifts = list(profile.shifts.all())
+        return {
+            'user_id': str(profile.user_id),
+            'admin_id': str(profile.admin_id),
+            'organization_id': str(profile.organization_id),
+            'allow_geo_fencing': profile.allow_geo_fencing,
+            'radius': profile.radius,
+            'shifts': shifts,
+            'shift_timeline': ShiftTimeline(shifts),
+            'week_offs': [
+                {'id': w.id, 'week_days': w.week_days, 'week_off_cycle': w.week_off_cycle}
+                for w in profile.week_offs.all()
+            ],
+        }
+
+    @staticmethod
+    def _build_org_settings(organization_id):
+        values = OrganizationSettings.objects.filter(
+            organization_id=organization_id
+        ).values(*ORG_SETTING_FIELDS).first()
+        return values or {}
@@ -0,0 +1,435 @@
+"""
+Write-behind ingest pipeline for attendance punches.
+
+In ``queued`` mode the check-in/check-out API only validates the punch, stores
+it in a durable queue and acknowledges it. ``PunchIngestService.drain`` (run by
+the ``apply_attendance_punches_task`` worker) then applies the queued punches to
+``Attendance`` in batches with ``bulk_create``/``bulk_update``.
+
+Every punch carries an idempotency key (``Idempotency-Key`` header or
+``punch_id`` field, scoped to the user). Duplicates are rejected at ack time
+through the cache and again at apply time through the unique
+``check_in_punch_key``/``check_out_punch_key`` columns, so a retried mobile
+punch is never counted twice even when the queue redelivers it.
+
+A batch that fails to apply is bisected and its halves applied on their own,
+so one bad punch cannot hold back the rest of its batch; a punch that still
+fails alone is moved to the queue's dead letters (with the error) and acked.
+Database connection errors are not split: the batch stays unacked and is
+redelivered.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from itertools import chain
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import InterfaceError, OperationalError, transaction
+from django.db.models import Prefetch, Q
+
+from AuthN.models import UserProfile
+from ServiceShift.models import ServiceShift
+from WorkLog.models import Attendance
+from .attendance_image_service import AttendanceImageService
+from .daily_summary_service import DailyAttendanceSummaryService
+from .punch_context import PunchContextService
+from .attendance_utils import ShiftTimeline, calculate_checkout_metrics
+
+logger = logging.getLogger(__name__)
+
+
+# ==================== QUEUE BACKENDS ====================
+
+class RedisStreamPunchQueue:
+    """Redis stream + consumer group. Unacked entries of dead consumers are re-claimed."""
+
+    def __init__(self, url, stream='attendance:punches', group='attendance-writers', reclaim_after_seconds=60):
+        import redis
+
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.stream = stream
+        self.group = group
+        self.consumer = f"{os.uname().nodename}-{os.getpid()}"
+        self.reclaim_idle_ms = reclaim_after_seconds * 1000
+
+        try:
+            self.client.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def push(self, punch):
+        self.client.xadd(self.stream, {'punch': json.dumps(punch)})
+
+    def claim(self, count):
+        # Entries left pending by a crashed worker come first
+        _, entries, *_ = self.client.xautoclaim(
+            self.stream, self.group, self.consumer,
+            min_idle_time=self.reclaim_idle_ms, start_id='0-0', count=count
+        )
+        entries = list(entries)
+
+        if len(entries) < count:
+            response = self.client.xreadgroup(
+                self.group, self.consumer, {self.stream: '>'}, count=count - len(entries)
+            )
+            for _, messages in response or []:
+                entries.extend(messages)
+
+        return [(entry_id, json.loads(fields['punch'])) for entry_id, fields in entries if fields]
+
+    def ack(self, entry_ids):
+        if entry_ids:
+            self.client.xack(self.stream, self.group, *entry_ids)
+            self.client.xdel(self.stream, *entry_ids)
+
+    def dead_letter(self, entry_id, punch, error):
+        self.client.xadd(f"{self.stream}:dead", {'punch': json.dumps(punch), 'error': error})
+        self.ack([entry_id])
+
+
+class SpoolPunchQueue:
+    """
+    Local stand-in for the Redis stream: one fsync'ed JSON file per punch.
+    Files are claimed by an atomic rename so several workers can share a spool.
+    """
+
+    def __init__(self, directory, reclaim_after_seconds=60):
+        self.directory = directory
+        self.reclaim_after_seconds = reclaim_after_seconds
+        os.makedirs(self.directory, exist_ok=True)
+
+    def push(self, punch):
+        file_name = f"{time.time_ns():020d}_{punch['punch_key'][:16]}.json"
+        tmp_path = os.path.join(self.directory, file_name + '.tmp')
+
+        with open(tmp_path, 'w') as f:
+            json.dump(punch, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, os.path.join(self.directory, file_name))
+
+    def claim(self, count):
+        self._release_stale_claims()
+
+        file_names = sorted(n for n in os.listdir(self.directory) if n.endswith('.json'))[:count]
+        claimed = []
+
+        for file_name in file_names:
+            source = os.path.join(self.directory, file_name)
+            claimed_path = source + '.claimed'
+            try:
+                os.rename(source, claimed_path)
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+
+            with open(claimed_path) as f:
+                claimed.append((claimed_path, json.load(f)))
+
+        return claimed
+
+    def ack(self, entry_ids):
+        for path in entry_ids:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def dead_letter(self, entry_id, punch, error):
+        """Move the claimed file to dead/, next to a .error file with the reason"""
+        dead_directory = os.path.join(self.directory, 'dead')
+        os.makedirs(dead_directory, exist_ok=True)
+        dead_path = os.path.join(dead_directory, os.path.basename(entry_id)[:-len('.claimed')])
+        with open(dead_path + '.error', 'w') as f:
+            f.write(error)
+        try:
+            os.replace(entry_id, dead_path)
+        except FileNotFoundError:
+            pass
+
+    def _release_stale_claims(self):
+        """Put back punches claimed by a worker that died before acking"""
+        cutoff = time.time() - self.reclaim_after_seconds
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.claimed'):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.rename(path, path[:-len('.claimed')])
+            except FileNotFoundError:
+                pass
+
+
+_punch_queue = None
+
+
+def get_punch_queue():
+    """Process-wide punch queue configured by ATTENDANCE_PUNCH_QUEUE_BACKEND"""
+    global _punch_queue
+
+    if _punch_queue is None:
+        backend = getattr(settings, 'ATTENDANCE_PUNCH_QUEUE_BACKEND', 'spool')
+        if backend == 'redis':
+            _punch_queue = RedisStreamPunchQueue(settings.ATTENDANCE_PUNCH_QUEUE_URL)
+        else:
+            _punch_queue = SpoolPunchQueue(
+                getattr(settings, 'ATTENDANCE_PUNCH_SPOOL_DIR', os.path.join(settings.BASE_DIR, 'spool', 'punches'))
+            )
+
+    return _punch_queue
+
+
+# ==================== INGEST SERVICE ====================
+
+class PunchIngestService:
+
+    OPTIONAL_FIELDS = [
+        "marked_by",
+        "check_in_location", "check_out_location",
+        "check_in_latitude", "check_in_longitude",
+        "check_out_latitude", "check_out_longitude",
+    ]
+    COORDINATE_FIELDS = [
+        "check_in_latitude", "check_in_longitude",
+        "check_out_latitude", "check_out_longitude",
+    ]
+
+    @staticmethod
+    def accept(userid, data, idempotency_key=None):
+        """
+        Validate a punch, append it to the queue and return (punch, duplicate).
+        Raises BaseUserModel.DoesNotExist for unknown users and ValueError for bad payloads.
+        """
+        # Cached punch context: the ack path normally skips the database entirely
+        PunchContextService.get(userid)
+
+        punch = {
+            "punch_id": str(idempotency_key or uuid.uuid4()),
+            "user_id": str(userid),
+            "punched_at": datetime.now().isoformat(),
+        }
+        punch["punch_key"] = PunchIngestService.punch_key(userid, punch["punch_id"])
+
+        for field in PunchIngestService.OPTIONAL_FIELDS:
+            value = data.get(field)
+            if value in (None, ""):
+                continue
+            if field in PunchIngestService.COORDINATE_FIELDS:
+                try:
+                    value = str(Decimal(str(value)).quantize(Decimal("0.000001")))
+                except InvalidOperation:
+                    raise ValueError(f"Invalid value for {field}.")
+            punch[field] = value
+
+        # Atomic set-if-absent: a retried punch inside the TTL is acknowledged but not re-queued
+        ttl = getattr(settings, 'ATTENDANCE_PUNCH_IDEMPOTENCY_TTL', 86400)
+        if not cache.add(f"punch_idem_{punch['punch_key']}", 1, ttl):
+            return punch, True
+
+        try:
+            # Only a spool path travels through the queue, never the base64 payload
+            base64_image = AttendanceImageService.first_image(data.get("base64_images"))
+            if base64_image:
+                punch["attachment"] = AttendanceImageService.spool_attachment(
+                    base64_image, 'check_in', punch["punched_at"]
+                )
+            get_punch_queue().push(punch)
+        except Exception:
+            cache.delete(f"punch_idem_{punch['punch_key']}")
+            raise
+
+        return punch, False
+
+    @staticmethod
+    def punch_key(userid, punch_id):
+        return hashlib.sha256(f"{userid}:{punch_id}".encode()).hexdigest()
+
+    @staticmethod
+    def drain(batch_size=None):
+        """Claim one batch from the queue, apply it and ack it. Returns number of punches applied."""
+        batch_size = batch_size or getattr(settings, 'ATTENDANCE_PUNCH_BATCH_SIZE', 500)
+        queue = get_punch_queue()
+
+        claimed = queue.claim(batch_size)
+        if not claimed:
+            return 0
+
+        return PunchIngestService._apply_or_split(queue, claimed)
+
+    @staticmethod
+    def _apply_or_split(queue, claimed):
+        """Apply and ack claimed (entry id, punch) pairs, bisecting a batch that fails"""
+        try:
+            applied, rejected = PunchIngestService.apply_batch([punch for _, punch in claimed])
+        except (OperationalError, InterfaceError):
+            # The database is unreachable, not the punches at fault: leave them for redelivery
+            raise
+        except Exception as e:
+            if len(claimed) == 1:
+                entry_id, punch = claimed[0]
+                logger.error(f"Dead-lettering punch {punch.get('punch_id')} for {punch.get('user_id')}: {str(e)}")
+                punch.pop("check_time", None)
+                queue.dead_letter(entry_id, punch, str(e))
+                return 0
+            logger.warning(f"Applying {len(claimed)} punches failed ({str(e)}); applying the halves separately")
+            middle = len(claimed) // 2
+            return (
+                PunchIngestService._apply_or_split(queue, claimed[:middle]) +
+                PunchIngestService._apply_or_split(queue, claimed[middle:])
+            )
+
+        for entry_id, punch in claimed:
+            if punch["punch_key"] in rejected:
+                logger.error(f"Dead-lettering punch {punch.get('punch_id')} for {punch.get('user_id')}: {rejected[punch['punch_key']]}")
+                punch.pop("check_time", None)
+                queue.dead_letter(entry_id, punch, rejected[punch["punch_key"]])
+        queue.ack([entry_id for entry_id, punch in claimed if punch["punch_key"] not in rejected])
+        return applied
+
+    @staticmethod
+    def apply_batch(punches):
+        """
+        Apply punches (in punch-time order) with a fixed number of queries per batch.
+        Returns (applied count, {punch_key: reason} of punches that can never be applied).
+        """
+        punches = sorted(punches, key=lambda p: p["punched_at"])
+        for punch in punches:
+            punch["check_time"] = datetime.fromisoformat(punch["punched_at"])
+
+        keys = [p["punch_key"] for p in punches]
+        user_ids = {p["user_id"] for p in punches}
+        # Yesterday too: a night shift started then is still open after midnight
+        dates = {p["check_time"].date() - timedelta(days=day) for p in punches for day in (0, 1)}
+
+        pending_images = []
+
+        with transaction.atomic():
+            applied_keys = set()
+            for check_in_key, check_out_key in Attendance.objects.filter(
+                Q(check_in_punch_key__in=keys) | Q(check_out_punch_key__in=keys)
+            ).values_list('check_in_punch_key', 'check_out_punch_key'):
+                applied_keys.update([check_in_key, check_out_key])
+
+            profiles = {
+                str(p.user_id): p
+                for p in UserProfile.objects.filter(user_id__in=user_ids).only('id', 'user_id').prefetch_related(
+                    Prefetch('shifts', queryset=ServiceShift.objects.only('id', 'start_time', 'end_time', 'duration_minutes', 'is_night_shift'))
+                )
+            }
+            timelines = {user_id: ShiftTimeline(profile.shifts.all()) for user_id, profile in profiles.items()}
+
+            # Latest open attendance per (user, date), same as the synchronous flow's .first()
+            open_attendances = {}
+            for attendance in Attendance.objects.select_related('assign_shift').select_for_update(of=('self',)).filter(
+                user_id__in=user_ids,
+                attendance_date__in=dates,
+                check_out_time__isnull=True
+            ).order_by('-check_in_time'):
+                open_attendances.setdefault((str(attendance.user_id), attendance.attendance_date), attendance)
+
+            to_create = []
+            to_update = {}
+            applied_count = 0
+            rejected = {}
+
+            for punch in punches:
+                key = punch["punch_key"]
+                profile = profiles.get(punch["user_id"])
+                if key in applied_keys:
+                    continue
+                if profile is None:
+                    rejected[key] = "user has no profile"
+                    continue
+
+                check_time = punch["check_time"]
+                slot = (punch["user_id"], check_time.date())
+                if slot not in open_attendances:
+                    previous_slot = (punch["user_id"], check_time.date() - timedelta(days=1))
+                    previous = open_attendances.get(previous_slot)
+                    if previous and previous.assign_shift and previous.assign_shift.is_night_shift:
+                        slot = previous_slot
+                attendance = open_attendances.pop(slot, None)
+
+                if attendance:
+                    metrics = calculate_checkout_metrics(
+                        attendance.check_in_time, check_time, attendance.assign_shift, attendance.attendance_date
+                    )
+                    if metrics is None:
+                        # The synchronous API rejects sessions under 10 seconds; drop the punch likewise
+                        open_attendances[slot] = attendance
+                        logger.info(f"Dropped punch {punch['punch_id']} for {punch['user_id']}: working time too short")
+                        continue
+
+                    for field, value in metrics.items():
+                        setattr(attendance, field, value)
+                    if punch.get("check_out_latitude") and punch.get("check_out_longitude"):
+                        attendance.check_out_latitude = punch["check_out_latitude"]
+                        attendance.check_out_longitude = punch["check_out_longitude"]
+                    if punch.get("check_out_location"):
+                        attendance.check_out_location = punch["check_out_location"]
+                    attendance.check_out_punch_key = key
+
+                    if attendance.pk:
+                        to_update[attendance.pk] = attendance
+                else:
+                    nearest_shift, late_minutes, attendance_date = timelines[punch["user_id"]].resolve(check_time)
+                    slot = (punch["user_id"], attendance_date)
+                    attendance = Attendance(
+                        user_id=punch["user_id"],
+                        attendance_date=attendance_date,
+                        check_in_time=check_time,
+                        attendance_status="present",
+                        marked_by=punch.get("marked_by", "mobile"),
+                        assign_shift=nearest_shift,
+                        late_minutes=late_minutes or 0,
+                        is_late=True if (late_minutes and late_minutes > 0) else False,
+                        check_in_punch_key=key,
+                    )
+                    if punch.get("check_in_latitude") and punch.get("check_in_longitude"):
+                        attendance.check_in_latitude = punch["check_in_latitude"]
+                        attendance.check_in_longitude = punch["check_in_longitude"]
+                    if punch.get("check_in_location"):
+                        attendance.check_in_location = punch["check_in_location"]
+
+                    to_create.append(attendance)
+                    open_attendances[slot] = attendance
+
+                applied_keys.add(key)
+                applied_count += 1
+                if punch.get("attachment"):
+                    attachment = dict(punch["attachment"], image_type='check_out' if attendance.check_out_time else 'check_in')
+                    attendance.attachments = (attendance.attachments or []) + [attachment]
+                    pending_images.append((attendance, attachment["id"]))
+
+            if to_create:
+                Attendance.objects.bulk_create(to_create, batch_size=500)
+            if to_update:
+                Attendance.objects.bulk_update(
+                    list(to_update.values()),
+                    [
+                        'check_out_time', 'total_working_minutes', 'early_exit_minutes',
+                        'overtime_minutes', 'is_early_exit', 'check_out_latitude',
+                        'check_out_longitude', 'check_out_location', 'check_out_punch_key',
+                        'attachments',
+                    ],
+                    batch_size=500
+                )
+
+            for attendance, attachment_id in pending_images:
+                AttendanceImageService.dispatch(attendance.pk, attachment_id)
+
+            # bulk writes skip the Attendance signals, so roll up the touched employee-days here
+            DailyAttendanceSummaryService.mark_dirty(
+                (attendance.user_id, attendance.attendance_date)
+                for attendance in chain(to_create, to_update.values())
+            )
+
+        return applied_count, rejected
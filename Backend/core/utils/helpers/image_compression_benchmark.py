@@ -0,0 +1,131 @@
+"""
+Benchmark: legacy selfie compression vs adaptive compression + content-addressed store.
+
+Legacy path   = compress_image(), then compress_image_aggressive() when still over the limit,
+                one new file per upload (what save_base64_image() does).
+Adaptive path = compress_image_adaptive() + store_content_addressed()
+                (what process_spooled_image() does).
+
+Every image in the corpus is "uploaded" --resends times to model mobile retries
+and repeated selfies. Reported per path: CPU seconds per image, bytes written to
+disk and files created.
+
+Usage (from Backend/core):
+    python utils/helpers/image_compression_benchmark.py [CORPUS_DIR] [--resends 2] [--synthetic 30]
+
+Without CORPUS_DIR a synthetic corpus of camera-sized selfies is generated.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from io import BytesIO
+
+import django
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+django.setup()
+
+from django.conf import settings
+from utils.helpers.image_utils import (
+    compress_image, compress_image_aggressive, compress_image_adaptive, store_content_addressed
+)
+
+
+def _synthetic_corpus(count):
+    """Noisy gradient 'selfies' at common phone-camera resolutions, with EXIF orientation"""
+    from PIL import Image
+
+    sizes = [(4032, 3024), (3264, 2448), (2560, 1920), (1600, 1200)]
+    corpus = []
+    for i in range(count):
+        width, height = sizes[i % len(sizes)]
+        gradient = Image.linear_gradient('L').resize((width, height))
+        noise = Image.effect_noise((width, height), 40 + i % 30)
+        img = Image.merge('RGB', (gradient, noise, gradient.rotate(90, expand=False)))
+
+        exif = Image.Exif()
+        exif[0x0112] = 6 if i % 3 == 0 else 1
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=95, exif=exif.tobytes())
+        corpus.append((f"synthetic_{i}.jpg", output.getvalue()))
+    return corpus
+
+
+def _load_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().rsplit('.', 1)[-1] in ('jpg', 'jpeg', 'png', 'webp'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                corpus.append((name, f.read()))
+    return corpus
+
+
+def _run_legacy(corpus, resends, media_root):
+    max_size = getattr(settings, 'ATTENDANCE_IMAGE_MAX_SIZE_MB', 3) * 1024 * 1024
+    folder = os.path.join(media_root, 'legacy')
+    os.makedirs(folder, exist_ok=True)
+
+    bytes_written, files_written = 0, 0
+    started = time.process_time()
+    for _ in range(resends):
+        for name, image_data in corpus:
+            extension = name.rsplit('.', 1)[-1].lower()
+            compressed = compress_image(image_data, extension)
+            if len(compressed) > max_size:
+                compressed = compress_image_aggressive(image_data, extension, max_size)
+            with open(os.path.join(folder, f"{uuid.uuid4().hex}.{extension}"), 'wb') as f:
+                f.write(compressed)
+            bytes_written += len(compressed)
+            files_written += 1
+    return time.process_time() - started, bytes_written, files_written
+
+
+def _run_adaptive(corpus, resends):
+    bytes_written, files_written = 0, 0
+    started = time.process_time()
+    for _ in range(resends):
+        for name, image_data in corpus:
+            compressed, extension, content_hash = compress_image_adaptive(image_data, name.rsplit('.', 1)[-1])
+            saved = store_content_addressed(compressed, extension, content_hash, 'adaptive')
+            if not saved['deduplicated']:
+                bytes_written += saved['file_size']
+                files_written += 1
+    return time.process_time() - started, bytes_written, files_written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus_dir', nargs='?', help="Directory of sample selfies (jpg/png/webp)")
+    parser.add_argument('--resends', type=int, default=2, help="Times each image is uploaded (default: 2)")
+    parser.add_argument('--synthetic', type=int, default=30, help="Synthetic images when no corpus is given")
+    args = parser.parse_args()
+
+    media_root = tempfile.mkdtemp(prefix='image_benchmark_')
+    try:
+        settings.MEDIA_ROOT = media_root
+        corpus = _load_corpus(args.corpus_dir) if args.corpus_dir else _synthetic_corpus(args.synthetic)
+        uploads = len(corpus) * args.resends
+        source_bytes = sum(len(data) for _, data in corpus) * args.resends
+
+        results = [
+            ("legacy", *_run_legacy(corpus, args.resends, media_root)),
+            ("adaptive+cas", *_run_adaptive(corpus, args.resends)),
+        ]
+
+        print(f"{len(corpus)} images x {args.resends} uploads = {uploads} uploads, "
+              f"{source_bytes / (1024 * 1024):.1f} MB received")
+        print(f"{'path':<14}{'cpu ms/image':>14}{'MB written':>12}{'files':>8}")
+        for path, cpu_seconds, bytes_written, files_written in results:
+            print(f"{path:<14}{cpu_seconds * 1000 / uploads:>14.1f}"
+                  f"{bytes_written / (1024 * 1024):>12.2f}{files_written:>8}")
+    finally:
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
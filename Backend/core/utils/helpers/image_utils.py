@@ -2,6 +2,7 @@
 Image utility functions for handling base64 images
 """
 import base64
+import hashlib
 import os
 import uuid
 from django.conf import settings
@@ -9,7 +10,7 @@ from datetime import datetime
 from io import BytesIO
 
 try:
-    from PIL import Image
+    from PIL import Image, ImageOps
     PIL_AVAILABLE = True
 except ImportError:
     PIL_AVAILABLE = False
@@ -43,19 +44,8 @@ def save_base64_image(base64_string, folder_name='attendance_images', attendance
         # Store attendance_type before it gets overwritten
         attendance_image_type = attendance_type
         
-        # Remove data URL prefix if present (e.g., "data:image/jpeg;base64,")
-        if ',' in base64_string:
-            header, base64_string = base64_string.split(',', 1)
-            # Extract image file extension from header
-            if 'image/' in header:
-                file_extension = header.split('image/')[1].split(';')[0]
-            else:
-                file_extension = 'jpg'  # default
-        else:
-            file_extension = 'jpg'  # default
-        
-        # Decode base64 string
-        image_data = base64.b64decode(base64_string)
+        # Decode base64 string (data URL prefix gives the file extension)
+        image_data, file_extension = decode_base64_image(base64_string)
         
         # Validate file format
         allowed_formats = getattr(settings, 'ATTENDANCE_IMAGE_ALLOWED_FORMATS', ['jpg', 'jpeg', 'png', 'webp'])
@@ -150,6 +140,227 @@ def save_base64_image(base64_string, folder_name='attendance_images', attendance
         raise ValueError(f"Error processing base64 image: {str(e)}")
 
 
+def decode_base64_image(base64_string):
+    """
+    Decode a base64 image string (with or without data URL prefix).
+    
+    Returns:
+        tuple: (raw image bytes, file extension taken from the data URL header, default 'jpg')
+    """
+    # Remove data URL prefix if present (e.g., "data:image/jpeg;base64,")
+    file_extension = 'jpg'  # default
+    if ',' in base64_string:
+        header, base64_string = base64_string.split(',', 1)
+        # Extract image file extension from header
+        if 'image/' in header:
+            file_extension = header.split('image/')[1].split(';')[0]
+    
+    return base64.b64decode(base64_string), file_extension
+
+
+def spool_base64_image(base64_string):
+    """
+    Decode a base64 image and write the raw bytes to the spool folder without any
+    PIL work, so the request thread only pays for a base64 decode and one write.
+    The spooled file is turned into the final image later by process_spooled_image().
+    
+    Returns:
+        dict: {
+            'spool_path': relative path from MEDIA_ROOT of the raw bytes,
+            'file_type': file extension from the data URL header,
+            'file_size': raw size in bytes
+        }
+    
+    Raises:
+        ValueError: If base64 string is invalid
+    """
+    try:
+        image_data, file_extension = decode_base64_image(base64_string)
+    except Exception as e:
+        raise ValueError(f"Error decoding base64 image: {str(e)}")
+    
+    spool_folder = getattr(settings, 'ATTENDANCE_IMAGE_SPOOL_FOLDER', 'spool/attendance_images')
+    os.makedirs(os.path.join(settings.MEDIA_ROOT, spool_folder), exist_ok=True)
+    
+    relative_path = os.path.join(spool_folder, f"{uuid.uuid4().hex}.{file_extension}.raw")
+    with open(os.path.join(settings.MEDIA_ROOT, relative_path), 'wb') as f:
+        f.write(image_data)
+    
+    return {
+        'spool_path': relative_path,
+        'file_type': file_extension,
+        'file_size': len(image_data)
+    }
+
+
+def process_spooled_image(spool_path, folder_name='attendance_images', file_extension='jpg'):
+    """
+    Decode, EXIF-strip, resize and compress a spooled raw image into folder_name.
+    Pure file-in/file-out work (no ORM) so it can run in a Celery or process-pool worker.
+    Images are stored content-addressed, so a resent selfie reuses the existing file.
+    The spooled file is removed once the final image is written.
+    
+    Args:
+        spool_path: Relative path from MEDIA_ROOT returned by spool_base64_image()
+        folder_name: Folder name inside MEDIA_ROOT for the final image
+        file_extension: Extension from the original data URL
+    
+    Returns:
+        dict: store_content_addressed() result
+    """
+    source_path = os.path.join(settings.MEDIA_ROOT, spool_path)
+    with open(source_path, 'rb') as f:
+        image_data = f.read()
+    
+    allowed_formats = getattr(settings, 'ATTENDANCE_IMAGE_ALLOWED_FORMATS', ['jpg', 'jpeg', 'png', 'webp'])
+    if file_extension.lower() not in allowed_formats:
+        file_extension = 'jpg'
+    
+    if PIL_AVAILABLE:
+        image_data, file_extension, content_hash = compress_image_adaptive(image_data, file_extension)
+    else:
+        content_hash = hashlib.sha256(image_data).hexdigest()
+    
+    saved_image = store_content_addressed(image_data, file_extension, content_hash, folder_name)
+    os.remove(source_path)
+    
+    return saved_image
+
+
+def compress_image_adaptive(image_data, file_extension='jpg', target_size_bytes=None,
+                            max_width=None, max_height=None, min_quality=None, max_quality=None):
+    """
+    Decode once and encode with the highest quality that fits the size limit.
+    
+    - JPEG sources are decoded with draft() so libjpeg downscales by 1/2, 1/4 or 1/8
+      while decoding instead of materialising full-resolution pixels.
+    - EXIF orientation is applied to the pixels and all metadata is dropped.
+    - The configured quality is tried first (one encode for most selfies); only if
+      that is too large is the quality binary-searched down to min_quality, and only
+      if that still does not fit is the image scaled down.
+    
+    Args:
+        image_data: Raw image bytes
+        file_extension: Requested output extension (jpg, jpeg, png, webp)
+        target_size_bytes: Maximum output size (default: ATTENDANCE_IMAGE_MAX_SIZE_MB)
+        max_width / max_height: Bounding box (default: from settings)
+        min_quality / max_quality: Quality search range (default: from settings)
+    
+    Returns:
+        tuple: (compressed bytes, file extension, SHA-256 hex digest of the decoded pixels)
+    """
+    max_width = max_width or getattr(settings, 'ATTENDANCE_IMAGE_MAX_WIDTH', 1920)
+    max_height = max_height or getattr(settings, 'ATTENDANCE_IMAGE_MAX_HEIGHT', 1080)
+    max_quality = max_quality or getattr(settings, 'ATTENDANCE_IMAGE_QUALITY', 85)
+    min_quality = min_quality or getattr(settings, 'ATTENDANCE_IMAGE_MIN_QUALITY', 20)
+    target_size_bytes = target_size_bytes or getattr(settings, 'ATTENDANCE_IMAGE_MAX_SIZE_MB', 3) * 1024 * 1024
+    
+    img = Image.open(BytesIO(image_data))
+    
+    # Orientations 5-8 are rotated by 90°, so the draft box has to be rotated too
+    draft_box = (max_width, max_height)
+    if img.getexif().get(0x0112) in (5, 6, 7, 8):
+        draft_box = (max_height, max_width)
+    img.draft('RGB', draft_box)
+    
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        img = background
+    elif img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    
+    if img.width > max_width or img.height > max_height:
+        img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+    
+    content_hash = hashlib.sha256(
+        f"{img.mode}:{img.width}x{img.height}:".encode() + img.tobytes()
+    ).hexdigest()
+    
+    file_extension = file_extension.lower()
+    if file_extension == 'png':
+        output = BytesIO()
+        img.save(output, format='PNG', optimize=True)
+        if output.tell() <= target_size_bytes:
+            return output.getvalue(), 'png', content_hash
+        file_extension = 'jpg'  # Lossless does not fit, fall through to lossy search
+    
+    image_format = 'WEBP' if file_extension == 'webp' else 'JPEG'
+    file_extension = 'webp' if image_format == 'WEBP' else 'jpg'
+    
+    def encode(image, quality):
+        output = BytesIO()
+        if image_format == 'WEBP':
+            image.save(output, format='WEBP', quality=quality, method=4)
+        else:
+            image.save(output, format='JPEG', quality=quality, optimize=True)
+        return output.getvalue()
+    
+    for _ in range(4):
+        encoded = encode(img, max_quality)
+        if len(encoded) <= target_size_bytes:
+            return encoded, file_extension, content_hash
+        
+        # Highest quality in [min_quality, max_quality) that fits
+        low, high, best = min_quality, max_quality - 1, None
+        while low <= high:
+            quality = (low + high) // 2
+            candidate = encode(img, quality)
+            if len(candidate) <= target_size_bytes:
+                best, low = candidate, quality + 1
+            else:
+                encoded, high = candidate, quality - 1
+        if best:
+            return best, file_extension, content_hash
+        
+        if min(img.width, img.height) * 3 // 4 < 200:
+            break
+        img = img.resize((img.width * 3 // 4, img.height * 3 // 4), Image.Resampling.LANCZOS)
+    
+    # Smallest encode we produced; may still exceed the limit for pathological inputs
+    return encoded, file_extension, content_hash
+
+
+def store_content_addressed(image_data, file_extension, content_hash, folder_name='attendance_images'):
+    """
+    Write image bytes under folder_name/<hash[:2]>/<hash>.<ext> unless already stored.
+    
+    Returns:
+        dict: {
+            'file_path': relative path from MEDIA_ROOT,
+            'file_name': stored file name,
+            'file_size': size in bytes,
+            'file_type': image file extension,
+            'content_hash': SHA-256 of the decoded pixels,
+            'deduplicated': True if an identical image was already stored
+        }
+    """
+    file_name = f"{content_hash}.{file_extension}"
+    relative_path = os.path.join(folder_name, content_hash[:2], file_name)
+    file_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+    
+    deduplicated = os.path.exists(file_path)
+    if not deduplicated:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # Write-then-rename so concurrent writers of the same hash never expose a partial file
+        tmp_path = f"{file_path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(image_data)
+        os.replace(tmp_path, file_path)
+    
+    return {
+        'file_path': relative_path,
+        'file_name': file_name,
+        'file_size': len(image_data),
+        'file_type': file_extension,
+        'content_hash': content_hash,
+        'deduplicated': deduplicated
+    }
+
+
 def save_multiple_base64_images(base64_images, folder_name='attendance_images', attendance_type='check_in', captured_at=None):
     """
     Save multiple base64 images with limits.